@@ -5,9 +5,13 @@ from janrain_datalib.app import get_app
 from janrain_datalib.app import App
 from janrain_datalib.client import Client
 from janrain_datalib.clientsettings import ClientSettings
+from janrain_datalib.concurrencycontroller import ConcurrencyController
 from janrain_datalib.defaultsettings import DefaultSettings
+from janrain_datalib.progress import Progress
+from janrain_datalib.recordsdelta import RecordsDelta
 from janrain_datalib.schema import Schema
 from janrain_datalib.schemaattributes import SchemaAttributes
+from janrain_datalib.schemamirror import SchemaMirror
 from janrain_datalib.schemarecords import SchemaRecords
 from janrain_datalib.schemarecord import SchemaRecord
 from janrain_datalib.schemarules import SchemaRules
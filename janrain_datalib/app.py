@@ -1,9 +1,13 @@
 """App class."""
 import logging
+import time
 
+import requests
 import requests.exceptions
 import janrain.capture
+import janrain.capture.api
 
+from janrain_datalib import utils
 from janrain_datalib.exceptions import ApiError
 from janrain_datalib.exceptions import ApiAuthError
 from janrain_datalib.exceptions import ApiInputError
@@ -15,6 +19,11 @@ from janrain_datalib.defaultsettings import DefaultSettings
 from janrain_datalib.client import Client
 from janrain_datalib.schema import Schema
 
+# seconds to wait for a streamed response to connect
+_STREAM_CONNECT_TIMEOUT = 10
+# seconds to wait for streamed data beyond the api call's own timeout
+_STREAM_READ_MARGIN = 10
+
 def get_app(application_url, client_id, client_secret, application_id=None, user_agent=None):
     """Get an :class:`.App` object.
 
@@ -40,13 +49,17 @@ def get_app(application_url, client_id, client_secret, application_id=None, user
 class App(object):
     """Encapsulates a Capture app."""
 
-    def __init__(self, api):
+    def __init__(self, api, controller=None):
         """Initialize app.
 
         Args:
             api: a janrain.capture.Api object
+            controller: a :class:`.ConcurrencyController` that limits the
+                api calls in progress at once, shared by all operations
+                using this app (default: no limit)
         """
         self.api = api
+        self.controller = controller
         self.default_settings = DefaultSettings(self)
         self.logger = logging.getLogger('janrain_datalib')
         self.logger.addHandler(logging.NullHandler())
@@ -65,26 +78,225 @@ class App(object):
         Raises:
             ApiError: all kinds
         """
-        exception = None
+        return self._apicall(cmd, kwargs)
+
+    def apicall_stream(self, cmd, key='results', chunk_size=65536, progress=None, **kwargs):
+        """Make an api call, decoding the array at a key of the response
+        incrementally as the response body is received.
+
+        Only one item of the array needs to be in memory at a time and
+        the first item is available before the whole response has arrived.
+
+        Args:
+            cmd: api endpoint (e.g. entity.find)
+            key: key of the array in the response
+            chunk_size: number of bytes to read from the response at a time
+            progress: :class:`.Progress` to count the bytes received
+                and retries in
+            **kwargs: arbitrary keyword args for the api call
+
+        Returns:
+            iterator of the items of the array
+
+        Raises:
+            ApiError: all kinds
+        """
+        def call(cmd, **kwargs):
+            return self._stream_call(cmd, key, chunk_size, kwargs, progress)
+
+        # a concurrency controller counts the call as done once the first
+        # item has arrived, not while the caller works through the rest
+        return self._apicall(cmd, kwargs, call=call, progress=progress)
+
+    def _stream_call(self, cmd, key, chunk_size, kwargs, progress=None):
+        """Post an api call with a streamed response.
+
+        Errors that are found before the first item are raised immediately
+        so that they can be retried. The request times out if it does not
+        connect, or if no data arrives for longer than the api call's own
+        timeout (kwargs['timeout'], default 10 seconds) plus a margin.
+
+        Args:
+            cmd: api endpoint (e.g. entity.find)
+            key: key of the array in the response
+            chunk_size: number of bytes to read from the response at a time
+            kwargs: dict of keyword args for the api call
+            progress: :class:`.Progress` to count the bytes received in
+
+        Returns:
+            iterator of the items of the array
+
+        Raises:
+            janrain.capture.ApiResponseError: if the response is an error
+            requests.exceptions.HTTPError: if the request failed
+        """
+        url, headers, params = self._request_args(cmd, kwargs)
+        timeout = (_STREAM_CONNECT_TIMEOUT, int(kwargs.get('timeout', 10)) + _STREAM_READ_MARGIN)
+        r = requests.post(url, headers=headers, data=params, stream=True, timeout=timeout)
+        if r.status_code != 200:
+            try:
+                janrain.capture.api.raise_api_exceptions(r.json())
+                r.raise_for_status()
+            except ValueError:
+                r.raise_for_status()
+
+        chunks = r.iter_content(chunk_size)
+        if progress is not None:
+            chunks = self._count_bytes(chunks, progress)
+        extra = {}
+        items = utils.iter_json_array(chunks, key, extra)
+        try:
+            first = [next(items)]
+        except StopIteration:
+            first = []
+        except Exception:
+            r.close()
+            raise
+        if not first:
+            r.close()
+            janrain.capture.api.raise_api_exceptions(extra)
+
+        def generate():
+            try:
+                for item in first:
+                    yield item
+                for item in items:
+                    yield item
+            finally:
+                r.close()
+            if extra.get('stat') == 'error':
+                try:
+                    janrain.capture.api.raise_api_exceptions(extra)
+                except janrain.capture.ApiResponseError as err:
+                    raise self._api_exception(cmd, err)
+
+        return generate()
+
+    def _request_args(self, cmd, kwargs):
+        """Build an api request the way janrain.capture.Api.call does,
+        for calls that need to make the request themselves.
+
+        Api.call builds and sends the request in one step, so this repeats
+        its encoding, signing and headers as of janrain-python-api 0.4.0
+        (the version setup.py pins); check it when upgrading.
+
+        Args:
+            cmd: api endpoint (e.g. entity.find)
+            kwargs: dict of keyword args for the api call
+
+        Returns:
+            tuple of (url, headers, params)
+        """
+        api = self.api
+        params = api.defaults.copy()
+        for name, value in kwargs.items():
+            if value is not None:
+                params[name] = value
+        params = {k: janrain.capture.api.api_encode(v) for k, v in params.items()}
+        if cmd[0] != "/":
+            cmd = "/" + cmd
+        if api.sign_requests:
+            headers, params = janrain.capture.api.generate_signature(cmd, params)
+        else:
+            headers = {}
+        headers['User-Agent'] = api.user_agent
+        if api.compress:
+            headers['Accept-encoding'] = 'gzip'
+        return api.api_url + cmd, headers, params
+
+    def _count_bytes(self, chunks, progress):
+        """Count the bytes of response chunks as they are read."""
+        for chunk in chunks:
+            progress.add(num_bytes=len(chunk))
+            yield chunk
+
+    def _apicall(self, cmd, kwargs, retries_max=3, call=None, progress=None):
+        """Make an api call.
+        When the app has a :class:`.ConcurrencyController`, the call waits
+        for it and rate limited calls are retried after a delay.
+
+        Args:
+            cmd: api endpoint (e.g. entityType.list)
+            kwargs: dict of keyword args for the api call
+            retries_max: number of times a timed out call is retried
+                with a longer timeout
+            call: function that makes the call (default is api.call)
+            progress: :class:`.Progress` to count retries in
+
+        Returns:
+            response from the api
+
+        Raises:
+            ApiError: all kinds
+        """
+        if call is None:
+            call = self.api.call
+        controller = self.controller
         retries = 0
-        retries_max = 3
+        rate_retries = 0
         timeout = int(kwargs.get('timeout', 10))
         try:
             while True:
+                if controller is not None:
+                    start = controller.acquire()
+                overloaded = False
+                delay = 0
+                release = controller is not None
                 try:
                     self.logger.debug("apicall: %s", cmd)
-                    return self.api.call(cmd, **kwargs)
+                    return call(cmd, **kwargs)
                 except janrain.capture.ApiResponseError as err:
+                    overloaded = err.code == 504
                     if retries < retries_max and err.code == 504:
                         self.logger.debug("apicall timed out after {} seconds, retrying...".format(timeout))
                         retries += 1
+                        if progress is not None:
+                            progress.add(retries=1)
                         # increase timeout
                         timeout += 10
                         kwargs['timeout'] = timeout
                     else:
                         raise
+                except requests.exceptions.HTTPError as err:
+                    status_code = err.response.status_code
+                    overloaded = status_code in (504, 510)
+                    if controller is None or status_code != 510 or rate_retries >= controller.retries_max:
+                        raise
+                    delay = controller.retry_delay(rate_retries)
+                    self.logger.debug("apicall rate limited, retrying in {} seconds...".format(delay))
+                    rate_retries += 1
+                    if progress is not None:
+                        progress.add(retries=1)
+                finally:
+                    if release:
+                        controller.release(start, overloaded)
+                if delay:
+                    time.sleep(delay)
+
+        except (janrain.capture.ApiResponseError, requests.exceptions.HTTPError) as err:
+            exception = self._api_exception(cmd, err)
+            if exception is None:
+                # something else happened
+                raise
+
+        except Exception:
+            # most likely these will be other Requests errors
+            self.logger.error("other error: %s", cmd)
+            raise
 
-        except janrain.capture.ApiResponseError as err:
+        raise exception
+
+    def _api_exception(self, cmd, err):
+        """Map an error from an api call to an ApiError.
+
+        Args:
+            cmd: api endpoint (e.g. entityType.list)
+            err: janrain.capture.ApiResponseError or requests HTTPError
+
+        Returns:
+            an ApiError, or None if the error should be raised as-is
+        """
+        if isinstance(err, janrain.capture.ApiResponseError):
             err_msg = str(err)
             self.logger.error("api error: %s", cmd)
             cond = any((
@@ -95,38 +307,28 @@ class App(object):
                 "not a valid id" in err_msg,
             ))
             if cond:
-                exception = ApiAuthError(err_msg, err.code)
+                return ApiAuthError(err_msg, err.code, err.error)
             elif err.code == 404 or err.code == 222 or "not found" in err_msg:
-                exception = ApiNotFoundError(err_msg, err.code)
+                return ApiNotFoundError(err_msg, err.code, err.error)
             elif err.code == 226 and "changes have been made" in err_msg:
-                exception = ApiUpdateError(err_msg, err.code)
+                return ApiUpdateError(err_msg, err.code, err.error)
             elif "for_client_id" in err_msg or "flow_body" in err_msg:
-                exception = ApiInputError(err_msg, err.code)
+                return ApiInputError(err_msg, err.code, err.error)
             else:
-                exception = ApiError(err_msg, err.code)
-
-        except requests.exceptions.HTTPError as err:
-            self.logger.error("http error: %s", cmd)
-            cond = any((
-                err.response.status_code == 403,
-                err.response.status_code == 502,
-                err.response.status_code == 504,
-                "too large" in err.response.text,
-            ))
-            if cond:
-                exception = ApiTooLargeError("request was too large", err.response.status_code)
-            elif err.response.status_code == 510:
-                exception = ApiRateLimitError("rate limit exceeded", err.response.status_code)
-            # something else happened
-            raise
-
-        except Exception:
-            # most likely these will be other Requests errors
-            self.logger.error("other error: %s", cmd)
-            raise
-
-        if exception:
-            raise exception
+                return ApiError(err_msg, err.code, err.error)
+
+        self.logger.error("http error: %s", cmd)
+        status_code = err.response.status_code
+        if status_code == 413 or "too large" in err.response.text:
+            return ApiTooLargeError("request was too large", status_code)
+        elif status_code == 403:
+            return ApiAuthError("forbidden", status_code)
+        elif status_code in (502, 504):
+            # the gateway gave up, which says nothing about the request size
+            return ApiError("gateway error", status_code)
+        elif status_code == 510:
+            return ApiRateLimitError("rate limit exceeded", status_code)
+        return None
 
     def get_cache(self, key=None):
         """Retrieve a value from the cache.
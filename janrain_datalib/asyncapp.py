@@ -0,0 +1,103 @@
+"""AsyncApp class."""
+import asyncio
+import concurrent.futures
+import functools
+
+import janrain.capture
+
+from janrain_datalib.app import App
+from janrain_datalib.asyncschemarecords import AsyncSchemaRecords
+
+def get_async_app(application_url, client_id, client_secret, application_id=None,
+                  user_agent=None, concurrency=16, controller=None):
+    """Get an :class:`.AsyncApp` object.
+
+    Args:
+        application_url: capture application url
+        client_id: client_id with admin priveleges
+        client_secret: client_secret for client_id
+        application_id: application id
+        user_agent: user agent to use for api calls
+        concurrency: maximum number of api calls in progress at once
+        controller: a :class:`.ConcurrencyController` (see :class:`.AsyncApp`)
+
+    Returns:
+        an AsyncApp object
+    """
+    defaults = {
+        'client_id': client_id,
+        'client_secret': client_secret,
+    }
+    if application_id is not None:
+        defaults['application_id'] = application_id
+    api = janrain.capture.Api(application_url, defaults, user_agent=user_agent)
+    return AsyncApp(api, concurrency=concurrency, controller=controller)
+
+class AsyncApp(object):
+    """Encapsulates a Capture app for use with asyncio.
+
+    Api calls are handed to a pool of threads so they do not block the
+    event loop, and errors are raised as the same :class:`.ApiError`
+    subclasses as :meth:`.App.apicall`. Requires Python 3.6 or later.
+    """
+
+    def __init__(self, api, concurrency=16, controller=None):
+        """Initialize app.
+
+        Args:
+            api: a janrain.capture.Api object
+            concurrency: maximum number of api calls in progress at once
+            controller: a :class:`.ConcurrencyController` that further limits
+                the api calls in progress, which may be shared with an
+                :class:`.App` so that sync and async operations are limited
+                together (default: no further limit)
+        """
+        self._app = App(api, controller=controller)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+
+    @property
+    def app(self):
+        """The synchronous :class:`.App` making the api calls."""
+        return self._app
+
+    @property
+    def api(self):
+        """The janrain.capture.Api object."""
+        return self._app.api
+
+    @property
+    def logger(self):
+        """Logger used for api calls."""
+        return self._app.logger
+
+    async def apicall(self, cmd, **kwargs):
+        """Make an api call.
+
+        Args:
+            cmd: api endpoint (e.g. entityType.list)
+            **kwargs: arbitrary keyword args for the api call
+
+        Returns:
+            response from the api
+
+        Raises:
+            ApiError: all kinds
+        """
+        loop = asyncio.get_event_loop()
+        call = functools.partial(self._app.apicall, cmd, **kwargs)
+        return await loop.run_in_executor(self._executor, call)
+
+    def get_records(self, schema_name):
+        """Get an :class:`.AsyncSchemaRecords` object.
+
+        Args:
+            schema_name: name of schema
+
+        Returns:
+            an AsyncSchemaRecords object
+        """
+        return AsyncSchemaRecords(self, schema_name)
+
+    def close(self):
+        """Wait for api calls in progress and release the threads."""
+        self._executor.shutdown(wait=True)
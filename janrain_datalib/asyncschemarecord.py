@@ -0,0 +1,86 @@
+"""AsyncSchemaRecord class."""
+from janrain_datalib.utils import to_capture_record
+
+class AsyncSchemaRecord(object):
+    """Encapsulates a schema record for use with asyncio.
+    See :class:`.SchemaRecord` for the synchronous version.
+    """
+
+    def __init__(self, app, schema_name, id_value, id_attribute='uuid'):
+        """Initialize.
+
+        Args:
+            app: AsyncApp object
+            schema_name: name of schema
+            id_value: value of id_attribute
+            id_attribute: attribute to use for identifying the record,
+                (must have 'unique' constraint).
+        """
+        self._app = app
+        self._schema_name = schema_name
+        self._id_value = id_value
+        self._id_attribute = id_attribute
+
+    @property
+    def app(self):
+        """:class:`.AsyncApp` object."""
+        return self._app
+
+    @property
+    def schema_name(self):
+        """Schema name."""
+        return self._schema_name
+
+    @property
+    def id_value(self):
+        """Identifier value."""
+        return self._id_value
+
+    @property
+    def id_attribute(self):
+        """Identifier attribute."""
+        return self._id_attribute
+
+    async def as_dict(self, attributes=None):
+        """The record as a dict.
+
+        Args:
+            attributes: list of attributes to include (default: all attributes)
+
+        Returns:
+            record dict
+        """
+        kwargs = {
+            'type_name': self.schema_name,
+            'key_attribute': self.id_attribute,
+            # must be a "JSON" string
+            'key_value': '"{}"'.format(self.id_value),
+        }
+        if attributes is not None:
+            kwargs['attributes'] = attributes
+        r = await self.app.apicall('entity', **kwargs)
+        return r['result']
+
+    async def update(self, attributes, attribute_path=None, key_map=None, transform_map=None):
+        """Update record.
+
+        Args:
+            attributes: dict of attributes and their values.
+            attribute_path: path to a subset of record attributes to update
+            key_map: dict that maps keys in attributes to attribute dot-paths,
+                or a :class:`.RecordBuilder`
+            transform_map: dict that maps keys in attributes to transform functions
+        """
+        if key_map:
+            attributes = to_capture_record(attributes, key_map, transform_map)
+
+        kwargs = {
+            'type_name': self.schema_name,
+            'key_attribute': self.id_attribute,
+            # must be a "JSON" string
+            'key_value': '"{}"'.format(self.id_value),
+            'attributes': attributes,
+        }
+        if attribute_path is not None:
+            kwargs['attribute_name'] = attribute_path
+        await self.app.apicall('entity.update', **kwargs)
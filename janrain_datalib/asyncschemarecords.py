@@ -0,0 +1,179 @@
+"""AsyncSchemaRecords class."""
+import asyncio
+import collections
+
+from janrain_datalib.asyncschemarecord import AsyncSchemaRecord
+from janrain_datalib.exceptions import ApiError
+from janrain_datalib.exceptions import ApiTooLargeError
+from janrain_datalib.schemarecords import _BATCH_BYTES
+from janrain_datalib.schemarecords import _bulk_create_results
+from janrain_datalib.schemarecords import _commit_mode
+from janrain_datalib.schemarecords import _find_kwargs
+from janrain_datalib.schemarecords import _halves
+from janrain_datalib.schemarecords import _id_attributes
+from janrain_datalib.schemarecords import _id_filter
+from janrain_datalib.schemarecords import _is_record_error
+from janrain_datalib.schemarecords import _record_batches
+from janrain_datalib.schemarecords import _smart_parts
+from janrain_datalib.schemarecords import _too_large_result
+from janrain_datalib.utils import json_array_bytes
+
+class AsyncSchemaRecords(object):
+    """Encapsulates the records in a schema for use with asyncio.
+    See :class:`.SchemaRecords` for the synchronous version.
+    """
+
+    def __init__(self, app, schema_name):
+        """Initialize.
+
+        Args:
+            app: AsyncApp object
+            schema_name: name of schema
+        """
+        self._app = app
+        self._schema_name = schema_name
+
+    @property
+    def app(self):
+        """:class:`.AsyncApp` object."""
+        return self._app
+
+    @property
+    def schema_name(self):
+        """Schema name."""
+        return self._schema_name
+
+    async def create(self, records, mode='smart', batch_size=None, concurrency=1, batch_bytes=None):
+        """Create multiple records.
+
+        Args:
+            records: list or iterator of dicts of attribute keys and values
+            mode: the mode to use when committing the batch
+                (see :meth:`.SchemaRecords.create`)
+            batch_size: maximum number of records per api call
+                (default: 2000)
+            concurrency: number of simultaneous api calls that will be made
+            batch_bytes: maximum size of the records in an api call as JSON
+                (default: 1MB)
+
+        Yields:
+            results for new records as dicts containing either:
+                the id and uuid (on success)
+                or error and error description (on failure)
+            they will be returned in the same order the records were in
+        """
+        smart = mode == 'smart'
+        commit_each = _commit_mode(mode)
+
+        # lowered when a batch turns out to be too large
+        ceiling = {'bytes': batch_bytes or _BATCH_BYTES}
+
+        async def create_batch(start_record_num, batch, commit_each=commit_each):
+            payload = json_array_bytes(batch)
+            kwargs = {
+                'type_name': self.schema_name,
+                'commit_each': commit_each,
+                'all_attributes': payload,
+            }
+            try:
+                r = await self.app.apicall('entity.bulkCreate', **kwargs)
+            except ApiTooLargeError as err:
+                if len(batch) < 2:
+                    # the record is too large on its own
+                    return [(start_record_num, _too_large_result(err))]
+                ceiling['bytes'] = min(ceiling['bytes'], len(payload) // 2)
+                parts = _halves(batch, start_record_num, commit_each)
+            except ApiError as err:
+                if not smart or commit_each is True or not _is_record_error(err):
+                    raise
+                parts = _smart_parts(batch, start_record_num)
+            else:
+                return _bulk_create_results(r, start_record_num)
+            # retry the parts of the failed batch concurrently
+            part_results = await asyncio.gather(*(create_batch(*part) for part in parts))
+            return [result for results in part_results for result in results]
+
+        pending = collections.deque()
+        try:
+            batches = _record_batches(records, batch_size, lambda: ceiling['bytes'])
+            for start_record_num, batch in batches:
+                pending.append(asyncio.ensure_future(create_batch(start_record_num, batch)))
+                if len(pending) >= concurrency:
+                    # batches finish in any order but are yielded in order
+                    for _, result in await pending.popleft():
+                        yield result
+            while pending:
+                for _, result in await pending.popleft():
+                    yield result
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def count(self, filtering=None):
+        """Total records in the schema.
+
+        Args:
+            filtering: filter to apply (default: count all records)
+
+        Returns:
+            count of records
+        """
+        kwargs = {
+            'type_name': self.schema_name,
+        }
+        if filtering:
+            kwargs['filter'] = filtering
+        r = await self.app.apicall('entity.count', **kwargs)
+        return r['total_count']
+
+    async def find(self, attributes=None, sort_on=None, batch_size=None, start_index=None, filtering=None):
+        """Get a batch of records from the schema.
+        See :meth:`.SchemaRecords.find` for the arguments.
+
+        Returns:
+            list of records
+        """
+        kwargs = _find_kwargs(self.schema_name, attributes, sort_on, batch_size, start_index, filtering)
+        r = await self.app.apicall('entity.find', **kwargs)
+        return r['results']
+
+    async def iterator(self, attributes=None, batch_size=None, filtering=None):
+        """Iterate over records in the schema, paging by id.
+
+        Args:
+            attributes: list of attributes to include
+            batch_size: maximum results to return per batch
+            filtering: filter to apply
+
+        Yields:
+            the next record
+        """
+        attributes, remove_id = _id_attributes(attributes)
+        last_id = 0
+        while True:
+            records = await self.find(
+                attributes=attributes,
+                sort_on=['id'],
+                batch_size=batch_size,
+                filtering=_id_filter(filtering, last_id),
+            )
+            if not records:
+                break
+            last_id = records[-1]['id']
+            for record in records:
+                if remove_id:
+                    record.pop('id', None)
+                yield record
+
+    def get_record(self, id_value, id_attribute='uuid'):
+        """Get an :class:`.AsyncSchemaRecord` object.
+
+        Args:
+            id_value: the value of the id_key
+            id_attribute: attribute to use for identifying the record,
+                (must have 'unique' constraint).
+
+        Returns:
+            AsyncSchemaRecord object
+        """
+        return AsyncSchemaRecord(self.app, self.schema_name, id_value, id_attribute)
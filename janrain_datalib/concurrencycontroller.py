@@ -0,0 +1,107 @@
+"""ConcurrencyController class."""
+import threading
+import time
+
+class ConcurrencyController(object):
+    """Limits how many api calls an :class:`.App` has in progress at once,
+    adapting the limit to how the api responds.
+
+    The limit grows by one for each limit's worth of calls that complete
+    within target_seconds (additive increase) and is halved when a call is
+    rate limited (510), times out (504) or is slow (multiplicative
+    decrease). Calls that were already in progress when the limit was
+    decreased do not decrease it again.
+
+    Set one on an App to share it between all of the bulk operations
+    using that App, from any number of threads. It only holds calls back:
+    each operation still has as many worker threads as its own concurrency.
+
+    Example:
+        app = App(api, controller=ConcurrencyController(maximum=16))
+        results = app.get_schema('user').records.create(records, concurrency=16)
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=32, target_seconds=10.0,
+                 backoff_seconds=1.0, retries_max=5):
+        """Initialize.
+
+        Args:
+            initial: starting limit
+            minimum: smallest limit
+            maximum: largest limit
+            target_seconds: calls taking longer than this decrease the limit
+            backoff_seconds: delay before the first retry of a rate limited
+                call, doubled for each further retry
+            retries_max: number of times a rate limited call is retried
+        """
+        self._cond = threading.Condition()
+        self._limit = float(initial)
+        self._minimum = minimum
+        self._maximum = maximum
+        self._target_seconds = target_seconds
+        self._backoff_seconds = backoff_seconds
+        self._retries_max = retries_max
+        self._in_flight = 0
+        self._decreased_at = None
+
+    @property
+    def limit(self):
+        """Current maximum number of calls in progress."""
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        """Number of calls in progress."""
+        return self._in_flight
+
+    @property
+    def maximum(self):
+        """Largest limit."""
+        return self._maximum
+
+    @property
+    def retries_max(self):
+        """Number of times a rate limited call is retried."""
+        return self._retries_max
+
+    def acquire(self):
+        """Wait until another call may start.
+
+        Returns:
+            the time the call started, to pass to :meth:`release`
+        """
+        with self._cond:
+            while self._in_flight >= int(self._limit):
+                self._cond.wait()
+            self._in_flight += 1
+            return time.time()
+
+    def release(self, start, overloaded=False):
+        """Record that a call finished and adjust the limit.
+
+        Args:
+            start: time the call started, from :meth:`acquire`
+            overloaded: whether the call was rate limited or timed out
+        """
+        now = time.time()
+        with self._cond:
+            self._in_flight -= 1
+            if overloaded or now - start > self._target_seconds:
+                # only once for the calls that were in progress together
+                if self._decreased_at is None or start >= self._decreased_at:
+                    self._limit = max(self._minimum, self._limit / 2)
+                    self._decreased_at = now
+            else:
+                self._limit = min(self._maximum, self._limit + 1 / self._limit)
+            self._cond.notify_all()
+
+    def retry_delay(self, retries):
+        """Seconds to wait before retrying a rate limited call.
+
+        Args:
+            retries: number of times the call has been retried already
+
+        Returns:
+            number of seconds
+        """
+        return self._backoff_seconds * 2 ** retries
@@ -2,10 +2,12 @@
 
 class ApiError(Exception):
     """Generic error thrown by an api call."""
-    def __init__(self, message, code):
+    def __init__(self, message, code, error=None):
         super(ApiError, self).__init__(message, code)
         self.message = message
         self.code = code
+        # short name of the error from the api (e.g. unique_violation)
+        self.error = error
 
 class ApiAuthError(ApiError):
     """Authentication error."""
@@ -0,0 +1,168 @@
+"""Progress class."""
+import collections
+import threading
+import time
+
+ProgressSnapshot = collections.namedtuple('ProgressSnapshot', [
+    'records', 'pages', 'bytes', 'retries', 'errors',
+    'total', 'elapsed', 'rate', 'eta', 'done',
+])
+ProgressSnapshot.__doc__ = """Progress of an operation at a point in time.
+
+records: number of records processed
+pages: number of pages (api calls) completed
+bytes: number of bytes received (estimated from the decoded records
+    unless the response was streamed)
+retries: number of api calls that were retried
+errors: number of records that failed
+total: expected number of records, or None if not known
+elapsed: seconds since the operation started
+rate: records per second
+eta: estimated seconds until done, or None if not known
+done: whether the operation has finished
+"""
+
+class Progress(object):
+    """Throughput counters for a long-running records operation.
+
+    Pass one as the progress argument of :meth:`.SchemaRecords.iterator`,
+    :meth:`.SchemaRecords.csv_iterator` or :meth:`.SchemaRecords.create`,
+    then either poll :meth:`snapshot` from another thread or give it a
+    callback. The counters are safe to update from several threads.
+
+    Example:
+        progress = Progress(callback=lambda s: print(s.rate, s.eta))
+        for record in records.iterator(progress=progress):
+            ...
+    """
+
+    def __init__(self, total=None, callback=None, interval=1.0):
+        """Initialize.
+
+        Args:
+            total: expected number of records (default: the operation
+                counts the records before it starts, if it can)
+            callback: function called with a :class:`ProgressSnapshot`
+                at most every interval seconds while the operation runs
+                and once when it finishes (it may be called from a
+                worker thread)
+            interval: minimum seconds between callbacks
+        """
+        self._lock = threading.Lock()
+        self._total = total
+        self._callback = callback
+        self._interval = interval
+        self._counts = {
+            'records': 0,
+            'pages': 0,
+            'bytes': 0,
+            'retries': 0,
+            'errors': 0,
+        }
+        self._start = None
+        self._end = None
+        self._last_callback = None
+
+    @property
+    def total(self):
+        """Expected number of records, or None if not known."""
+        return self._total
+
+    @total.setter
+    def total(self, total):
+        with self._lock:
+            self._total = total
+
+    def start(self):
+        """Start the clock (done automatically by the first update)."""
+        with self._lock:
+            if self._start is None:
+                self._start = time.time()
+
+    def add(self, records=0, pages=0, num_bytes=0, retries=0, errors=0):
+        """Add to the counters.
+
+        Args:
+            records: number of records processed
+            pages: number of pages completed
+            num_bytes: number of bytes received
+            retries: number of api calls retried
+            errors: number of records that failed
+        """
+        now = time.time()
+        with self._lock:
+            if self._start is None:
+                self._start = now
+            counts = self._counts
+            counts['records'] += records
+            counts['pages'] += pages
+            counts['bytes'] += num_bytes
+            counts['retries'] += retries
+            counts['errors'] += errors
+            due = self._callback is not None and (
+                self._last_callback is None or now - self._last_callback >= self._interval)
+            if due:
+                self._last_callback = now
+                snapshot = self._snapshot(now)
+        if due:
+            self._callback(snapshot)
+
+    def finish(self):
+        """Stop the clock and make the final callback."""
+        now = time.time()
+        with self._lock:
+            if self._end is not None:
+                return
+            if self._start is None:
+                self._start = now
+            self._end = now
+            snapshot = self._snapshot(now)
+        if self._callback is not None:
+            self._callback(snapshot)
+
+    def track(self, iterable):
+        """Iterate, finishing when the iterable is exhausted or closed.
+
+        Args:
+            iterable: iterable of the operation's results
+
+        Yields:
+            the items of the iterable
+        """
+        self.start()
+        try:
+            yield from iterable
+        finally:
+            self.finish()
+
+    def snapshot(self):
+        """Get the current progress.
+
+        Returns:
+            a :class:`ProgressSnapshot`
+        """
+        with self._lock:
+            return self._snapshot(time.time())
+
+    def _snapshot(self, now):
+        """Build a snapshot; the lock must be held."""
+        if self._start is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self._end or now) - self._start
+        records = self._counts['records']
+        rate = records / elapsed if elapsed > 0 else 0.0
+        done = self._end is not None
+        eta = None
+        if done:
+            eta = 0.0
+        elif self._total is not None and rate > 0:
+            eta = max(self._total - records, 0) / rate
+        return ProgressSnapshot(
+            total=self._total,
+            elapsed=elapsed,
+            rate=rate,
+            eta=eta,
+            done=done,
+            **self._counts
+        )
@@ -0,0 +1,122 @@
+"""RecordsDelta class."""
+from janrain_datalib.utils import AdaptiveBatchSize
+from janrain_datalib.utils import filter_value
+
+class RecordsDelta(object):
+    """Encapsulates the records that changed since a lastUpdated watermark.
+
+    Iterating yields the records in (lastUpdated, id) order. The watermark
+    is the (lastUpdated, id) of the last record yielded; save it and pass it
+    in on the next run to continue exactly where this one stopped. Records
+    sharing a lastUpdated timestamp are told apart by id, so none are
+    missed or yielded twice.
+    """
+
+    def __init__(self, records, watermark=None, attributes=None, batch_size=None, filtering=None):
+        """Initialize.
+
+        Args:
+            records: SchemaRecords object
+            watermark: dict with 'lastUpdated' and 'id' from a previous run,
+                or a lastUpdated timestamp string to get the records updated
+                at or after that time (default: all records)
+            attributes: list of attributes to include (default: all attributes)
+            batch_size: maximum results to return per batch, or 'auto'
+            filtering: additional filter to apply
+        """
+        if isinstance(watermark, str):
+            watermark = {'lastUpdated': watermark, 'id': 0}
+        elif watermark is not None:
+            watermark = {'lastUpdated': watermark['lastUpdated'], 'id': watermark['id']}
+        if batch_size == 'auto':
+            batch_size = AdaptiveBatchSize()
+        self._records = records
+        self._watermark = watermark
+        self._attributes = attributes
+        self._batch_size = batch_size
+        self._filtering = filtering
+
+    @property
+    def watermark(self):
+        """Dict with the 'lastUpdated' and 'id' of the last record yielded
+        (None if no records have been yielded and none was given).
+        """
+        if self._watermark is None:
+            return None
+        return self._watermark.copy()
+
+    def __iter__(self):
+        """Iterate over the changed records.
+
+        Yields:
+            the next record
+        """
+        attributes = self._attributes
+        remove = []
+        if attributes is not None:
+            # needed to move the watermark
+            for attr in ('lastUpdated', 'id'):
+                if attr not in attributes:
+                    attributes = attributes + [attr]
+                    remove.append(attr)
+
+        for records in self._pages(attributes):
+            for record in records:
+                self._watermark = {
+                    'lastUpdated': record['lastUpdated'],
+                    'id': record['id'],
+                }
+                for attr in remove:
+                    record.pop(attr, None)
+                yield record
+
+    def _pages(self, attributes):
+        """Page through the changed records.
+
+        Each page of records newer than the current timestamp may end part
+        way through the records sharing its last timestamp, so the rest of
+        those are paged through by id before moving on.
+
+        Yields:
+            lists of records
+        """
+        if self._watermark is None:
+            timestamp = None
+            last_id = 0
+        else:
+            timestamp = self._watermark['lastUpdated']
+            last_id = self._watermark['id']
+
+        while True:
+            newer = None
+            if timestamp is not None:
+                # remaining records with the same timestamp
+                while True:
+                    same = 'lastUpdated = {} and id > {}'.format(filter_value(timestamp), last_id)
+                    records = self._find(attributes, ['id'], same)
+                    if not records:
+                        break
+                    last_id = records[-1]['id']
+                    yield records
+                newer = 'lastUpdated > {}'.format(filter_value(timestamp))
+
+            records = self._find(attributes, ['lastUpdated', 'id'], newer)
+            if not records:
+                break
+            timestamp = records[-1]['lastUpdated']
+            last_id = records[-1]['id']
+            yield records
+            if isinstance(self._batch_size, int) and len(records) < self._batch_size:
+                # a short batch means there is nothing newer
+                break
+
+    def _find(self, attributes, sort_on, filtering):
+        """Get a batch of records matching the filter and the
+        additional filter.
+        """
+        if self._filtering is not None:
+            if filtering is None:
+                filtering = self._filtering
+            else:
+                filtering = '{} and {}'.format(self._filtering, filtering)
+        return self._records.find(attributes, sort_on, self._batch_size, filtering=filtering)
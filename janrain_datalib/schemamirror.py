@@ -0,0 +1,280 @@
+"""SchemaMirror class."""
+import itertools
+import json
+import re
+import sqlite3
+
+from janrain_datalib.exceptions import InputError
+from janrain_datalib.utils import to_json
+
+_ATTRIBUTE = re.compile(r'^\w+(\.\w+)*$')
+_PLACEHOLDER = re.compile(r'\{([^{}]*)\}')
+
+class SchemaMirror(object):
+    """Encapsulates a local SQLite copy of the records in a schema.
+
+    Records are stored as JSON keyed by id. Attributes are read with
+    SQLite's json_extract, and the attributes listed in indexes get an
+    expression index so that lookups on them do not scan the table.
+
+    The first :meth:`sync` copies every record page by page in id order.
+    Later syncs only fetch the records updated since the previous one.
+
+    Example:
+        mirror = records.mirror('user.sqlite', indexes=['email'])
+        mirror.sync()
+        mirror.count("{birthday} < ?", ['1970-01-01'])
+        mirror.find("{email} = ?", ['test@test.test'])
+    """
+
+    def __init__(self, records, path, indexes=None, attributes=None):
+        """Initialize.
+
+        Args:
+            records: SchemaRecords object
+            path: path to the SQLite database (created if missing)
+            indexes: list of attributes to index
+            attributes: list of attributes to copy (default: all attributes)
+
+        Raises:
+            InputError: if the database is a mirror of a different schema
+                or set of attributes, or an attribute name is invalid
+        """
+        if attributes is not None and 'id' not in attributes:
+            # the records are keyed by id
+            attributes = attributes + ['id']
+        self._records = records
+        self._path = path
+        self._attributes = attributes
+        self._conn = sqlite3.connect(path)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS records (id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            for key, value in (('schema_name', records.schema_name), ('attributes', attributes)):
+                saved = self._get_meta(key, value)
+                if saved != value:
+                    raise InputError("{} is a mirror of a different {}".format(path, key))
+                self._set_meta(key, value)
+            for attribute in ['uuid'] + (indexes or []):
+                self._conn.execute("CREATE INDEX IF NOT EXISTS {} ON records ({})".format(
+                    'index_' + attribute.replace('.', '__'), self.column(attribute)))
+
+    @property
+    def records(self):
+        """The :class:`.SchemaRecords` the mirror is copied from."""
+        return self._records
+
+    @property
+    def path(self):
+        """Path to the SQLite database."""
+        return self._path
+
+    @property
+    def connection(self):
+        """The sqlite3 connection, for queries :meth:`find` can't express."""
+        return self._conn
+
+    @property
+    def watermark(self):
+        """Watermark of the last sync (see :class:`.RecordsDelta`)."""
+        return self._get_meta('watermark')
+
+    def sync(self, batch_size=None, prune=False):
+        """Bring the mirror up to date.
+
+        The first sync copies all the records and later ones copy the
+        records that were created or updated since the previous sync.
+        Progress is committed after every batch, so an interrupted sync
+        continues where it stopped.
+
+        Args:
+            batch_size: maximum results to return per batch, or 'auto'
+            prune: also scan the ids of all the records to remove the ones
+                that were deleted from the schema
+
+        Returns:
+            number of records copied
+        """
+        copied = 0
+        if not self._get_meta('synced', False):
+            copy = self._get_meta('copy')
+            if copy is None:
+                # anything updated while copying gets a later lastUpdated;
+                # if there is nothing to copy, the watermark stays None and
+                # the next sync copies whatever has been created since, then
+                # takes its watermark from the server's timestamps
+                copy = {'watermark': self._latest_update()}
+                with self._conn:
+                    self._set_meta('copy', copy)
+            # continue an interrupted copy after the last record written
+            last_id = self._conn.execute("SELECT MAX(id) FROM records").fetchone()[0] or 0
+            pages = self._records.iter_pages(self._attributes, batch_size, start_id=last_id)
+            for page in pages:
+                with self._conn:
+                    copied += self._write(page.records)
+            with self._conn:
+                self._set_meta('watermark', copy['watermark'])
+                self._set_meta('synced', True)
+                self._conn.execute("DELETE FROM meta WHERE key = 'copy'")
+
+        delta = self._records.delta(self.watermark, self._attributes, batch_size)
+        delta_records = iter(delta)
+        size = batch_size if isinstance(batch_size, int) else 1000
+        while True:
+            batch = list(itertools.islice(delta_records, size))
+            if not batch:
+                break
+            with self._conn:
+                copied += self._write(batch)
+                self._set_meta('watermark', delta.watermark)
+
+        if prune:
+            self.prune(batch_size)
+        return copied
+
+    def prune(self, batch_size=None):
+        """Remove records that were deleted from the schema.
+        Scans the ids of all the records in the schema.
+
+        Args:
+            batch_size: maximum results to return per batch
+
+        Returns:
+            number of records removed
+        """
+        removed = 0
+        last_id = 0
+        for page in self._records.iter_pages(['id'], batch_size):
+            removed += self._remove_missing(last_id, page.last_id, page.records)
+            last_id = page.last_id
+        removed += self._remove_missing(last_id, None, [])
+        return removed
+
+    def column(self, attribute):
+        """SQL expression for the value of an attribute.
+        Use the same expression in queries for indexes to be used.
+
+        Args:
+            attribute: dot-separated attribute path
+
+        Returns:
+            SQL expression string
+
+        Raises:
+            InputError: if the attribute name is invalid
+        """
+        if not _ATTRIBUTE.match(attribute):
+            raise InputError("invalid attribute: {}".format(attribute))
+        return "json_extract(data, '$.{}')".format(attribute)
+
+    def count(self, where=None, params=()):
+        """Count the records in the mirror.
+
+        Args:
+            where: SQL condition, in which {attribute} stands for the
+                value of an attribute
+            params: values for the ? placeholders in the condition
+
+        Returns:
+            number of records matching the condition
+        """
+        sql = "SELECT COUNT(*) FROM records" + self._where(where)
+        return self._conn.execute(sql, params).fetchone()[0]
+
+    def find(self, where=None, params=(), order_by=None, limit=None):
+        """Find records in the mirror.
+
+        Args:
+            where: SQL condition, in which {attribute} stands for the
+                value of an attribute
+            params: values for the ? placeholders in the condition
+            order_by: SQL ordering, as for where (default: id)
+            limit: maximum number of records to return
+
+        Returns:
+            list of records
+        """
+        sql = "SELECT data FROM records" + self._where(where)
+        sql += " ORDER BY " + self._expand(order_by or "id")
+        if limit is not None:
+            sql += " LIMIT {:d}".format(limit)
+        return [json.loads(row[0]) for row in self._conn.execute(sql, params)]
+
+    def get(self, id_value, id_attribute='uuid'):
+        """Get a record from the mirror.
+
+        Args:
+            id_value: unique identifier of the record
+            id_attribute: attribute that uniquely identifies the record
+
+        Returns:
+            the record, or None if it is not in the mirror
+        """
+        if id_attribute == 'id':
+            where = "id = ?"
+        else:
+            where = self.column(id_attribute) + " = ?"
+        found = self.find(where, [id_value], limit=1)
+        return found[0] if found else None
+
+    def close(self):
+        """Close the database."""
+        self._conn.close()
+
+    def _where(self, where):
+        if where is None:
+            return ""
+        return " WHERE " + self._expand(where)
+
+    def _expand(self, sql):
+        """Replace {attribute} with the SQL expression for its value."""
+        return _PLACEHOLDER.sub(lambda m: self.column(m.group(1)), sql)
+
+    def _latest_update(self):
+        """lastUpdated of the most recently updated record,
+        or None if there are no records.
+        """
+        found = self._records.find(attributes=['lastUpdated'], sort_on=['-lastUpdated'], batch_size=1)
+        if not found:
+            return None
+        return found[0]['lastUpdated']
+
+    def _write(self, records):
+        """Insert or replace records.
+
+        Returns:
+            number of records written
+        """
+        rows = [(record['id'], to_json(record, compact=True)) for record in records]
+        self._conn.executemany("INSERT OR REPLACE INTO records (id, data) VALUES (?, ?)", rows)
+        return len(rows)
+
+    def _remove_missing(self, start_id, end_id, records):
+        """Remove records with ids in (start_id, end_id] that are not
+        in a page of records from the schema.
+
+        Returns:
+            number of records removed
+        """
+        sql = "SELECT id FROM records WHERE id > ?"
+        params = [start_id]
+        if end_id is not None:
+            sql += " AND id <= ?"
+            params.append(end_id)
+        present = {record['id'] for record in records}
+        missing = [row for row in self._conn.execute(sql, params) if row[0] not in present]
+        with self._conn:
+            self._conn.executemany("DELETE FROM records WHERE id = ?", missing)
+        return len(missing)
+
+    def _get_meta(self, key, default=None):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def _set_meta(self, key, value):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
@@ -92,7 +92,8 @@ class SchemaRecord(object):
 
         Args:
             attributes: dict of attributes and their values.
-            key_map: dict that maps keys in attributes to attribute dot-paths
+            key_map: dict that maps keys in attributes to attribute dot-paths,
+                or a :class:`.RecordBuilder`
             transform_map: dict that maps keys in attributes to transform functions
 
         Returns:
@@ -132,7 +133,8 @@ class SchemaRecord(object):
         Args:
             attributes: dict of attributes and their values.
             attribute_path: path to a subset of record attributes to replace
-            key_map: dict that maps keys in attributes to attribute dot-paths
+            key_map: dict that maps keys in attributes to attribute dot-paths,
+                or a :class:`.RecordBuilder`
             transform_map: dict that maps keys in attributes to transform functions
         """
         if key_map:
@@ -155,7 +157,8 @@ class SchemaRecord(object):
         Args:
             attributes: dict of attributes and their values.
             attribute_path: path to a subset of record attributes to update
-            key_map: dict that maps keys in attributes to attribute dot-paths
+            key_map: dict that maps keys in attributes to attribute dot-paths,
+                or a :class:`.RecordBuilder`
             transform_map: dict that maps keys in attributes to transform functions
         """
         if key_map:
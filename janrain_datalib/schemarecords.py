@@ -1,14 +1,61 @@
 """SchemaRecords class."""
+import collections
 import concurrent.futures
+import csv
+import functools
+import gzip
+import io
 import itertools
 import json
+import os
 import queue
-import re
+import shutil
+import threading
+import time
 
+from janrain_datalib.exceptions import ApiError
+from janrain_datalib.exceptions import ApiAuthError
+from janrain_datalib.exceptions import ApiRateLimitError
+from janrain_datalib.exceptions import ApiTooLargeError
+from janrain_datalib.exceptions import InputError
+from janrain_datalib.utils import AdaptiveBatchSize
+from janrain_datalib.utils import DuplicateFilter
+from janrain_datalib.utils import Projector
+from janrain_datalib.utils import RecordBuilder
+from janrain_datalib.utils import csv_field
+from janrain_datalib.utils import filter_value
+from janrain_datalib.utils import json_array_bytes
 from janrain_datalib.utils import to_csv
-from janrain_datalib.utils import dot_lookup
+from janrain_datalib.utils import to_json_bytes
+from janrain_datalib.utils import to_json_line
+from janrain_datalib.utils import load_json_file
+from janrain_datalib.utils import ordered_map
+from janrain_datalib.utils import save_json_file
+from janrain_datalib.utils import read_ahead
+from janrain_datalib.utils import split_range
+from janrain_datalib.recordsdelta import RecordsDelta
+from janrain_datalib.schemamirror import SchemaMirror
 from janrain_datalib.schemarecord import SchemaRecord
 
+# failed 'smart' batches this small are retried with commit_each
+_SMART_EACH_SIZE = 8
+# default limits for entity.bulkCreate batches
+_BATCH_RECORDS = 2000
+_BATCH_BYTES = 1000000
+# limits for the filters that look up records by key
+_KEYS_PER_FIND = 100
+_FILTER_CHARS = 4000
+
+RecordsPage = collections.namedtuple('RecordsPage', ['records', 'first_id', 'last_id', 'elapsed'])
+RecordsPage.__doc__ = """A batch of records from :meth:`SchemaRecords.iter_pages`.
+
+Attributes:
+    records: list of records sorted by id
+    first_id: id of the first record
+    last_id: id of the last record
+    elapsed: seconds the api call took
+"""
+
 class SchemaRecords(object):
     """Encapsulates the records in a schema."""
 
@@ -32,7 +79,8 @@ class SchemaRecords(object):
         """Schema name."""
         return self._schema_name
 
-    def create(self, records, mode='smart', batch_size=None, concurrency=1):
+    def create(self, records, mode='smart', batch_size=None, concurrency=1, progress=None,
+               batch_bytes=None, dedupe=None, check_existing=False):
         """Create multiple records.
 
         Args:
@@ -40,16 +88,40 @@ class SchemaRecords(object):
             mode: the mode to use when committing the batch
                 options: ('smart', 'each', 'all')
                     'smart': try to create all in a single batch - if it fails,
-                        fallback to 'each' (minimizes failures
-                        while providing a speed boost if most records are ok)
+                        split it in half and retry each half the same way,
+                        down to a few records which are created with 'each'
+                        (minimizes failures while committing the good
+                        records in bulk)
                     'each': create each record separately - if one fails,
                         continue to the next one (slow)
                     'all': create all in a single batch - if any one fails, all
                         of the records in the batch will fail (fast, but some
                         records may fail that would not have)
-            batch_size: if specified, api calls will be broken up into batches
-                of this number of records
-            concurrency: number of simultaneous api calls that will be made
+            batch_size: maximum number of records per api call
+                (default: 2000)
+            concurrency: maximum number of simultaneous api calls that will
+                be made (and of worker threads); if the app has a
+                :class:`.ConcurrencyController`, it may allow fewer
+            progress: :class:`.Progress` to report to (its total defaults
+                to the number of records, if records is a list)
+            batch_bytes: maximum size of the records in an api call as JSON,
+                a batch is closed before it grows past this size or
+                batch_size records (default: 1MB); a batch that is still too
+                large is split in half and the halves are retried concurrently,
+                and the remaining batches are kept as small as the halves; a
+                record that is too large on its own gets an error result
+            dedupe: True to not send records that repeat a unique key of an
+                earlier record that was created, using the schema's 'unique'
+                attribute constraints and rules, or a list of unique keys (each a list of attribute
+                paths) to use instead; they get the same unique_violation
+                result as from the api (see :class:`.DuplicateFilter`).
+                A record whose key is that of a record still being created
+                waits for its result, and is created on its own if that
+                record failed
+            check_existing: with dedupe, also look up the values of the unique
+                keys of a single top-level attribute in the schema, a batch
+                of records at a time, and not send records that would
+                duplicate an existing record
 
         Yields:
             results for new records as dicts containing either:
@@ -57,66 +129,210 @@ class SchemaRecords(object):
                 or error and error description (on failure)
             they will be returned in the same order the records were in
         """
-        if mode == 'each':
-            mode = True
-        elif mode == 'all':
-            mode = False
+        if dedupe:
+            results = self._create_unique(records, dedupe, check_existing, mode, batch_size,
+                                          concurrency, progress, batch_bytes)
+        else:
+            results = self._create(records, mode, batch_size, concurrency, progress, batch_bytes)
+        if progress is not None:
+            if progress.total is None and hasattr(records, '__len__'):
+                progress.total = len(records)
+            return progress.track(results)
+        return results
+
+    def _create_unique(self, records, dedupe, check_existing, mode, batch_size, concurrency,
+                       progress=None, batch_bytes=None):
+        """Create multiple records (see :meth:`create`), reporting the
+        duplicates of created or existing records without sending them.
+
+        Yields:
+            results for new records in the same order as the records
+        """
+        keys = self._unique_keys() if dedupe is True else dedupe
+        duplicates = DuplicateFilter(keys)
+        lookup_keys = [key[0] for key in keys if len(key) == 1 and '.' not in key[0]]
+        # what happened to each record, in order: ('sent', keys),
+        # ('duplicate', None) or ('held', (record, keys)) for a record
+        # whose key was reserved by an earlier one still being created
+        outcomes = collections.deque()
+
+        def duplicate():
+            if progress is not None:
+                progress.add(records=1, errors=1)
+            return _unique_violation()
+
+        def unique_records():
+            records_iter = iter(records)
+            while True:
+                group = list(itertools.islice(records_iter, _KEYS_PER_FIND))
+                if not group:
+                    break
+                existing = {}
+                if check_existing:
+                    existing = self._existing_values(group, lookup_keys)
+                for record in group:
+                    if any(record.get(attr) in values for attr, values in existing.items()):
+                        outcomes.append(('duplicate', None))
+                        continue
+                    record_keys = duplicates.keys(record)
+                    status = duplicates.reserve(record_keys)
+                    if status == 'duplicate':
+                        outcomes.append(('duplicate', None))
+                    elif status == 'pending':
+                        outcomes.append(('held', (record, record_keys)))
+                    else:
+                        outcomes.append(('sent', record_keys))
+                        yield record
+
+        def resolve(kind, value):
+            """Result of a record that was not sent with the others. The
+            records before it have all been resolved, so a held record's
+            key is no longer reserved by an earlier one.
+            """
+            if kind == 'duplicate':
+                return duplicate()
+            record, record_keys = value
+            status = duplicates.reserve(record_keys)
+            if status == 'duplicate':
+                return duplicate()
+            # the earlier record failed, so this one may be created
+            result = next(self._create([record], mode, None, 1, progress, batch_bytes))
+            if status is None:
+                duplicates.release(record_keys, 'error' not in result)
+            return result
+
+        results = self._create(
+            unique_records(), mode, batch_size, concurrency, progress, batch_bytes)
+        for result in results:
+            # the records before this one were all seen before it was sent
+            kind, value = outcomes.popleft()
+            while kind != 'sent':
+                yield resolve(kind, value)
+                kind, value = outcomes.popleft()
+            duplicates.release(value, 'error' not in result)
+            yield result
+        # the records have all been read once the results are done
+        while outcomes:
+            yield resolve(*outcomes.popleft())
+
+    def _unique_keys(self):
+        """Unique keys of the schema: each attribute with a 'unique'
+        constraint, and the attributes of each 'unique' rule.
+
+        Returns:
+            list of unique keys, each a list of attribute dot-paths
+        """
+        schema = self.app.get_schema(self.schema_name)
+        keys = [[path] for path in _unique_attributes(schema.get_attr_defs())]
+        for rule in schema.get_rule_defs():
+            if rule['definition'] == 'unique':
+                key = [attr.strip('/').replace('/', '.') for attr in rule['attributes']]
+                if key not in keys:
+                    keys.append(key)
+        return keys
+
+    def _existing_values(self, records, attributes):
+        """Values of unique attributes of records that are already in the schema.
+
+        Returns:
+            dict that maps each attribute to a set of values
+        """
+        existing = {}
+        for attr in attributes:
+            values = [record.get(attr) for record in records]
+            found = set()
+            for group in self._key_groups(values, attr):
+                found.update(self._find_keys(attr, group, [attr]))
+            existing[attr] = found
+        return existing
+
+    def _create(self, records, mode, batch_size, concurrency, progress=None, batch_bytes=None):
+        """Create multiple records (see :meth:`create`).
+
+        Yields:
+            results for new records in the same order as the records
+        """
+        smart = mode == 'smart'
+        commit_each = _commit_mode(mode)
+
+        # lowered when a batch turns out to be too large
+        ceiling = {'bytes': batch_bytes or _BATCH_BYTES}
+        ceiling_lock = threading.Lock()
 
         futures_q = queue.Queue(maxsize=concurrency*2)
         results_q = queue.Queue()
 
-        def create_batch(batch, start_record_num):
+        def create_batch(batch, start_record_num, commit_each=commit_each):
             """Create a batch of records.
 
             Returns:
-                iterator of tuples consisting of (record_num, uuid_result)
+                tuple of (results, parts): the list of tuples consisting of
+                (record_num, uuid_result), or if the batch was too large or
+                failed in 'smart' mode, the list of
+                (start_record_num, batch, commit_each) tuples to retry instead
             """
+            payload = json_array_bytes(batch)
             kwargs = {
                 'type_name': self.schema_name,
-                'commit_each': mode,
-                'all_attributes': batch,
+                'commit_each': commit_each,
+                'all_attributes': payload,
             }
-            r = self.app.apicall('entity.bulkCreate', **kwargs)
-            batch_results = []
-            for i, cid, uuid in zip(itertools.count(start=start_record_num), r['results'], r['uuid_results']):
-                if isinstance(uuid, dict):
-                    result = (i, uuid)
-                else:
-                    result = (i, {'id': cid, 'uuid': uuid})
-                batch_results.append(result)
-            return batch_results
+            try:
+                r = self.app._apicall('entity.bulkCreate', kwargs, progress=progress)
+            except ApiTooLargeError as err:
+                if len(batch) < 2:
+                    # the record is too large on its own
+                    if progress is not None:
+                        progress.add(records=1, pages=1, errors=1)
+                    return [(start_record_num, _too_large_result(err))], []
+                with ceiling_lock:
+                    # the remaining batches are built no larger than the halves
+                    ceiling['bytes'] = min(ceiling['bytes'], len(payload) // 2)
+                self.app.logger.debug("batch of %s bytes was too large, splitting", len(payload))
+                if progress is not None:
+                    progress.add(retries=1)
+                return [], _halves(batch, start_record_num, commit_each)
+            except ApiError as err:
+                if not smart or commit_each is True or not _is_record_error(err):
+                    raise
+                self.app.logger.debug("batch of %s records failed, splitting", len(batch))
+                if progress is not None:
+                    progress.add(retries=1)
+                return [], _smart_parts(batch, start_record_num)
+            results = _bulk_create_results(r, start_record_num)
+            if progress is not None:
+                errors = sum(1 for _, result in results if 'error' in result)
+                progress.add(records=len(results), pages=1, errors=errors)
+            return results, []
 
         def records_creator(batch_size, executor):
             """Schedules creation of record batches and puts the future
             results in a queue for later retrieval.
             """
-            batch = []
-            # keep track of the record_num at the beginning of each batch so
-            # that information is available when the results are retrieved
-            start_record_num = None
-            for record_num, record in enumerate(records, start=1):
-                if not start_record_num:
-                    start_record_num = record_num
-                batch.append(record)
-                if not batch_size:
-                    # find reasonable batch size based on size of first record
-                    record_len = len(json.dumps(record))
-                    # limit batches to approx 1MB
-                    batch_size = 1 + int(1000000 / record_len)
-                    if batch_size > 2000:
-                        # or 2000 records, whichever is less
-                        batch_size = 2000
-                if len(batch) >= batch_size:
-                    future = executor.submit(create_batch, batch, start_record_num)
-                    futures_q.put(future)
-                    # start a new batch
-                    batch = []
-                    start_record_num = None
-            # leftover records
-            if batch:
+            batches = _record_batches(records, batch_size, lambda: ceiling['bytes'])
+            for start_record_num, batch in batches:
                 future = executor.submit(create_batch, batch, start_record_num)
                 futures_q.put(future)
 
+        def batch_results(future, executor):
+            """Wait for a batch, retrying the parts of a failed batch
+            concurrently.
+
+            Returns:
+                list of tuples consisting of (record_num, uuid_result)
+            """
+            results, parts = future.result()
+            if parts:
+                # the parts are submitted, not run here, so that a worker
+                # never waits on another worker
+                futures = [
+                    executor.submit(create_batch, batch, start_record_num, commit_each)
+                    for start_record_num, batch, commit_each in parts
+                ]
+                for part_future in futures:
+                    results.extend(batch_results(part_future, executor))
+            return results
+
         def results_fetcher():
             """Starts the record creating thread, gets the results from
             the futures queue, and puts them in the results queue.
@@ -136,12 +352,15 @@ class SchemaRecords(object):
                             break
                     else:
                         try:
-                            result = future.result()
+                            result = batch_results(future, creator_executor)
                         except Exception:
                             # stop creating records if an error happens
                             creator_executor.shutdown(wait=False)
                             # unwedge records_creator
-                            futures_q.get(timeout=1)
+                            try:
+                                futures_q.get_nowait()
+                            except queue.Empty:
+                                pass
                             raise
                         else:
                             results_q.put(result)
@@ -164,7 +383,7 @@ class SchemaRecords(object):
                             # might raise an exception
                             results_future.result()
                             # all done
-                            raise StopIteration
+                            return
                     else:
                         # put results into the map
                         for record_num, result in results:
@@ -172,6 +391,343 @@ class SchemaRecords(object):
 
                 yield results_map.pop(i)
 
+    def import_csv(self, fp, key_map=None, transform_map=None, mode='smart', batch_size=None,
+                   concurrency=1, processes=None, chunk_size=1000, delimiter=None,
+                   progress=None, batch_bytes=None):
+        """Create records from the rows of a CSV file.
+
+        The file is read a chunk of rows at a time by a background thread,
+        the rows are converted with a :class:`.RecordBuilder` and the
+        records are created as in :meth:`create`. Bounded queues between
+        the stages keep memory use constant for files of any size, and a
+        slow stage holds back the ones before it.
+
+        Example:
+            with open('users.csv', newline='') as fp:
+                for line_num, result in records.import_csv(fp, key_map, concurrency=4):
+                    if 'error' in result:
+                        print(line_num, result['error_description'])
+
+        Args:
+            fp: file object opened in text mode, with a header row
+            key_map: dict that maps column names to attribute dot-paths,
+                or a :class:`.RecordBuilder`
+            transform_map: dict that maps column names to transform functions
+            mode: the mode to use when committing the batches (see :meth:`create`)
+            batch_size: maximum number of records per api call (see :meth:`create`)
+            concurrency: number of simultaneous api calls that will be made
+                (see :meth:`create`)
+            processes: if specified, the rows are converted on a pool of this
+                many processes (the transform functions must be picklable,
+                e.g. defined at module level)
+            chunk_size: number of rows read and converted at a time
+            delimiter: the delimiter to use (default: comma)
+            progress: :class:`.Progress` to report to
+            batch_bytes: maximum size of the records in an api call
+                (see :meth:`create`)
+
+        Yields:
+            tuples of (line number, result) in the same order as the rows,
+            where the line number is that of the row in the file (its last
+            line, if a field contains newlines) and the result is as in
+            :meth:`create`
+        """
+        reader = csv.DictReader(fp, delimiter=delimiter or ',')
+        line_nums = collections.deque()
+        if not isinstance(key_map, RecordBuilder):
+            key_map = RecordBuilder(key_map, transform_map)
+
+        def chunks():
+            """Read the rows a chunk at a time with their line numbers."""
+            lines = []
+            rows = []
+            for row in reader:
+                lines.append(reader.line_num)
+                rows.append(row)
+                if len(rows) >= chunk_size:
+                    yield lines, rows
+                    lines = []
+                    rows = []
+            if rows:
+                yield lines, rows
+
+        def records(converted):
+            """Records to create, noting the line number of each one."""
+            for lines, chunk_records in converted:
+                line_nums.extend(lines)
+                yield from chunk_records
+
+        def convert(executor, chunk):
+            """Convert a chunk of rows, in a worker process if there is a pool."""
+            lines, rows = chunk
+            if executor is None:
+                return lines, _capture_records(rows, key_map)
+            future = executor.submit(_capture_records, rows, key_map)
+            return lines, future.result()
+
+        def create(executor):
+            chunks_read = read_ahead(chunks(), 2)
+            if executor is None:
+                # converted by the thread that batches the records
+                converted = (convert(None, chunk) for chunk in chunks_read)
+            else:
+                converted = ordered_map(
+                    functools.partial(convert, executor), chunks_read, processes)
+            results = self._create(
+                records(converted), mode, batch_size, concurrency, progress, batch_bytes)
+            for result in results:
+                yield line_nums.popleft(), result
+
+        def import_rows():
+            if not processes:
+                yield from create(None)
+                return
+            with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+                yield from create(executor)
+
+        if progress is not None:
+            return progress.track(import_rows())
+        return import_rows()
+
+    def update_many(self, updates, id_attribute='uuid', attribute_path=None, key_map=None,
+                    transform_map=None, concurrency=1, progress=None):
+        """Update multiple records, one api call per record.
+
+        Example:
+            updates = ((row['uuid'], {'givenName': row['name']}) for row in rows)
+            for uuid, result in records.update_many(updates, concurrency=8):
+                ...
+
+        Args:
+            updates: list or iterator of tuples of (id_value, attributes)
+            id_attribute: attribute that identifies the records
+                (must have 'unique' constraint)
+            attribute_path: path to a subset of record attributes to update
+            key_map: dict that maps keys in attributes to attribute dot-paths,
+                or a :class:`.RecordBuilder`
+            transform_map: dict that maps keys in attributes to transform functions
+            concurrency: number of simultaneous api calls that will be made
+                (see :meth:`create`)
+            progress: :class:`.Progress` to report to (its total defaults
+                to the number of updates, if updates is a list)
+
+        Yields:
+            tuples of (id value, result) in the same order as the updates,
+            the results being dicts containing either:
+                stat 'ok' (on success)
+                or error and error description (on failure)
+
+        Raises:
+            ApiAuthError: if the client may not update records
+            ApiRateLimitError: if the api stays rate limited
+        """
+        if (key_map or transform_map) and not isinstance(key_map, RecordBuilder):
+            # compiled once for all the records
+            key_map = RecordBuilder(key_map, transform_map)
+
+        def update(item):
+            id_value, attributes = item
+            record = self.get_record(id_value, id_attribute)
+            record.update(attributes, attribute_path, key_map, transform_map)
+
+        results = self._record_calls(update, updates, concurrency, progress)
+        return self._track_items(
+            ((item[0], result) for item, result in results), updates, progress)
+
+    def delete_many(self, id_values=None, filtering=None, id_attribute='uuid', batch_size=None,
+                    concurrency=1, progress=None):
+        """Delete multiple records, one api call per record.
+
+        Either a list of id values or a filter must be given. The records
+        matching a filter are found a batch at a time in id order while the
+        previous batch is being deleted.
+
+        Example:
+            for uuid, result in records.delete_many(filtering="email like '%@example.com'"):
+                ...
+
+        Args:
+            id_values: list or iterator of the id values of the records to delete
+            filtering: filter matching the records to delete
+            id_attribute: attribute that identifies the records in id_values
+                (must have 'unique' constraint)
+            batch_size: maximum records to find per batch when filtering
+            concurrency: number of simultaneous api calls that will be made
+                (see :meth:`create`)
+            progress: :class:`.Progress` to report to (its total defaults
+                to the number of id values, if it is a list, or to the count
+                of the records matching the filter)
+
+        Yields:
+            tuples of (id value, result) in the same order as the id values,
+            or in id order when filtering (the id value is then the uuid);
+            the results are as in :meth:`update_many`
+
+        Raises:
+            InputError: if not exactly one of id_values and filtering is given
+            ApiAuthError: if the client may not delete records
+            ApiRateLimitError: if the api stays rate limited
+        """
+        if (id_values is None) == (filtering is None):
+            raise InputError("delete_many needs either id_values or filtering")
+        if filtering is not None:
+            id_attribute = 'uuid'
+            pages = self.iter_pages(['uuid'], batch_size, filtering, prefetch=1)
+            id_values = (record['uuid'] for page in pages for record in page.records)
+            if progress is not None and progress.total is None:
+                progress.total = self.count(filtering)
+
+        def delete(id_value):
+            self.get_record(id_value, id_attribute).delete()
+
+        results = self._record_calls(delete, id_values, concurrency, progress)
+        return self._track_items(results, id_values, progress)
+
+    def upsert_many(self, records, key_attribute='email', mode='smart', batch_size=None,
+                    concurrency=1, progress=None):
+        """Create the records that do not exist yet and update the ones that do.
+
+        The records are looked up by key a batch at a time, with the next
+        batch looked up while the current one is written. New records are
+        created in bulk (see :meth:`create`) and existing records are updated
+        one api call per record (see :meth:`update_many`). A record that
+        repeats the key of an earlier one is written after it, as an update
+        of the record it created or found.
+
+        Keys are matched exactly, as the api compares them: a key that
+        differs from an existing one only in case (e.g. an email address)
+        is taken for a new record, which then fails to be created with a
+        unique_violation if the schema ignores case. Normalize the keys
+        the way the schema stores them first.
+
+        Example:
+            for result in records.upsert_many(crm_records, concurrency=8):
+                ...
+
+        Args:
+            records: list or iterator of dicts of attribute keys and values
+            key_attribute: top-level attribute that identifies the records
+                (must have 'unique' constraint); records without it are created
+            mode: the mode to use when creating records (see :meth:`create`)
+            batch_size: maximum number of records to look up per api call
+                (default: 100)
+            concurrency: number of simultaneous api calls that will be made
+                (see :meth:`create`)
+            progress: :class:`.Progress` to report to (its total defaults
+                to the number of records, if records is a list)
+
+        Yields:
+            results for the records as dicts containing either:
+                the id and uuid (on success)
+                or error and error description (on failure)
+            and created, whether the record was new;
+            they will be returned in the same order the records were in
+        """
+        def lookups():
+            for group in self._key_groups(records, key_attribute, batch_size,
+                                          key=lambda record: record.get(key_attribute)):
+                keys = [record.get(key_attribute) for record in group]
+                yield group, self._find_keys(key_attribute, keys, ['id', 'uuid'])
+
+        def update(item):
+            uuid, record = item
+            self.get_record(uuid).update(record)
+
+        def write(part, existing):
+            """Write records with distinct keys.
+
+            Yields:
+                results in the same order as the records
+            """
+            new = [record for record in part if record.get(key_attribute) not in existing]
+            updates = [
+                (existing[record[key_attribute]]['uuid'], record)
+                for record in part if record.get(key_attribute) in existing
+            ]
+            # both run in the background while the results are merged
+            created = self._create(new, mode, None, concurrency, progress)
+            updated = self._record_calls(update, updates, concurrency, progress)
+            for record in part:
+                found = existing.get(record.get(key_attribute))
+                if found is None:
+                    yield dict(next(created), created=True)
+                    continue
+                result = next(updated)[1]
+                if result['stat'] == 'ok':
+                    result = {'id': found['id'], 'uuid': found['uuid']}
+                yield dict(result, created=False)
+
+        def upserts():
+            # the lookup of a group may run while the two groups before it
+            # are written, so it does not find the records they created
+            recent = collections.deque(maxlen=2)
+            for group, existing in read_ahead(lookups(), 1):
+                for created in recent:
+                    existing.update(created)
+                created = {}
+                results = [None] * len(group)
+                # a record that repeats a key is written after the one before it
+                for part in _repeat_parts(group, lambda record: record.get(key_attribute)):
+                    for i, result in zip(part, write([group[i] for i in part], existing)):
+                        key_value = group[i].get(key_attribute)
+                        if result['created'] and 'error' not in result and key_value is not None:
+                            created[key_value] = existing[key_value] = result
+                        results[i] = result
+                recent.append(created)
+                yield from results
+
+        return self._track_items(upserts(), records, progress)
+
+    def get_many(self, id_values, id_attribute='uuid', attributes=None, batch_size=None,
+                 concurrency=1, progress=None):
+        """Get multiple records by id value.
+
+        The id values are grouped into OR filters, one entity.find call per
+        group, and the groups are fetched concurrently.
+
+        Example:
+            for uuid, record in records.get_many(uuids, concurrency=4):
+                if record is None:
+                    ...
+
+        Args:
+            id_values: list or iterator of the id values of the records
+            id_attribute: top-level attribute that identifies the records
+                (must have 'unique' constraint)
+            attributes: list of attributes to return in each record
+                (default: all attributes)
+            batch_size: maximum number of records to get per api call
+                (default: 100)
+            concurrency: number of simultaneous api calls that will be made
+            progress: :class:`.Progress` to report to (its total defaults
+                to the number of id values, if it is a list); the records
+                that were not found are counted as errors
+
+        Yields:
+            tuples of (id value, record) in the same order as the id values,
+            the record being None if there is no record with the id value
+        """
+        remove_key = attributes is not None and id_attribute not in attributes
+
+        def get_group(group):
+            found = self._find_keys(id_attribute, group, attributes)
+            if progress is not None:
+                missing = sum(1 for value in group if value not in found)
+                progress.add(records=len(group), pages=1, errors=missing)
+            return group, found
+
+        def records():
+            for group, found in ordered_map(get_group, self._key_groups(
+                    id_values, id_attribute, batch_size), concurrency):
+                for value in group:
+                    record = found.get(value)
+                    if record is not None and remove_key:
+                        record = dict(record)
+                        record.pop(id_attribute, None)
+                    yield value, record
+
+        return self._track_items(records(), id_values, progress)
+
     def delete(self):
         """Delete all records in the schema."""
         kwargs = {
@@ -206,6 +762,7 @@ class SchemaRecords(object):
             sort_on: list of attributes to sort by; to sort in descending order,
                 prefix the attribute with a minus sign (-)
             batch_size: maximum results to return; cannot be higher than 10000
+                (an :class:`.AdaptiveBatchSize` may also be passed, see :meth:`iterator`)
             start_index: start batch at a number other than 1;
                 use this if all records cannot be returned in a single batch
             filtering: filter to apply when fetching records;
@@ -215,64 +772,225 @@ class SchemaRecords(object):
         Returns:
             list of records
         """
-        kwargs = {
-            'type_name': self.schema_name,
-        }
-        if attributes is not None:
-            kwargs['attributes'] = attributes
-        if sort_on is not None:
-            kwargs['sort_on'] = sort_on
-        if filtering is not None:
-            kwargs['filter'] = filtering
-        if batch_size is not None:
-            kwargs['max_results'] = batch_size
-        if start_index is not None:
-            kwargs['first_result'] = start_index
+        if isinstance(batch_size, AdaptiveBatchSize):
+            return self._adaptive_find(attributes, sort_on, batch_size, filtering,
+                                       start_index=start_index)
+        kwargs = _find_kwargs(self.schema_name, attributes, sort_on, batch_size, start_index, filtering)
         return self.app.apicall('entity.find', **kwargs)['results']
 
-    def iterator(self, attributes=None, batch_size=None, filtering=None):
+    def iterator(self, attributes=None, batch_size=None, filtering=None, prefetch=0,
+                 stream=False, progress=None):
         """Iterate over records in the schema.
         Does not allow arbitrary sorting; sorts by id in order to use it
         for paging for efficiency reasons.
 
         Args:
             attributes: list of attributes to include
-            batch_size: maximum results to return per batch
+            batch_size: maximum results to return per batch, or 'auto' to
+                adapt it to api response times and sizes (an
+                :class:`.AdaptiveBatchSize` may also be passed)
             filtering: filter to apply
+            prefetch: number of upcoming batches to keep loading in the
+                background while the current one is consumed
+                (default: fetch the next batch only when it is needed)
+            stream: decode each record as soon as it is received instead of
+                waiting for the whole batch, so that only one record at a time
+                is held in memory (requires a fixed batch_size and no prefetch)
+            progress: :class:`.Progress` to report to; records are counted
+                as they are yielded (its total defaults to the count of the
+                records, which is looked up when the first one is requested)
 
         Yields:
             the next record
-        """
-        remove_id = False  # whether to remove id from results
-        if attributes is not None and 'id' not in attributes:
-            # must add id to attributes in order to get the last one
-            attributes = attributes + ['id']
-            # but then remove it from the results because it wasn't asked for
-            remove_id = True
 
-        last_id = 0
-        if filtering is None:
-            filtering = 'id > {}'.format(last_id)
+        Raises:
+            InputError: if stream is combined with prefetch or an adaptive batch_size
+        """
+        attributes, remove_id = _id_attributes(attributes)
+        if stream:
+            if prefetch:
+                raise InputError("stream cannot be combined with prefetch")
+            if batch_size == 'auto' or isinstance(batch_size, AdaptiveBatchSize):
+                raise InputError("stream requires a fixed batch_size")
+            records = self._stream_records(attributes, batch_size, filtering, remove_id, progress)
         else:
-            filtering = '{} and id > {}'.format(filtering, last_id)
-        while True:
-            records = self.find(
-                attributes=attributes,
-                sort_on=['id'],
-                batch_size=batch_size,
-                filtering=filtering,
-            )
-            if records:
-                last_id = records[-1]['id']
-                filtering = re.sub(r'id > (\d+)', 'id > {}'.format(last_id), filtering)
-                for record in records:
-                    if remove_id:
-                        record.pop('id', None)
-                    yield record
+            records = self._page_records(
+                attributes, batch_size, filtering, prefetch, remove_id, progress)
+        return self._track(records, progress, lambda: self.count(filtering))
+
+    def iter_pages(self, attributes=None, batch_size=None, filtering=None, prefetch=0,
+                   progress=None, start_id=0, end_id=None):
+        """Iterate over the records in the schema a batch at a time.
+        Batches are fetched in id order as in :meth:`iterator`.
+
+        Args:
+            attributes: list of attributes to include (id is always included)
+            batch_size: maximum results to return per batch (see :meth:`iterator`)
+            filtering: filter to apply
+            prefetch: number of upcoming batches to keep loading in the
+                background (see :meth:`iterator`)
+            progress: :class:`.Progress` to count the pages in; the records
+                of a batch are counted when it is yielded
+            start_id: only include records with ids greater than this
+                (e.g. the last_id of the last batch of a previous run)
+            end_id: only include records with ids up to and including this
+
+        Yields:
+            :class:`RecordsPage` tuples of (records, first_id, last_id, elapsed)
+        """
+        attributes = _id_attributes(attributes)[0]
+        pages = self._id_range_pages(
+            attributes, batch_size, filtering, start_id, end_id, progress=progress)
+        if prefetch:
+            pages = read_ahead(pages, prefetch)
+        if progress is not None:
+            pages = self._counted_pages(pages, progress)
+        return pages
+
+    def resumable_iterator(self, checkpoint_path, attributes=None, batch_size=None,
+                           filtering=None, prefetch=0, checkpoint_every=1, on_checkpoint=None,
+                           progress=None):
+        """Iterate over records in the schema, saving progress to a
+        checkpoint file so that an interrupted iteration can be restarted
+        where it left off.
+
+        The checkpoint holds the id of the last record consumed, along with
+        the attributes and filter; a record counts as consumed once the next
+        one is requested. It is saved after every checkpoint_every batches
+        and whenever the iteration stops early (the iterator is closed or an
+        api call fails), so a restart neither repeats nor skips records. If
+        the process is killed outright, the restart repeats the records
+        consumed since the last save. Once the iteration is complete, the
+        checkpoint is marked as finished and restarting yields nothing;
+        delete the file to start over.
+
+        Args:
+            checkpoint_path: path of the checkpoint file; if it exists, the
+                iteration resumes from it
+            attributes: list of attributes to include
+            batch_size: maximum results to return per batch (see :meth:`iterator`)
+            filtering: filter to apply
+            prefetch: number of upcoming batches to keep loading in the
+                background (see :meth:`iterator`)
+            checkpoint_every: save the checkpoint after this many batches
+            on_checkpoint: function called with no arguments just before the
+                checkpoint is saved (e.g. to flush the output file); it may
+                return a dict of extra values to save in the checkpoint
+            progress: :class:`.Progress` to report to (see :meth:`iterator`);
+                when resuming, its total defaults to the count of the records
+                that remain
+
+        Yields:
+            the next record
+
+        Raises:
+            InputError: if the checkpoint is for a different iteration
+        """
+        records = self._resumable_records(
+            checkpoint_path, attributes, batch_size, filtering,
+            prefetch, checkpoint_every, on_checkpoint, progress)
+        return self._track(records, progress, lambda: self._remaining_count(
+            checkpoint_path, attributes, filtering))
+
+    def parallel_iterator(self, attributes=None, partitions=8, concurrency=4,
+                          batch_size=None, filtering=None, ordered=True):
+        """Iterate over records in the schema, fetching several id ranges
+        at the same time.
+
+        The lowest and highest ids are looked up once and the span between
+        them is split into disjoint ranges, each of which is paged through
+        by id on its own worker thread.
+
+        Args:
+            attributes: list of attributes to include
+            partitions: number of id ranges to split the schema into
+            concurrency: number of simultaneous api calls that will be made
+                (see :meth:`create` for apps with a concurrency controller)
+            batch_size: maximum results to return per batch, or 'auto' to
+                adapt it to api response times and sizes (an
+                :class:`.AdaptiveBatchSize` may also be passed)
+            filtering: filter to apply
+            ordered: if True, records are yielded in id order;
+                otherwise they are yielded in the order the pages arrive
+
+        Yields:
+            the next record
+        """
+        attributes, remove_id = _id_attributes(attributes)
+        if batch_size == 'auto':
+            # share what is learned between the ranges
+            batch_size = AdaptiveBatchSize()
+        span = self._id_span(filtering)
+        if span is None:
+            # no matching records
+            return
+        ranges = split_range(span[0] - 1, span[1], partitions)
+
+        stop = threading.Event()
+
+        def put(page_q, item):
+            """Put an item in the queue unless the consumer went away."""
+            while not stop.is_set():
+                try:
+                    page_q.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def fetch_range(page_q, start_id, end_id):
+            """Fetch the pages of an id range and put them in the queue,
+            followed by None when the range is exhausted.
+            """
+            if stop.is_set():
+                # the consumer went away before this range was started
+                return
+            try:
+                pages = self._id_range_pages(attributes, batch_size, filtering, start_id, end_id)
+                for page in pages:
+                    if not put(page_q, page.records):
+                        return
+            except Exception as err:
+                put(page_q, err)
+            put(page_q, None)
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        futures = []
+        try:
+            if ordered:
+                # one queue per range, drained in range order
+                sources = [(queue.Queue(maxsize=2), 1) for _ in ranges]
+                for (page_q, _), (start_id, end_id) in zip(sources, ranges):
+                    futures.append(executor.submit(fetch_range, page_q, start_id, end_id))
             else:
-                break
+                # all ranges share a queue
+                page_q = queue.Queue(maxsize=concurrency * 2)
+                sources = [(page_q, len(ranges))]
+                for start_id, end_id in ranges:
+                    futures.append(executor.submit(fetch_range, page_q, start_id, end_id))
 
-    def csv_iterator(self, attributes, batch_size=None, filtering=None, headers=True):
+            for page_q, remaining in sources:
+                while remaining:
+                    item = page_q.get()
+                    if item is None:
+                        remaining -= 1
+                    elif isinstance(item, Exception):
+                        raise item
+                    else:
+                        for record in item:
+                            if remove_id:
+                                record.pop('id', None)
+                            yield record
+        finally:
+            # drop the ranges not started yet, unblock the workers
+            # and wait for in-flight calls to finish
+            stop.set()
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def csv_iterator(self, attributes, batch_size=None, filtering=None, headers=True, prefetch=0,
+                     checkpoint_path=None, on_checkpoint=None, progress=None):
         """Iterate over records in the schema and format as CSV.
 
         Newlines within fields will be escaped as '\\n' to ensure that each
@@ -283,7 +1001,9 @@ class SchemaRecords(object):
 
         Args:
             attributes: list of attributes to include
-            batch_size: maximum results to return per batch
+            batch_size: maximum results to return per batch, or 'auto' to
+                adapt it to api response times and sizes (an
+                :class:`.AdaptiveBatchSize` may also be passed)
             filtering: filter to apply
             headers:
                 if falsey, don't include headers
@@ -291,10 +1011,20 @@ class SchemaRecords(object):
                 if a dict, then the headers will be looked up from it using the
                     attribute path - if lookup fails, fallback to using the
                     attribute path
+            prefetch: number of upcoming batches to keep loading in the
+                background (see :meth:`iterator`)
+            checkpoint_path: if specified, progress is saved to this file and
+                an interrupted iteration resumes from it without repeating
+                the headers (see :meth:`resumable_iterator`)
+            on_checkpoint: function called just before the checkpoint is saved
+            progress: :class:`.Progress` to report to (see :meth:`iterator`)
 
         Yields:
             a CSV row as a string
         """
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            # resuming, headers were already written
+            headers = False
         if headers:
             if headers is True:
                 headers = {}
@@ -307,16 +1037,228 @@ class SchemaRecords(object):
             yield to_csv(row)
 
         kwargs = {
-            'attributes': attributes
+            'attributes': attributes,
+            'prefetch': prefetch,
+            'progress': progress,
         }
         if batch_size is not None:
             kwargs['batch_size'] = batch_size
         if filtering is not None:
             kwargs['filtering'] = filtering
 
-        for record in self.iterator(**kwargs):
-            row = [dot_lookup(record, attr) for attr in attributes]
-            yield to_csv(row)
+        if checkpoint_path:
+            kwargs['on_checkpoint'] = on_checkpoint
+            records = self.resumable_iterator(checkpoint_path, **kwargs)
+        else:
+            records = self.iterator(**kwargs)
+        project = Projector(attributes)
+        for record in records:
+            yield to_csv(project(record))
+
+    def export_csv(self, fp, attributes, batch_size=None, filtering=None, headers=True,
+                   delimiter=None, prefetch=0, checkpoint_path=None, checkpoint_every=1):
+        """Write records in the schema to a file as CSV.
+
+        Produces the same output as :meth:`csv_iterator`, but a single CSV
+        writer is used for the whole export, attribute paths are split only
+        once and rows are written a batch at a time.
+
+        Args:
+            fp: file object to write to, opened in binary mode or in text
+                mode with newline='' (binary files are written as UTF-8)
+            attributes: list of attributes to include
+            batch_size: maximum results to return per batch (see :meth:`iterator`)
+            filtering: filter to apply
+            headers: headers to write (see :meth:`csv_iterator`)
+            delimiter: the delimiter to use (default: comma)
+            prefetch: number of upcoming batches to keep loading in the
+                background (see :meth:`iterator`)
+            checkpoint_path: if specified, progress and the file position are
+                saved to this file; an interrupted export resumes from it,
+                truncating any rows written after the last checkpoint
+                (fp must be seekable)
+            checkpoint_every: save the checkpoint after this many batches
+
+        Returns:
+            number of records written
+        """
+        if checkpoint_path:
+            try:
+                offset = load_json_file(checkpoint_path).get('offset')
+            except FileNotFoundError:
+                offset = None
+            if offset is not None:
+                # resuming, headers were already written
+                headers = False
+                fp.seek(offset)
+                fp.truncate()
+            pages = self._resumable_pages(
+                checkpoint_path, attributes, batch_size, filtering,
+                prefetch, checkpoint_every, on_checkpoint=lambda: {'offset': fp.tell()})
+        else:
+            pages = self.iter_pages(attributes, batch_size, filtering, prefetch)
+
+        return self._write_csv(fp, attributes, pages, headers, delimiter, flush=bool(checkpoint_path))
+
+    def export_csv_shards(self, path_template, attributes, shards=8, processes=None,
+                          batch_size=None, filtering=None, headers=True, delimiter=None,
+                          merge_path=None):
+        """Write records in the schema to several CSV files at once, using a
+        pool of processes.
+
+        The id span is split into ranges as in :meth:`parallel_iterator`,
+        and each range is exported to its own file by a separate process
+        with its own :class:`.App`, so that JSON decoding and CSV formatting
+        are spread over all cores.
+
+        Args:
+            path_template: path of the shard files, formatted with the shard
+                number (e.g. 'export-{}.csv')
+            attributes: list of attributes to include
+            shards: number of id ranges (and files) to split the export into
+            processes: number of worker processes (default: number of cores)
+            batch_size: maximum results to return per batch (see :meth:`iterator`)
+            filtering: filter to apply
+            headers: headers to write at the top of each file
+                (see :meth:`csv_iterator`)
+            delimiter: the delimiter to use (default: comma)
+            merge_path: if specified, the shard files are concatenated in id
+                order into this file (keeping only the first header row) and
+                then deleted
+
+        Returns:
+            number of records written
+        """
+        span = self._id_span(filtering)
+        if span is None:
+            ranges = [(0, 0)]
+        else:
+            ranges = split_range(span[0] - 1, span[1], shards)
+        paths = [path_template.format(shard) for shard in range(1, len(ranges) + 1)]
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [
+                executor.submit(
+                    _export_csv_shard, self.app.api, self.schema_name, path, attributes,
+                    batch_size, filtering, start_id, end_id, headers, delimiter)
+                for path, (start_id, end_id) in zip(paths, ranges)
+            ]
+            count = sum(future.result() for future in futures)
+
+        if merge_path:
+            with open(merge_path, 'wb') as merged:
+                for shard, path in enumerate(paths):
+                    with open(path, 'rb') as fp:
+                        if headers and shard:
+                            # only the first file keeps its header row
+                            fp.readline()
+                        shutil.copyfileobj(fp, merged)
+            for path in paths:
+                os.remove(path)
+
+        return count
+
+    def jsonl_iterator(self, attributes=None, batch_size=None, filtering=None, prefetch=0):
+        """Iterate over records in the schema and format as JSON Lines.
+
+        Unlike :meth:`csv_iterator`, objects and plurals are kept as nested
+        JSON, so every record is exported in full.
+
+        Args:
+            attributes: list of attributes to include (default: all attributes)
+            batch_size: maximum results to return per batch (see :meth:`iterator`)
+            filtering: filter to apply
+            prefetch: number of upcoming batches to keep loading in the
+                background (see :meth:`iterator`)
+
+        Yields:
+            a compact JSON record as a string ending in a newline
+        """
+        for record in self.iterator(attributes, batch_size, filtering, prefetch):
+            yield to_json_line(record)
+
+    def export_jsonl(self, fp, attributes=None, batch_size=None, filtering=None,
+                     prefetch=0, compress=False):
+        """Write records in the schema to a file as JSON Lines.
+
+        Records are encoded and written a batch at a time, so memory use
+        does not grow with the size of the schema.
+
+        Args:
+            fp: file object to write to, opened in binary mode or in text
+                mode (binary files are written as UTF-8)
+            attributes: list of attributes to include (default: all attributes)
+            batch_size: maximum results to return per batch (see :meth:`iterator`)
+            filtering: filter to apply
+            prefetch: number of upcoming batches to keep loading in the
+                background (see :meth:`iterator`)
+            compress: whether to gzip the output (fp must be binary)
+
+        Returns:
+            number of records written
+        """
+        binary = isinstance(fp, (io.RawIOBase, io.BufferedIOBase)) or 'b' in str(getattr(fp, 'mode', ''))
+        if compress and not binary:
+            raise InputError("compressed output requires a binary file")
+        out = fp
+        if compress:
+            out = gzip.GzipFile(fileobj=fp, mode='wb')
+
+        remove_id = _id_attributes(attributes)[1]
+        count = 0
+        try:
+            for page in self.iter_pages(attributes, batch_size, filtering, prefetch):
+                records = page.records
+                if remove_id:
+                    for record in records:
+                        record.pop('id', None)
+                chunk = ''.join([to_json_line(record) for record in records])
+                out.write(chunk.encode('utf-8') if binary else chunk)
+                count += len(records)
+        finally:
+            if compress:
+                # writes the gzip trailer; the caller's file stays open
+                out.close()
+        return count
+
+    def delta(self, watermark=None, attributes=None, batch_size=None, filtering=None):
+        """Get the records that changed since a previous run.
+
+        Example:
+            delta = records.delta(saved_watermark)
+            for record in delta:
+                ...
+            saved_watermark = delta.watermark
+
+        Args:
+            watermark: watermark saved from a previous run, or a lastUpdated
+                timestamp string (default: all records)
+            attributes: list of attributes to include (default: all attributes)
+            batch_size: maximum results to return per batch (see :meth:`iterator`)
+            filtering: additional filter to apply
+
+        Returns:
+            RecordsDelta object
+        """
+        return RecordsDelta(self, watermark, attributes, batch_size, filtering)
+
+    def mirror(self, path, indexes=None, attributes=None):
+        """Get a local SQLite copy of the records.
+
+        Example:
+            mirror = records.mirror('user.sqlite', indexes=['email'])
+            mirror.sync()
+            found = mirror.find("{email} = ?", [email])
+
+        Args:
+            path: path to the SQLite database (created if missing)
+            indexes: list of attributes to index
+            attributes: list of attributes to copy (default: all attributes)
+
+        Returns:
+            SchemaMirror object
+        """
+        return SchemaMirror(self, path, indexes, attributes)
 
     def get_record(self, id_value, id_attribute='uuid'):
         """Get a :class:`.SchemaRecord` object.
@@ -330,3 +1272,643 @@ class SchemaRecords(object):
             SchemaRecord object
         """
         return SchemaRecord(self.app, self.schema_name, id_value, id_attribute)
+
+    def _write_csv(self, fp, attributes, pages, headers=True, delimiter=None, flush=False):
+        """Write pages of records to a file as CSV (see :meth:`export_csv`).
+
+        Args:
+            fp: text or binary file object
+            attributes: list of attributes to include
+            pages: iterable of :class:`RecordsPage`
+            headers: headers to write
+            delimiter: the delimiter to use (default: comma)
+            flush: whether to flush the file after every page
+
+        Returns:
+            number of records written
+        """
+        binary = isinstance(fp, (io.RawIOBase, io.BufferedIOBase)) or 'b' in str(getattr(fp, 'mode', ''))
+        out = fp
+        if binary:
+            out = io.TextIOWrapper(fp, encoding='utf-8', newline='')
+
+        writer_kwargs = {}
+        if delimiter:
+            writer_kwargs['delimiter'] = delimiter
+        writer = csv.writer(out, **writer_kwargs)
+
+        if headers:
+            if headers is True:
+                headers = {}
+            writer.writerow([headers.get(attr, attr) for attr in attributes])
+
+        project = Projector(attributes)
+
+        count = 0
+        try:
+            for page in pages:
+                writer.writerows([[csv_field(value) for value in project(record)] for record in page.records])
+                count += len(page.records)
+                if flush:
+                    out.flush()
+        finally:
+            out.flush()
+            if binary:
+                # leave the caller's file open
+                out.detach()
+        return count
+
+    def _key_groups(self, items, key_attribute, batch_size=None, key=None):
+        """Group items so that a filter matching their keys stays within
+        the filter length limit.
+
+        Args:
+            items: iterable of key values, or of items to get them from
+            key_attribute: attribute the keys are values of
+            batch_size: maximum number of items per group (default: 100)
+            key: function that gets the key value of an item
+
+        Yields:
+            lists of items
+        """
+        batch_size = batch_size or _KEYS_PER_FIND
+        group = []
+        length = 0
+        for item in items:
+            value = item if key is None else key(item)
+            term = len(self._key_filter(key_attribute, [value])) + len(' or ')
+            if group and (len(group) >= batch_size or length + term > _FILTER_CHARS):
+                yield group
+                group = []
+                length = 0
+            group.append(item)
+            length += term
+        if group:
+            yield group
+
+    def _key_filter(self, key_attribute, values):
+        """Filter matching the records with any of the key values."""
+        terms = ['{} = {}'.format(key_attribute, filter_value(value)) for value in values]
+        return ' or '.join(terms)
+
+    def _find_keys(self, key_attribute, values, attributes=None):
+        """Find the records with any of the key values in one api call.
+
+        Args:
+            key_attribute: top-level attribute with 'unique' constraint
+            values: key values (None is never found)
+            attributes: list of attributes to return (default: all attributes)
+
+        Returns:
+            dict that maps the key values that were found to their records
+        """
+        values = list(collections.OrderedDict.fromkeys(v for v in values if v is not None))
+        if not values:
+            return {}
+        if attributes is not None and key_attribute not in attributes:
+            attributes = attributes + [key_attribute]
+        records = self.find(attributes, batch_size=len(values),
+                            filtering=self._key_filter(key_attribute, values))
+        return {record[key_attribute]: record for record in records}
+
+    def _record_calls(self, call, items, concurrency, progress=None):
+        """Make an api call for each item on a pool of worker threads.
+        Errors for individual records become error results; auth and
+        rate limit errors are raised.
+
+        Yields:
+            tuples of (item, result) in the same order as the items
+        """
+        def record_call(item):
+            try:
+                call(item)
+            except (ApiAuthError, ApiRateLimitError):
+                raise
+            except ApiError as err:
+                result = _error_result(err)
+            else:
+                result = {'stat': 'ok'}
+            if progress is not None:
+                progress.add(records=1, pages=1, errors=int(result['stat'] == 'error'))
+            return item, result
+
+        return ordered_map(record_call, items, concurrency)
+
+    def _track_items(self, results, items, progress):
+        """Report the progress of a bulk operation, its total being the
+        number of items if they are a list.
+        """
+        if progress is None:
+            return results
+        if progress.total is None and hasattr(items, '__len__'):
+            progress.total = len(items)
+        return progress.track(results)
+
+    def _resumable_pages(self, checkpoint_path, attributes, batch_size, filtering,
+                         prefetch=0, checkpoint_every=1, on_checkpoint=None, progress=None):
+        """Page through the records in the schema, saving a checkpoint
+        after batches have been consumed (see :meth:`resumable_iterator`).
+
+        Yields:
+            :class:`RecordsPage` tuples
+        """
+        state = self._load_checkpoint(checkpoint_path, attributes, filtering)
+        if state['finished']:
+            return
+
+        def save():
+            if on_checkpoint:
+                state.update(on_checkpoint() or {})
+            save_json_file(checkpoint_path, state)
+
+        attributes = _id_attributes(attributes)[0]
+        pages = self._id_range_pages(
+            attributes, batch_size, filtering, start_id=state['last_id'], progress=progress)
+        if prefetch:
+            pages = read_ahead(pages, prefetch)
+        unsaved = 0
+        for page in pages:
+            yield page
+            # every record of the batch has been consumed
+            state['last_id'] = page.last_id
+            unsaved += 1
+            if unsaved >= checkpoint_every:
+                save()
+                unsaved = 0
+        state['finished'] = True
+        save()
+
+    def _resumable_records(self, checkpoint_path, attributes, batch_size, filtering,
+                           prefetch=0, checkpoint_every=1, on_checkpoint=None, progress=None):
+        """Iterate over the records in the schema, saving the id of the
+        last record consumed (see :meth:`resumable_iterator`).
+
+        Yields:
+            the next record
+        """
+        state = self._load_checkpoint(checkpoint_path, attributes, filtering)
+        if state['finished']:
+            return
+
+        def save(last_id):
+            state['last_id'] = last_id
+            if on_checkpoint:
+                state.update(on_checkpoint() or {})
+            save_json_file(checkpoint_path, state)
+
+        if not os.path.exists(checkpoint_path):
+            # anything yielded before the first record (e.g. headers) is done
+            save(state['last_id'])
+        id_attributes, remove_id = _id_attributes(attributes)
+        pages = self._id_range_pages(
+            id_attributes, batch_size, filtering, start_id=state['last_id'], progress=progress)
+        if prefetch:
+            pages = read_ahead(pages, prefetch)
+        consumed = state['last_id']
+        unsaved = 0
+        try:
+            for page in pages:
+                for record in page.records:
+                    record_id = record['id']
+                    if remove_id:
+                        record.pop('id', None)
+                    yield record
+                    # the next record was requested
+                    consumed = record_id
+                unsaved += 1
+                if unsaved >= checkpoint_every:
+                    save(consumed)
+                    unsaved = 0
+        except BaseException:
+            # stopped part way, including by the iterator being closed
+            if consumed != state['last_id']:
+                save(consumed)
+            raise
+        state['finished'] = True
+        save(consumed)
+
+    def _load_checkpoint(self, checkpoint_path, attributes, filtering):
+        """Load the state of a resumable iteration.
+
+        Returns:
+            state dict, new if the checkpoint file does not exist
+
+        Raises:
+            InputError: if the checkpoint is for a different iteration
+        """
+        state = {
+            'schema_name': self.schema_name,
+            'attributes': attributes,
+            'filtering': filtering,
+            'last_id': 0,
+            'finished': False,
+        }
+        try:
+            saved = load_json_file(checkpoint_path)
+        except FileNotFoundError:
+            return state
+        for key in ('schema_name', 'attributes', 'filtering'):
+            if saved.get(key) != state[key]:
+                raise InputError("checkpoint {} does not match: {}".format(checkpoint_path, key))
+        return saved
+
+    def _page_records(self, attributes, batch_size, filtering, prefetch, remove_id, progress=None):
+        """Records of the pages of :meth:`iter_pages`, one at a time."""
+        pages = self._id_range_pages(attributes, batch_size, filtering, progress=progress)
+        if prefetch:
+            pages = read_ahead(pages, prefetch)
+        return self._records_of(pages, remove_id)
+
+    def _records_of(self, pages, remove_id):
+        """Records of pages, one at a time."""
+        for page in pages:
+            if remove_id:
+                for record in page.records:
+                    record.pop('id', None)
+            yield from page.records
+
+    def _stream_records(self, attributes, batch_size, filtering, remove_id, progress=None):
+        """Page through the records in id order, decoding the records
+        of each page as they are received.
+
+        Yields:
+            the next record
+        """
+        last_id = 0
+        while True:
+            kwargs = _find_kwargs(
+                self.schema_name, attributes, ['id'], batch_size, None, _id_filter(filtering, last_id))
+            found = 0
+            for record in self.app.apicall_stream('entity.find', progress=progress, **kwargs):
+                found += 1
+                last_id = record['id']
+                if remove_id:
+                    record.pop('id', None)
+                yield record
+            if progress is not None:
+                progress.add(pages=1)
+            if not found:
+                break
+
+    def _track(self, records, progress, count):
+        """Report the progress of iterating over records.
+
+        Args:
+            records: iterator of records
+            progress: :class:`.Progress` or None
+            count: function returning the total, called when the first
+                record is requested if the total is not known
+        """
+        if progress is None:
+            return records
+        return progress.track(self._counted(records, progress, count))
+
+    def _counted(self, records, progress, count):
+        """Count records as they are consumed."""
+        if progress.total is None:
+            progress.total = count()
+        for record in records:
+            progress.add(records=1)
+            yield record
+
+    def _counted_pages(self, pages, progress):
+        """Count the records of pages as they are consumed."""
+        for page in pages:
+            progress.add(records=len(page.records))
+            yield page
+
+    def _remaining_count(self, checkpoint_path, attributes, filtering):
+        """Count the records that a resumable iteration has yet to yield."""
+        state = self._load_checkpoint(checkpoint_path, attributes, filtering)
+        if state['finished']:
+            return 0
+        if state['last_id']:
+            filtering = _id_filter(filtering, state['last_id'])
+        return self.count(filtering)
+
+    def _id_span(self, filtering=None):
+        """Lowest and highest ids of the records matching the filter.
+
+        Returns:
+            tuple of (lowest id, highest id) or None if there are no records
+        """
+        kwargs = {
+            'attributes': ['id'],
+            'batch_size': 1,
+            'filtering': filtering,
+        }
+        first = self.find(sort_on=['id'], **kwargs)
+        if not first:
+            return None
+        last = self.find(sort_on=['-id'], **kwargs)
+        return first[0]['id'], last[0]['id']
+
+    def _id_range_pages(self, attributes, batch_size, filtering, start_id=0, end_id=None,
+                        progress=None):
+        """Page through the records with ids in the range (start_id, end_id].
+
+        Yields:
+            :class:`RecordsPage` tuples with the records sorted by id
+        """
+        if batch_size == 'auto':
+            batch_size = AdaptiveBatchSize()
+        last_id = start_id
+        while True:
+            id_filtering = _id_filter(filtering, last_id, end_id)
+            start = time.time()
+            records = self._find_page(attributes, ['id'], batch_size, id_filtering, progress)
+            elapsed = time.time() - start
+            if progress is not None:
+                # the records are counted as they are consumed
+                progress.add(pages=1, num_bytes=_estimate_bytes(records))
+            if not records:
+                break
+            last_id = records[-1]['id']
+            yield RecordsPage(records, records[0]['id'], last_id, elapsed)
+            if end_id is not None and last_id >= end_id:
+                # the end of the range was reached, nothing more to find
+                break
+
+    def _find_page(self, attributes, sort_on, batch_size, filtering, progress=None):
+        """Get a batch of records with a fixed or adaptive batch size.
+
+        Returns:
+            list of records
+        """
+        if isinstance(batch_size, AdaptiveBatchSize):
+            return self._adaptive_find(attributes, sort_on, batch_size, filtering, progress)
+        kwargs = _find_kwargs(self.schema_name, attributes, sort_on, batch_size, None, filtering)
+        return self.app._apicall('entity.find', kwargs, progress=progress)['results']
+
+    def _adaptive_find(self, attributes, sort_on, batch_size, filtering, progress=None,
+                       start_index=None):
+        """Get a batch of records, sized by an :class:`.AdaptiveBatchSize`.
+        A batch that times out or is too large is retried at a smaller size
+        instead of with a longer timeout.
+
+        Returns:
+            list of records
+        """
+        while True:
+            size = batch_size.size
+            kwargs = _find_kwargs(self.schema_name, attributes, sort_on, size, start_index, filtering)
+            start = time.time()
+            try:
+                r = self.app._apicall('entity.find', kwargs, retries_max=0)
+            except ApiError as err:
+                too_large = isinstance(err, ApiTooLargeError) or err.code == 504
+                if too_large and batch_size.shrink(size):
+                    self.app.logger.debug("batch of %s records failed, shrinking", size)
+                    if progress is not None:
+                        progress.add(retries=1)
+                    continue
+                raise
+            elapsed = time.time() - start
+            records = r['results']
+            batch_size.update(size, len(records), elapsed, _estimate_bytes(records))
+            return records
+
+def _error_result(err):
+    """The result for a record that failed, in the same form as the
+    errors in the results of entity.bulkCreate.
+    """
+    result = {
+        'code': err.code,
+        'error_description': err.message,
+        'stat': 'error',
+    }
+    if err.error is not None:
+        result['error'] = err.error
+    return result
+
+def _too_large_result(err):
+    """The result for a record that is too large to be created on its own."""
+    result = _error_result(err)
+    # results of entity.bulkCreate are told apart by their error name
+    result.setdefault('error', 'request_too_large')
+    return result
+
+def _commit_mode(mode):
+    """Convert a create mode to the commit_each value for entity.bulkCreate.
+    'smart' batches are first tried as a whole.
+    """
+    if mode == 'each':
+        return True
+    elif mode in ('all', 'smart'):
+        return False
+    return mode
+
+def _is_record_error(err):
+    """Whether a failed bulkCreate may be caused by the records in it,
+    rather than by the request as a whole.
+    """
+    if err.code in (502, 504):
+        # the gateway gave up
+        return False
+    return not isinstance(err, (ApiAuthError, ApiRateLimitError, ApiTooLargeError))
+
+def _smart_parts(batch, start_record_num):
+    """Split a failed 'smart' batch into the parts to retry.
+
+    Returns:
+        list of (start_record_num, batch, commit_each) tuples
+    """
+    if len(batch) <= _SMART_EACH_SIZE:
+        # few enough to find the failures with a single call
+        return [(start_record_num, batch, True)]
+    return _halves(batch, start_record_num, False)
+
+def _halves(batch, start_record_num, commit_each):
+    """Split a batch in two.
+
+    Returns:
+        list of (start_record_num, batch, commit_each) tuples
+    """
+    half = len(batch) // 2
+    return [
+        (start_record_num, batch[:half], commit_each),
+        (start_record_num + half, batch[half:], commit_each),
+    ]
+
+def _record_batches(records, batch_size=None, batch_bytes=None):
+    """Split records into batches for entity.bulkCreate.
+    Each record is serialized once, the batches hold the JSON.
+
+    Args:
+        records: list or iterator of records
+        batch_size: maximum number of records per batch (default: 2000)
+        batch_bytes: maximum size of a batch as a JSON array (default: 1MB,
+            a record larger than this is put in a batch of its own),
+            or a function returning it, called for each record
+
+    Yields:
+        tuples of (number of the first record in the batch,
+            list of records as JSON byte strings)
+    """
+    if not batch_size:
+        batch_size = _BATCH_RECORDS
+    if not batch_bytes:
+        batch_bytes = _BATCH_BYTES
+    if callable(batch_bytes):
+        max_bytes = batch_bytes
+    else:
+        max_bytes = lambda: batch_bytes
+    batch = []
+    # size of the batch as a JSON array: brackets and commas
+    size = 1
+    # keep track of the record_num at the beginning of each batch so
+    # that information is available when the results are retrieved
+    start_record_num = None
+    for record_num, record in enumerate(records, start=1):
+        data = to_json_bytes(record)
+        if batch and size + len(data) + 1 > max_bytes():
+            yield start_record_num, batch
+            # start a new batch
+            batch = []
+            size = 1
+        if not batch:
+            start_record_num = record_num
+        batch.append(data)
+        size += len(data) + 1
+        if len(batch) >= batch_size:
+            yield start_record_num, batch
+            batch = []
+            size = 1
+    # leftover records
+    if batch:
+        yield start_record_num, batch
+
+def _bulk_create_results(r, start_record_num):
+    """Pair the results of an entity.bulkCreate call with record numbers.
+
+    Returns:
+        list of tuples consisting of (record_num, result)
+    """
+    batch_results = []
+    for i, cid, uuid in zip(itertools.count(start=start_record_num), r['results'], r['uuid_results']):
+        if isinstance(uuid, dict):
+            result = (i, uuid)
+        else:
+            result = (i, {'id': cid, 'uuid': uuid})
+        batch_results.append(result)
+    return batch_results
+
+def _id_attributes(attributes):
+    """Make sure id is requested since it is needed for paging.
+
+    Returns:
+        tuple of (attributes, whether id must be removed from results)
+    """
+    if attributes is not None and 'id' not in attributes:
+        # must add id to attributes in order to get the last one
+        # but then remove it from the results because it wasn't asked for
+        return attributes + ['id'], True
+    return attributes, False
+
+def _id_filter(filtering, start_id, end_id=None):
+    """Combine a filter with an id range (start_id, end_id]."""
+    id_filter = 'id > {}'.format(start_id)
+    if end_id is not None:
+        id_filter = '{} and id <= {}'.format(id_filter, end_id)
+    if filtering is None:
+        return id_filter
+    return '{} and {}'.format(filtering, id_filter)
+
+def _find_kwargs(schema_name, attributes, sort_on, batch_size, start_index, filtering):
+    """Keyword args for an entity.find call."""
+    kwargs = {
+        'type_name': schema_name,
+    }
+    if attributes is not None:
+        kwargs['attributes'] = attributes
+    if sort_on is not None:
+        kwargs['sort_on'] = sort_on
+    if filtering is not None:
+        kwargs['filter'] = filtering
+    if batch_size is not None:
+        kwargs['max_results'] = batch_size
+    if start_index is not None:
+        kwargs['first_result'] = start_index
+    return kwargs
+
+def _estimate_bytes(records):
+    """Estimate the size of a batch of records as JSON from the first
+    and last records, to avoid serializing the whole batch.
+    """
+    if not records:
+        return 0
+    sample = len(json.dumps(records[0])) + len(json.dumps(records[-1]))
+    return sample * len(records) // 2
+
+def _unique_violation():
+    """Result for a record that was found to be a duplicate locally,
+    the same as the api's.
+    """
+    return {
+        'code': 361,
+        'error': 'unique_violation',
+        'error_description': 'Attempted to update a duplicate value',
+        'stat': 'error',
+    }
+
+def _unique_attributes(attr_defs, prefix=''):
+    """Dot-paths of the attributes with a 'unique' constraint, including
+    those of objects but not of plurals (unique within each element).
+
+    Returns:
+        list of attribute dot-paths
+    """
+    paths = []
+    for attr in attr_defs:
+        path = prefix + attr['name']
+        if 'unique' in (attr.get('constraints') or []):
+            paths.append(path)
+        if attr.get('type') == 'object':
+            paths.extend(_unique_attributes(attr.get('attr_defs', []), path + '.'))
+    return paths
+
+def _repeat_parts(items, key):
+    """Split items into parts in which no key repeats, the first item
+    with each key in the first part, the second in the second, and so on.
+    Items without a key (None) are all in the first part.
+
+    Returns:
+        list of lists of the indexes of the items, in order
+    """
+    seen = collections.Counter()
+    parts = [[]]
+    for i, item in enumerate(items):
+        value = key(item)
+        n = 0
+        if value is not None:
+            n = seen[value]
+            seen[value] += 1
+        if n == len(parts):
+            parts.append([])
+        parts[n].append(i)
+    return parts
+
+def _capture_records(rows, build):
+    """Convert CSV rows to records with a :class:`.RecordBuilder`.
+    May run in a worker process of :meth:`SchemaRecords.import_csv`.
+
+    Returns:
+        list of records
+    """
+    return [build(row) for row in rows]
+
+def _export_csv_shard(api, schema_name, path, attributes, batch_size, filtering,
+                      start_id, end_id, headers, delimiter):
+    """Export the id range (start_id, end_id] to a CSV file.
+    Runs in a worker process of :meth:`SchemaRecords.export_csv_shards`.
+
+    Returns:
+        number of records written
+    """
+    # imported here to avoid a circular import
+    from janrain_datalib.app import App
+    records = SchemaRecords(App(api), schema_name)
+    pages = records.iter_pages(
+        attributes, batch_size, filtering, start_id=start_id, end_id=end_id)
+    with open(path, 'wb') as fp:
+        return records._write_csv(fp, attributes, pages, headers, delimiter)
@@ -1,7 +1,22 @@
 """Stand-alone utility functions and classes."""
+import codecs
+import collections
+import concurrent.futures
 import csv
+import hashlib
 import io
 import json
+import os
+import queue
+import re
+import threading
+
+# encoders are reused since json.dumps builds a new one for every call
+# that is not using the default options
+_JSON_ENCODERS = {
+    True: json.JSONEncoder(ensure_ascii=False, sort_keys=True, separators=(',', ':')),
+    False: json.JSONEncoder(ensure_ascii=False, sort_keys=True, indent=4, separators=(',', ': ')),
+}
 
 def to_json(item, compact=False):
     """Convert item to JSON string.
@@ -17,16 +32,56 @@ def to_json(item, compact=False):
     Returns:
         JSON string
     """
-    kwargs = {
-        'ensure_ascii': False,
-        'sort_keys': True,
-    }
-    if compact:
-        kwargs['separators'] = (',', ':')
-    else:
-        kwargs['indent'] = 4
-        kwargs['separators'] = (',', ': ')
-    return json.dumps(item, **kwargs)
+    return _JSON_ENCODERS[bool(compact)].encode(item)
+
+_JSON_LINE_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+def to_json_line(item):
+    """Convert item to a compact, single-line JSON string ending in a newline.
+    Keys are kept in their original order.
+
+    Example:
+    >>> to_json_line({'b': [1, 2], 'a': 'x'})
+    '{"b":[1,2],"a":"x"}\\n'
+
+    Args:
+        item: thing to convert to JSON string
+
+    Returns:
+        JSON Lines record string
+    """
+    return _JSON_LINE_ENCODER.encode(item) + '\n'
+
+def to_json_bytes(item):
+    """Convert item to compact UTF-8 encoded JSON.
+    Keys are kept in their original order.
+
+    Example:
+    >>> to_json_bytes({'b': [1, 2], 'a': 'x'})
+    b'{"b":[1,2],"a":"x"}'
+
+    Args:
+        item: thing to convert to JSON
+
+    Returns:
+        JSON byte string
+    """
+    return _JSON_LINE_ENCODER.encode(item).encode('utf-8')
+
+def json_array_bytes(items):
+    """Join items that are already JSON byte strings into a JSON array.
+
+    Example:
+    >>> json_array_bytes([b'{"a":1}', b'2'])
+    b'[{"a":1},2]'
+
+    Args:
+        items: list of JSON byte strings
+
+    Returns:
+        JSON byte string
+    """
+    return b'[' + b','.join(items) + b']'
 
 def to_csv(row, delimiter=None):
     """Convert a list of items to a CSV string.
@@ -42,18 +97,7 @@ def to_csv(row, delimiter=None):
     Returns:
         CSV record string
     """
-    new_row = []
-    for item in row:
-        if item is None:
-            # None/null should just be an empty string
-            item = ''
-        elif isinstance(item, str):
-            # escape newlines
-            item = item.replace('\n', '\\n')
-        else:
-            # convert to JSON string
-            item = to_json(item, compact=True)
-        new_row.append(item)
+    new_row = [csv_field(item) for item in row]
     output = io.StringIO()
 
     # if the delimiter is set use it
@@ -66,6 +110,55 @@ def to_csv(row, delimiter=None):
     writer.writerow(new_row)
     return output.getvalue()
 
+def csv_field(item):
+    """Format a value as a CSV field.
+
+    Example:
+    >>> csv_field({'a': 1})
+    '{"a":1}'
+
+    Args:
+        item: value to format; None becomes an empty string, newlines in
+            strings are escaped and anything else is converted to JSON
+
+    Returns:
+        string
+    """
+    if item is None:
+        # None/null should just be an empty string
+        return ''
+    elif isinstance(item, str):
+        # escape newlines
+        return item.replace('\n', '\\n')
+    else:
+        # convert to JSON string
+        return to_json(item, compact=True)
+
+def filter_value(value):
+    """Format a value for use in an entity filter.
+
+    Example:
+    >>> filter_value("O'Brien")
+    "'O\\\\'Brien'"
+
+    Args:
+        value: string, number, boolean or None
+
+    Returns:
+        the value as it should appear in a filter; strings are enclosed in
+        single quotes with quotes and backslashes escaped
+    """
+    if value is None:
+        return 'null'
+    elif value is True:
+        return 'true'
+    elif value is False:
+        return 'false'
+    elif isinstance(value, (int, float)):
+        return str(value)
+    value = str(value).replace('\\', '\\\\').replace("'", "\\'")
+    return "'{}'".format(value)
+
 def dot_lookup(obj, path):
     """Lookup a value from a multi-level dict given a dot-separated path string.
 
@@ -84,6 +177,65 @@ def dot_lookup(obj, path):
         obj = obj[key]
     return obj
 
+class Projector(object):
+    """Reads a fixed list of dot-separated attribute paths from records.
+
+    The paths are split once when the projector is built rather than for
+    every record, and a path that is missing from a record (including
+    one that passes through a missing or null object) gives a default value
+    instead of raising an error.
+
+    Example:
+    >>> project = Projector(['a.b', 'c', 'd.e'])
+    >>> project({'a': {'b': 1}, 'c': 2, 'd': None})
+    [1, 2, None]
+    """
+
+    def __init__(self, attributes, default=None):
+        """Initialize.
+
+        Args:
+            attributes: list of dot-separated attribute paths
+            default: value for paths that are missing from a record
+        """
+        self._attributes = list(attributes)
+        self._default = default
+        self._getters = [self._getter(tuple(attr.split('.'))) for attr in self._attributes]
+
+    @property
+    def attributes(self):
+        """List of attribute paths."""
+        return list(self._attributes)
+
+    def __call__(self, record):
+        """Read the attribute values from a record.
+
+        Args:
+            record: multi-level dict
+
+        Returns:
+            list of values in the same order as the attributes
+        """
+        return [get(record) for get in self._getters]
+
+    def _getter(self, keys):
+        """Build a function that reads the value at a path of keys."""
+        default = self._default
+        if len(keys) == 1:
+            key = keys[0]
+
+            def get(record):
+                return record.get(key, default)
+        else:
+            def get(record):
+                try:
+                    for key in keys:
+                        record = record[key]
+                except (KeyError, TypeError):
+                    return default
+                return record
+        return get
+
 def dot_assign(obj, path, value):
     """Assign a value to a multi-level dict.
 
@@ -112,6 +264,160 @@ def dot_assign(obj, path, value):
             obj[key] = value
     return obj
 
+class RecordBuilder(object):
+    """Converts flat records to multi-level dicts like :func:`to_capture_record`,
+    with the key_map and transform_map compiled once.
+
+    Each key's dot-path is split when the builder is built (or the first
+    time an unmapped key is seen) rather than for every value, and values
+    are assigned without recursion. A builder can be passed as the key_map
+    of :func:`to_capture_record` and of the methods that take one.
+
+    Example:
+    >>> build = RecordBuilder({'balance': 'wallet.balance'}, {'balance': float})
+    >>> build({'balance': '12.3'})
+    {'wallet': {'balance': 12.3}}
+    """
+
+    def __init__(self, key_map=None, transform_map=None):
+        """Initialize.
+
+        Args:
+            key_map: map of key in flat record to capture dot-path
+            transform_map: map for key in flat record to a transform function
+                (see :func:`to_capture_record`)
+        """
+        key_map = key_map or {}
+        transform_map = transform_map or {}
+        self._steps = {}
+        for key in list(key_map) + list(transform_map):
+            path = key_map.get(key, key)
+            self._steps[key] = (tuple(path.split('.')), transform_map.get(key))
+
+    def __call__(self, record):
+        """Convert a record.
+
+        Args:
+            record: single-level dict
+
+        Returns:
+            multi-level dict
+        """
+        steps = self._steps
+        obj = {}
+        for key, value in record.items():
+            step = steps.get(key)
+            if step is None:
+                # unmapped keys are their own path
+                step = steps[key] = (tuple(key.split('.')), None)
+            path, transform = step
+            if transform:
+                value = transform(value)
+            target = obj
+            for part in path[:-1]:
+                if part not in target:
+                    target[part] = {}
+                target = target[part]
+            target[path[-1]] = value
+        return obj
+
+class DuplicateFilter(object):
+    """Finds records that repeat a unique key of a record that was created.
+
+    A unique key is a list of attribute paths whose values must be unique
+    together, as in a 'unique' schema rule. Records where any of a key's
+    values is missing or null are not checked against that key.
+
+    A record's keys are reserved while it is being created and only
+    remembered once it has been, so a record is never reported as a
+    duplicate of one that failed. Keys are remembered as 16-byte digests,
+    so there are no false positives, and once max_keys are remembered new
+    ones are no longer added (later duplicates of them are not found, which
+    only means the api reports them instead). It can be shared between
+    threads.
+
+    Example:
+    >>> duplicates = DuplicateFilter([['email'], ['givenName', 'familyName']])
+    >>> keys = duplicates.keys({'email': 'a@test.test'})
+    >>> duplicates.reserve(keys) is None
+    True
+    >>> duplicates.reserve(keys)
+    'pending'
+    >>> duplicates.release(keys, created=True)
+    >>> duplicates.reserve(keys)
+    'duplicate'
+    """
+
+    def __init__(self, keys, max_keys=1000000):
+        """Initialize.
+
+        Args:
+            keys: list of unique keys, each a list of dot-separated attribute paths
+            max_keys: maximum number of keys to remember (about 100 bytes each)
+        """
+        self._projectors = [Projector(key) for key in keys]
+        self._max_keys = max_keys
+        self._lock = threading.Lock()
+        self._created = set()
+        self._pending = set()
+
+    def __len__(self):
+        """Number of keys remembered."""
+        return len(self._created)
+
+    def keys(self, record):
+        """Digests of the unique keys of a record.
+
+        Args:
+            record: multi-level dict
+
+        Returns:
+            list of digests of the keys that have no null values
+        """
+        digests = []
+        for i, project in enumerate(self._projectors):
+            values = project(record)
+            if None in values:
+                continue
+            encoded = json.dumps([i] + values, sort_keys=True).encode('utf-8')
+            digests.append(hashlib.blake2b(encoded, digest_size=16).digest())
+        return digests
+
+    def reserve(self, keys):
+        """Reserve the keys of a record that is about to be created.
+
+        Args:
+            keys: digests from :meth:`keys`
+
+        Returns:
+            'duplicate' if a key is that of a record that was created,
+            'pending' if a key is reserved by a record still being created,
+            otherwise None, and the keys are then reserved
+        """
+        with self._lock:
+            if any(key in self._created for key in keys):
+                return 'duplicate'
+            if any(key in self._pending for key in keys):
+                return 'pending'
+            self._pending.update(keys)
+        return None
+
+    def release(self, keys, created):
+        """Release the keys reserved for a record once it was created or failed.
+
+        Args:
+            keys: digests passed to :meth:`reserve`
+            created: whether the record was created, in which case its keys
+                are remembered
+        """
+        with self._lock:
+            self._pending.difference_update(keys)
+            if created:
+                for key in keys:
+                    if len(self._created) >= self._max_keys:
+                        break
+                    self._created.add(key)
+
 def to_capture_record(record, key_map=None, transform_map=None):
     """Returns a multilevel dict given a flat record.
     If key is missing from key_map, use original key.
@@ -126,7 +432,8 @@ def to_capture_record(record, key_map=None, transform_map=None):
 
     Args:
         record: single-level dict
-        key_map: map of key in flat record to capture dot-path
+        key_map: map of key in flat record to capture dot-path,
+            or a :class:`RecordBuilder` (which makes transform_map unused)
         transform_map: map for key in flat record to a transform function;
             the transform function must take a single argument and return a
             single value
@@ -134,6 +441,8 @@ def to_capture_record(record, key_map=None, transform_map=None):
     Returns:
         multi-level dict
     """
+    if isinstance(key_map, RecordBuilder):
+        return key_map(record)
     if key_map is None:
         key_map = {}
     if transform_map is None:
@@ -147,3 +456,398 @@ def to_capture_record(record, key_map=None, transform_map=None):
         path = key_map.get(key, key)
         dot_assign(obj, path, value)
     return obj
+
+def split_range(start, end, parts):
+    """Split the integer range (start, end] into contiguous sub-ranges.
+
+    Example:
+    >>> split_range(0, 10, 3)
+    [(0, 4), (4, 7), (7, 10)]
+
+    Args:
+        start: exclusive lower bound
+        end: inclusive upper bound
+        parts: maximum number of sub-ranges
+
+    Returns:
+        list of (start, end) tuples, each also exclusive/inclusive
+    """
+    size = end - start
+    parts = max(1, min(parts, size))
+    step, extra = divmod(size, parts)
+    ranges = []
+    for i in range(parts):
+        sub_end = start + step + (1 if i < extra else 0)
+        ranges.append((start, sub_end))
+        start = sub_end
+    return ranges
+
+def read_ahead(iterable, size):
+    """Iterate over an iterable while a background thread keeps up to
+    size items loaded ahead of the consumer.
+
+    Example:
+    >>> list(read_ahead(range(3), 2))
+    [0, 1, 2]
+
+    Args:
+        iterable: iterable to consume in the background
+        size: maximum number of items to load ahead
+
+    Yields:
+        the items of the iterable in their original order
+    """
+    items_q = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def put(item):
+        """Put an item in the queue unless the consumer went away."""
+        while not stop.is_set():
+            try:
+                items_q.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer():
+        """Load items into the queue followed by a final marker."""
+        try:
+            for item in iterable:
+                if not put(('item', item)):
+                    return
+        except Exception as err:
+            put(('error', err))
+        else:
+            put(('done', None))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        executor.submit(producer)
+        try:
+            while True:
+                kind, item = items_q.get()
+                if kind == 'done':
+                    break
+                elif kind == 'error':
+                    raise item
+                yield item
+        finally:
+            # unblock the producer if the consumer stopped early
+            stop.set()
+
+def ordered_map(func, iterable, concurrency=1):
+    """Apply a function to items on a pool of worker threads, yielding
+    the results in the order of the items.
+
+    Items are read as they are needed, with at most twice concurrency
+    in progress or waiting to be yielded. If the function raises, the
+    exception is raised when its result is reached.
+
+    Example:
+    >>> list(ordered_map(lambda x: x * 2, [1, 2, 3], concurrency=2))
+    [2, 4, 6]
+
+    Args:
+        func: function taking a single item
+        iterable: items to apply the function to
+        concurrency: number of worker threads
+
+    Yields:
+        the result for each item
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    pending = collections.deque()
+    try:
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= concurrency * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+class AdaptiveBatchSize(object):
+    """A batch size that adapts to how the api responds.
+
+    The size grows while batches come back quickly and small, shrinks when
+    they get slow or large, and is halved after a batch times out or is
+    rejected as too large. It can be shared between threads.
+    """
+
+    def __init__(self, initial=1000, minimum=1, maximum=10000,
+                 target_seconds=5.0, target_bytes=10000000):
+        """Initialize.
+
+        Args:
+            initial: batch size to start with
+            minimum: smallest batch size to shrink to
+            maximum: largest batch size to grow to
+                (entity.find does not allow more than 10000)
+            target_seconds: response time to aim for
+            target_bytes: response size to aim for
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.target_bytes = target_bytes
+        self._size = max(minimum, min(initial, maximum))
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        """Current batch size."""
+        return self._size
+
+    def update(self, size, num_records, elapsed, num_bytes):
+        """Adjust the batch size after a successful batch.
+
+        Args:
+            size: batch size that was requested
+            num_records: number of records that came back
+            elapsed: seconds the batch took
+            num_bytes: approximate size of the response
+        """
+        # never more than double or halve at once
+        ratio = 2.0
+        if elapsed > 0:
+            ratio = min(ratio, self.target_seconds / elapsed)
+        if num_bytes > 0:
+            ratio = min(ratio, self.target_bytes / float(num_bytes))
+        if num_records < size and ratio >= 1:
+            # a short batch (e.g. the last one) says nothing about
+            # how a bigger one would do
+            return
+        ratio = max(ratio, 0.5)
+        with self._lock:
+            self._size = max(self.minimum, min(self.maximum, int(size * ratio)))
+
+    def shrink(self, size):
+        """Halve the batch size after a batch failed.
+
+        Args:
+            size: batch size that was requested
+
+        Returns:
+            False if the batch size could not shrink any further
+        """
+        with self._lock:
+            if size <= self.minimum:
+                return False
+            self._size = max(self.minimum, min(self._size, size // 2))
+            return True
+
+def load_json_file(path):
+    """Read a JSON file.
+
+    Args:
+        path: path of the file
+
+    Returns:
+        the decoded contents
+
+    Raises:
+        FileNotFoundError: if the file does not exist
+    """
+    with open(path, encoding='utf-8') as fp:
+        return json.load(fp)
+
+def save_json_file(path, item):
+    """Write a JSON file atomically, so that a reader sees either the old
+    or the new contents, never a partial write.
+
+    Args:
+        path: path of the file
+        item: thing to write as JSON
+    """
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w', encoding='utf-8') as fp:
+        fp.write(to_json(item))
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_JSON_DECODER = json.JSONDecoder()
+_JSON_STRUCTURE = re.compile(r'["\[\]{}]')
+_JSON_STRING_END = re.compile(r'["\\]')
+_JSON_SCALAR_END = re.compile(r'[ \t\n\r,\]}]')
+
+def iter_json_array(chunks, key, extra=None):
+    """Incrementally decode the array at a key of a JSON object, yielding
+    its items as soon as each one has been received.
+
+    Example:
+    >>> list(iter_json_array([b'{"a": 1, "re', b'sults": [{"b": 2}, 3]}'], 'results'))
+    [{'b': 2}, 3]
+
+    Args:
+        chunks: iterable of UTF-8 encoded byte strings making up a JSON object
+        key: key of the array in the top level of the object
+        extra: if specified, a dict that the other top-level keys and
+            values are put into (complete once the items are exhausted)
+
+    Yields:
+        the items of the array
+
+    Raises:
+        ValueError: if the JSON is invalid or incomplete
+    """
+    if extra is None:
+        extra = {}
+    chunks = iter(chunks)
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    # buf[pos:] is the text that has not been decoded yet
+    state = {'buf': '', 'pos': 0, 'eof': False}
+
+    def read():
+        """Read the next chunk as text; returns None at the end of the input."""
+        if state['eof']:
+            return None
+        try:
+            return decoder.decode(next(chunks))
+        except StopIteration:
+            state['eof'] = True
+            return decoder.decode(b'', final=True)
+
+    def more():
+        """Read the next chunk; returns False at the end of the input."""
+        text = read()
+        if text is None:
+            return False
+        state['buf'] = state['buf'][state['pos']:] + text
+        state['pos'] = 0
+        return True
+
+    def peek():
+        """Skip whitespace and return the next character ('' at the end)."""
+        while True:
+            state['pos'] = _WHITESPACE.match(state['buf'], state['pos']).end()
+            if state['pos'] < len(state['buf']):
+                return state['buf'][state['pos']]
+            if not more():
+                return ''
+
+    def expect(chars):
+        char = peek()
+        if char not in chars or not char:
+            raise ValueError("invalid JSON: expected {!r} at {!r}".format(chars, char))
+        state['pos'] += 1
+        return char
+
+    def value():
+        """Decode the next complete value.
+        Each chunk is scanned once for the end of the value, and the
+        value is decoded once it has been found.
+        """
+        if not peek():
+            raise ValueError("invalid JSON: expected a value")
+        text, pos = state['buf'], state['pos']
+        scan = {}
+        parts = []
+        end = _scan_json_value(text, pos, scan)
+        while end is None:
+            parts.append(text[pos:])
+            text, pos = read(), 0
+            if text is None:
+                if not scan['scalar']:
+                    raise ValueError("invalid JSON: incomplete value")
+                # a scalar may end with the input
+                text = ''
+                end = 0
+                break
+            end = _scan_json_value(text, 0, scan)
+        if parts:
+            parts.append(text[:end])
+            item_text = ''.join(parts)
+            item, item_end = _JSON_DECODER.raw_decode(item_text)
+            complete = item_end == len(item_text)
+        else:
+            item, item_end = _JSON_DECODER.raw_decode(text, pos)
+            complete = item_end == end
+        if not complete:
+            raise ValueError("invalid JSON: unexpected data in value")
+        state['buf'], state['pos'] = text, end
+        return item
+
+    expect('{')
+    if peek() == '}':
+        return
+    while True:
+        name = value()
+        expect(':')
+        if name == key:
+            expect('[')
+            if peek() == ']':
+                state['pos'] += 1
+            else:
+                while True:
+                    yield value()
+                    if expect(',]') == ']':
+                        break
+        else:
+            extra[name] = value()
+        if expect(',}') == '}':
+            break
+
+
+def _scan_json_value(text, pos, scan):
+    """Scan a chunk of text for the end of the JSON value that starts
+    at the first chunk's position, carrying the state between chunks.
+
+    Args:
+        text: chunk of text
+        pos: position to scan from (the start of the value in the first chunk)
+        scan: dict of the scan state, empty before the first chunk
+
+    Returns:
+        position in text just past the end of the value, or None if
+        the value continues in the next chunk
+    """
+    if not scan:
+        scan.update(scalar=text[pos] not in '[{"', depth=0, in_string=False, escape=False)
+    if scan['scalar']:
+        found = _JSON_SCALAR_END.search(text, pos)
+        return found.start() if found else None
+    if scan['escape']:
+        if pos >= len(text):
+            return None
+        # the character after a backslash at the end of the last chunk
+        pos += 1
+        scan['escape'] = False
+    depth = scan['depth']
+    in_string = scan['in_string']
+    while True:
+        if in_string:
+            found = _JSON_STRING_END.search(text, pos)
+            if found is None:
+                break
+            pos = found.end()
+            if found.group() == '\\':
+                if pos == len(text):
+                    scan['escape'] = True
+                    break
+                pos += 1
+                continue
+            in_string = False
+            if depth == 0:
+                return pos
+        else:
+            found = _JSON_STRUCTURE.search(text, pos)
+            if found is None:
+                break
+            pos = found.end()
+            char = found.group()
+            if char == '"':
+                in_string = True
+            elif char in '[{':
+                depth += 1
+            else:
+                depth -= 1
+                if depth <= 0:
+                    return pos
+    scan['depth'] = depth
+    scan['in_string'] = in_string
+    return None
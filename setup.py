@@ -17,6 +17,7 @@ setuptools.setup(
     packages=[
         PACKAGE,
     ],
+    python_requires=">=3.6",
     install_requires=[
         "janrain-python-api == 0.4.0",
     ],
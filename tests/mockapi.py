@@ -3,6 +3,7 @@
 Notes:
 Changes to schema attributes are not reflected in the response.
 """
+import asyncio
 import copy
 import json
 import os
@@ -11,6 +12,7 @@ import sys
 
 import mock
 import janrain.capture
+import janrain.capture.api
 
 def load_file(filename, subdir='data'):
     """read in a utf-8 file relative to the current file's dir"""
@@ -28,6 +30,53 @@ def load_json_file(filename, subdir='data'):
     contents = load_file(filename, subdir=subdir)
     return json.loads(contents)
 
+def project(entity, attributes=None):
+    """copy of an entity with only the given attributes (dot-paths)"""
+    if attributes is None:
+        return copy.deepcopy(entity)
+    result = {}
+    for attr in attributes:
+        source = entity
+        target = result
+        path = attr.split('.')
+        for key in path[:-1]:
+            source = source.get(key) or {}
+            target = target.setdefault(key, {})
+        target[path[-1]] = copy.deepcopy(source.get(path[-1]))
+    return result
+
+def run(coroutine):
+    """run a coroutine to completion on a new event loop
+    (like asyncio.run, which needs Python 3.7)"""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+def is_duplicate(entity):
+    """every 13th of the test{n}@test.test emails is a duplicate"""
+    found = re.match(r'test(\d+)@', str(entity.get('email', '')))
+    return bool(found) and (int(found.group(1)) + 1) % 13 == 0
+
+class MockResponse(object):
+    """Mock of a requests response with a JSON body"""
+
+    def __init__(self, body, status_code=200):
+        self.content = json.dumps(body).encode('utf-8')
+        self.status_code = status_code
+        self.closed = False
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        self.closed = True
+
 class Mockapi(janrain.capture.Api):
     """Mock of janrain.capture.Api"""
 
@@ -48,6 +97,9 @@ class Mockapi(janrain.capture.Api):
         ]
 
         self.entities = load_json_file('mockentities.json')
+        # entity.find only applies lastUpdated filters when this is set,
+        # for the tests that page by lastUpdated
+        self.filter_updated = False
 
         def call_side_effect(cmd, **kwargs):
             """defines the return values for various api calls"""
@@ -282,23 +334,57 @@ class Mockapi(janrain.capture.Api):
                     "stat": "ok"
                 }
             elif cmd == "entity.count":
+                entities = self.entities
+                found = re.search(r'id > (\d+)', kwargs.get('filter', ''))
+                if found:
+                    entities = [x for x in entities if x['id'] > int(found.group(1))]
                 return {
                     "stat": "ok",
-                    "total_count": len(self.entities)
+                    "total_count": len(entities)
                 }
             elif cmd == "entity.find":
                 if 'max_results' not in kwargs:
                     kwargs['max_results'] = 100
                 min_id = 0
+                max_id = None
                 if 'filter' in kwargs:
                     found = re.search(r'id > (\d+)', kwargs['filter'])
                     if found:
                         min_id = int(found.group(1))
+                    found = re.search(r'id <= (\d+)', kwargs['filter'])
+                    if found:
+                        max_id = int(found.group(1))
+                updated = None
+                updated_after = None
+                if 'filter' in kwargs and self.filter_updated:
+                    found = re.search(r"lastUpdated = '([^']*)'", kwargs['filter'])
+                    if found:
+                        updated = found.group(1)
+                    found = re.search(r"lastUpdated > '([^']*)'", kwargs['filter'])
+                    if found:
+                        updated_after = found.group(1)
+                keys = {}
+                if 'filter' in kwargs:
+                    for attr, value in re.findall(r"\b(email|uuid) = '((?:[^'\\]|\\.)*)'", kwargs['filter']):
+                        keys.setdefault(attr, set()).add(re.sub(r'\\(.)', r'\1', value))
+                entities = self.entities
+                if keys:
+                    entities = [x for x in entities if any(x.get(k) in v for k, v in keys.items())]
+                if kwargs.get('sort_on') == ['-id']:
+                    entities = reversed(entities)
+                elif kwargs.get('sort_on') == ['-lastUpdated']:
+                    entities = sorted(entities, key=lambda x: x['lastUpdated'], reverse=True)
+                elif kwargs.get('sort_on') == ['lastUpdated', 'id']:
+                    entities = sorted(entities, key=lambda x: (x['lastUpdated'], x['id']))
                 results = []
                 count = 0
-                for entity in self.entities:
-                    if entity['id'] > min_id:
-                        results.append(entity.copy())
+                for entity in entities:
+                    if updated is not None and entity['lastUpdated'] != updated:
+                        continue
+                    if updated_after is not None and entity['lastUpdated'] <= updated_after:
+                        continue
+                    if entity['id'] > min_id and (max_id is None or entity['id'] <= max_id):
+                        results.append(project(entity, kwargs.get('attributes')))
                         count += 1
                         if count >= kwargs['max_results']:
                             break
@@ -318,17 +404,24 @@ class Mockapi(janrain.capture.Api):
             elif cmd == "entity.bulkCreate":
                 results = []
                 uuid_results = []
-                for i, entity in enumerate(kwargs['all_attributes'], start=1):
-                    # make every 13th record fail
-                    if i % 13 == 0:
-                        err = {
-                            "code": 361,
-                            "error": "unique_violation",
-                            "error_description": "Attempted to update a duplicate value",
-                            "stat": "error"
-                        }
-                        results.append(err)
-                        uuid_results.append(err)
+                err = {
+                    "code": 361,
+                    "error": "unique_violation",
+                    "error_description": "Attempted to update a duplicate value",
+                    "stat": "error"
+                }
+                all_attributes = kwargs['all_attributes']
+                if isinstance(all_attributes, bytes):
+                    all_attributes = json.loads(all_attributes.decode('utf-8'))
+                failing = [is_duplicate(entity) for entity in all_attributes]
+                if kwargs.get('commit_each') is False and any(failing):
+                    # the whole batch fails
+                    raise janrain.capture.ApiResponseError(
+                        err['code'], err['error'], err['error_description'], err)
+                for i, failed in enumerate(failing, start=1):
+                    if failed:
+                        results.append(err.copy())
+                        uuid_results.append(err.copy())
                     else:
                         new_id = len(self.entities) + i
                         results.append(new_id)
@@ -344,3 +437,35 @@ class Mockapi(janrain.capture.Api):
 
         # replace the call method with a mock
         self.call = mock.Mock(side_effect=call_side_effect)
+        self.responses = []
+
+    def post(self, url, headers=None, data=None, stream=False, timeout=None):
+        """stand-in for requests.post that answers with the mocked call"""
+        cmd = url[len(self.api_url) + 1:]
+        kwargs = {}
+        for key, value in data.items():
+            value = janrain.capture.api.api_decode(value)
+            if isinstance(value, str) and value[:1] in ('[', '{'):
+                value = json.loads(value)
+            kwargs[key] = value
+        try:
+            body = self.call(cmd, **kwargs)
+        except janrain.capture.ApiResponseError as err:
+            body = err.response
+        response = MockResponse(body)
+        self.responses.append(response)
+        return response
+
+class ProcessMockapi(janrain.capture.Api):
+    """Mock of janrain.capture.Api that can be sent to a worker process,
+    where it answers with a Mockapi of its own"""
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('mockapi', None)
+        return state
+
+    def call(self, api_call, **kwargs):
+        if 'mockapi' not in self.__dict__:
+            self.mockapi = Mockapi(self.api_url)
+        return self.mockapi.call(api_call, **kwargs)
@@ -3,10 +3,12 @@ import mock
 import unittest
 
 import janrain.capture
+import requests
 
 import janrain_datalib.exceptions
 from janrain_datalib.app import App
 from janrain_datalib.client import Client
+from janrain_datalib.concurrencycontroller import ConcurrencyController
 from janrain_datalib.defaultsettings import DefaultSettings
 from janrain_datalib.schema import Schema
 from .mockapi import Mockapi
@@ -39,6 +41,118 @@ class TestApp(unittest.TestCase):
         else:
             self.fail("ApiNotFoundError not raised on 222 code from api")
 
+    def test_apicall_http_error(self):
+        response = requests.Response()
+        response.status_code = 413
+        response._content = b'request entity too large'
+        self.mockapi.call.side_effect = requests.exceptions.HTTPError(response=response)
+        with self.assertRaises(janrain_datalib.exceptions.ApiTooLargeError):
+            self.app.apicall('entity.bulkCreate')
+
+        response.status_code = 510
+        response._content = b''
+        with self.assertRaises(janrain_datalib.exceptions.ApiRateLimitError):
+            self.app.apicall('entity.bulkCreate')
+
+        # only a 413 or a response saying so means too large
+        response.status_code = 504
+        with self.assertRaises(janrain_datalib.exceptions.ApiError) as cm:
+            self.app.apicall('entity.bulkCreate')
+        self.assertNotIsInstance(cm.exception, janrain_datalib.exceptions.ApiTooLargeError)
+        self.assertEqual(cm.exception.code, 504)
+
+        response.status_code = 403
+        with self.assertRaises(janrain_datalib.exceptions.ApiAuthError):
+            self.app.apicall('entity.bulkCreate')
+
+        response.status_code = 500
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.app.apicall('entity.bulkCreate')
+
+    def test_apicall_timeout_retries(self):
+        args = (504, '', '', '')
+        self.mockapi.call.side_effect = janrain.capture.ApiResponseError(*args)
+        with self.assertRaises(janrain_datalib.exceptions.ApiError):
+            self.app.apicall('entity.find')
+        # first call plus 3 retries
+        self.assertEqual(len(self.mockapi.call.mock_calls), 4)
+
+        self.mockapi.call.reset_mock()
+        with self.assertRaises(janrain_datalib.exceptions.ApiError):
+            self.app._apicall('entity.find', {}, retries_max=0)
+        self.assertEqual(len(self.mockapi.call.mock_calls), 1)
+
+    def test_apicall_rate_limit(self):
+        self.app.controller = ConcurrencyController(initial=8, backoff_seconds=0.01, retries_max=2)
+        response = requests.Response()
+        response.status_code = 510
+        response._content = b''
+        error = requests.exceptions.HTTPError(response=response)
+        self.mockapi.call.side_effect = [error, error, {'stat': 'ok'}]
+        self.assertEqual(self.app.apicall('entity.count'), {'stat': 'ok'})
+        self.assertEqual(len(self.mockapi.call.mock_calls), 3)
+        self.assertTrue(self.app.controller.limit < 8)
+        self.assertEqual(self.app.controller.in_flight, 0)
+
+        # retried at most retries_max times
+        self.mockapi.call.side_effect = error
+        with self.assertRaises(janrain_datalib.exceptions.ApiRateLimitError):
+            self.app.apicall('entity.count')
+        self.assertEqual(self.app.controller.in_flight, 0)
+
+        # not retried without a controller
+        self.app.controller = None
+        self.mockapi.call.reset_mock()
+        with self.assertRaises(janrain_datalib.exceptions.ApiRateLimitError):
+            self.app.apicall('entity.count')
+        self.assertEqual(len(self.mockapi.call.mock_calls), 1)
+
+    def test_apicall_stream(self):
+        self.mockapi.sign_requests = False
+        with mock.patch('requests.post', side_effect=self.mockapi.post) as post:
+            items = self.app.apicall_stream('entity.find', type_name='user', max_results=5, chunk_size=7)
+            self.assertEqual(list(items), self.mockapi.entities[:5])
+        self.mockapi.call.assert_called_once_with('entity.find', type_name='user', max_results=5)
+        self.assertTrue(post.call_args[1]['stream'])
+        # connect and read timeouts, the read one beyond the api's own
+        self.assertEqual(post.call_args[1]['timeout'], (10, 20))
+        self.assertTrue(self.mockapi.responses[0].closed)
+
+        with mock.patch('requests.post', side_effect=self.mockapi.post) as post:
+            list(self.app.apicall_stream('entity.find', type_name='user', timeout=30))
+        self.assertEqual(post.call_args[1]['timeout'], (10, 40))
+
+    def test_apicall_stream_controller(self):
+        self.mockapi.sign_requests = False
+        controller = ConcurrencyController(maximum=2)
+        self.app.controller = controller
+        with mock.patch('requests.post', side_effect=self.mockapi.post):
+            items = self.app.apicall_stream('entity.find', type_name='user', max_results=5)
+            # released once the first item arrived
+            self.assertEqual(controller.in_flight, 0)
+            self.assertEqual(len(list(items)), 5)
+            self.assertEqual(controller.in_flight, 0)
+
+    def test_apicall_stream_nested(self):
+        self.mockapi.sign_requests = False
+        self.app.controller = ConcurrencyController(initial=1, maximum=1)
+        counts = []
+        with mock.patch('requests.post', side_effect=self.mockapi.post):
+            # another call made while the stream is being read does not wait for it
+            for record in self.app.apicall_stream('entity.find', type_name='user', max_results=3):
+                counts.append(self.app.apicall('entity.count', type_name='user')['total_count'])
+        self.assertEqual(counts, [len(self.mockapi.entities)] * 3)
+
+    def test_apicall_stream_error(self):
+        self.mockapi.sign_requests = False
+        self.mockapi.call.side_effect = janrain.capture.ApiResponseError(
+            222, 'not_found', 'not found', {'stat': 'error', 'code': 222,
+                                            'error': 'not_found', 'error_description': 'not found'})
+        with mock.patch('requests.post', side_effect=self.mockapi.post):
+            with self.assertRaises(janrain_datalib.exceptions.ApiNotFoundError):
+                self.app.apicall_stream('entity.find', type_name='user')
+        self.assertTrue(self.mockapi.responses[0].closed)
+
     def test_cache(self):
         # set
         self.app.set_cache('testkey', 'testvalue')
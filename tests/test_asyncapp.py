@@ -0,0 +1,117 @@
+"""Tests for AsyncApp."""
+import asyncio
+import http.server
+import json
+import threading
+import time
+import unittest
+
+import janrain.capture
+
+import janrain_datalib.exceptions
+from janrain_datalib.asyncapp import AsyncApp
+from janrain_datalib.concurrencycontroller import ConcurrencyController
+from janrain_datalib.asyncschemarecords import AsyncSchemaRecords
+from .mockapi import Mockapi
+from .mockapi import run
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """Answers api calls like a capture server would."""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        if self.path == '/entity.count':
+            body = {'stat': 'ok', 'total_count': 5}
+        else:
+            body = {
+                'stat': 'error',
+                'code': 310,
+                'error': 'record_not_found',
+                'error_description': 'record not found',
+            }
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+class TestAsyncApp(unittest.TestCase):
+
+    def setUp(self):
+        # use a mock for the api calls
+        self.mockapi = Mockapi('')
+
+        # create the app object to be tested
+        self.app = AsyncApp(self.mockapi)
+        self.addCleanup(self.app.close)
+
+    def test_apicall(self):
+        r = run(self.app.apicall('entityType.list'))
+        self.assertEqual(r['results'], self.mockapi.schemas_list)
+
+        args = (402, '', '', '')
+        self.mockapi.call.side_effect = janrain.capture.ApiResponseError(*args)
+        with self.assertRaises(janrain_datalib.exceptions.ApiAuthError):
+            run(self.app.apicall('flows/get'))
+
+    def test_apicall_concurrent(self):
+        async def calls():
+            return await asyncio.gather(*[self.app.apicall('entity.count') for _ in range(20)])
+        results = run(calls())
+        self.assertEqual([r['total_count'] for r in results], [len(self.mockapi.entities)] * 20)
+
+    def test_apicall_controller(self):
+        controller = ConcurrencyController(initial=2, maximum=2)
+        app = AsyncApp(self.mockapi, controller=controller)
+        self.addCleanup(app.close)
+        self.assertIs(app.app.controller, controller)
+
+        lock = threading.Lock()
+        in_flight = []
+        peak = []
+        call_side_effect = self.mockapi.call.side_effect
+        def mock_call(cmd, **kwargs):
+            with lock:
+                in_flight.append(1)
+                peak.append(len(in_flight))
+            time.sleep(0.01)
+            with lock:
+                in_flight.pop()
+            return call_side_effect(cmd, **kwargs)
+        self.mockapi.call.side_effect = mock_call
+
+        async def calls():
+            return await asyncio.gather(*[app.apicall('entity.count') for _ in range(10)])
+        run(calls())
+        self.assertLessEqual(max(peak), 2)
+
+    def test_stand_in_server(self):
+        server = http.server.HTTPServer(('127.0.0.1', 0), StandInHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        defaults = {'client_id': 'id', 'client_secret': 'secret'}
+        app = AsyncApp(janrain.capture.Api(url, defaults))
+        self.addCleanup(app.close)
+        records = app.get_records('user')
+
+        self.assertEqual(run(records.count()), 5)
+        with self.assertRaises(janrain_datalib.exceptions.ApiNotFoundError):
+            run(records.get_record('x').as_dict())
+
+    def test_get_records(self):
+        records = self.app.get_records('test')
+        self.assertTrue(isinstance(records, AsyncSchemaRecords))
+        # no api calls were made
+        self.assertEqual([], self.mockapi.call.mock_calls)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+"""Tests for AsyncSchemaRecord."""
+import mock
+import unittest
+
+from janrain_datalib.asyncapp import AsyncApp
+from janrain_datalib.asyncschemarecord import AsyncSchemaRecord
+from .mockapi import Mockapi
+from .mockapi import run
+
+class TestAsyncSchemaRecord(unittest.TestCase):
+
+    def setUp(self):
+        # use a mock for the api calls
+        self.mockapi = Mockapi('')
+
+        # create the app object
+        self.app = AsyncApp(self.mockapi)
+        self.addCleanup(self.app.close)
+
+        self.schema_name = 'janraintestschema'
+
+        self.uuid = '00000000-0000-0000-0000-000000000001'
+
+        # create the record object
+        self.record = AsyncSchemaRecord(self.app, self.schema_name, self.uuid)
+
+    def test_as_dict(self):
+        record = run(self.record.as_dict())
+        self.assertEqual(record, self.mockapi.entities[0])
+
+        calls = [
+            mock.call('entity', type_name=self.schema_name, key_attribute='uuid', key_value='"{}"'.format(self.uuid))
+        ]
+        self.assertEqual(calls, self.mockapi.call.mock_calls)
+
+    def test_update_with_maps(self):
+        record = {
+            'balance': '12.00',
+        }
+        key_map = {
+            'balance': 'wallet.balance',
+        }
+        transform_map = {
+            'balance': lambda x: float(x),
+        }
+        run(self.record.update(record, key_map=key_map, transform_map=transform_map))
+
+        calls = [
+            mock.call(
+                'entity.update',
+                type_name=self.schema_name,
+                key_attribute='uuid',
+                key_value='"{}"'.format(self.uuid),
+                attributes={'wallet': {'balance': 12.0}})
+        ]
+        self.assertEqual(calls, self.mockapi.call.mock_calls)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+"""Tests for AsyncSchemaRecords."""
+import mock
+import unittest
+
+from janrain_datalib.asyncapp import AsyncApp
+from janrain_datalib.asyncschemarecord import AsyncSchemaRecord
+from janrain_datalib.exceptions import ApiTooLargeError
+from .mockapi import Mockapi
+from .mockapi import run
+
+class TestAsyncSchemaRecords(unittest.TestCase):
+
+    def setUp(self):
+        # use a mock for the api calls
+        self.mockapi = Mockapi('')
+
+        # create the app object
+        self.app = AsyncApp(self.mockapi)
+        self.addCleanup(self.app.close)
+
+        self.schema_name = 'janraintestschema'
+
+        # create the records object
+        self.records = self.app.get_records(self.schema_name)
+
+    def collect(self, agen):
+        async def collect():
+            return [x async for x in agen]
+        return run(collect())
+
+    def test_create(self):
+        all_attributes = [{"email": "test{}@test.test".format(i)} for i in range(13)]
+        report = self.collect(self.records.create(all_attributes))
+        self.assertEqual(len(report), 13)
+        self.assertEqual(report[0], {'id': 44, 'uuid': '00000000-0000-0000-0000-000000000000'})
+        self.assertEqual(report[12]['error'], 'unique_violation')
+
+    def test_create_batches(self):
+        num_records = 20
+        all_attributes = [{"email": "test{}@test.test".format(i)} for i in range(num_records)]
+        report = self.collect(self.records.create(all_attributes, batch_size=3, concurrency=3))
+        self.assertEqual(len(report), num_records)
+        # 7 batches and the one with a duplicate retried
+        self.assertEqual(len(self.mockapi.call.mock_calls), 8)
+        self.assertEqual(report[12]['error'], 'unique_violation')
+        # results are in the same order as the records
+        ids = [r['id'] for r in report[:3]]
+        self.assertEqual(ids, [44, 45, 46])
+
+    def test_create_too_large(self):
+        call_side_effect = self.mockapi.call.side_effect
+
+        def mock_call(cmd, **kwargs):
+            if len(kwargs['all_attributes']) > 200:
+                raise ApiTooLargeError('too large', 413)
+            return call_side_effect(cmd, **kwargs)
+        self.mockapi.call.side_effect = mock_call
+
+        num_records = 40
+        all_attributes = [{"email": "test{}@test.test".format(i)} for i in range(num_records)]
+        report = self.collect(self.records.create(all_attributes, mode='each', batch_size=20, concurrency=2))
+        self.assertEqual(len(report), num_records)
+        self.assertEqual(report[12]['error'], 'unique_violation')
+        self.assertEqual(len([r for r in report if 'uuid' in r]), 37)
+
+        # a record too large on its own fails alone
+        all_attributes[5]['aboutMe'] = 'x' * 200
+        report = self.collect(self.records.create(all_attributes[:10], batch_size=20))
+        self.assertEqual([i for i, r in enumerate(report) if 'error' in r], [5])
+        self.assertEqual(report[5]['code'], 413)
+
+    def test_count(self):
+        count = run(self.records.count())
+        self.assertEqual(count, len(self.mockapi.entities))
+
+    def test_find(self):
+        records = run(self.records.find(batch_size=3, filtering='id > 5'))
+        self.assertEqual([r['id'] for r in records], [6, 7, 8])
+        calls = [
+            mock.call('entity.find', type_name=self.schema_name, max_results=3, filter='id > 5')
+        ]
+        self.assertEqual(calls, self.mockapi.call.mock_calls)
+
+    def test_iterator(self):
+        records = self.collect(self.records.iterator(attributes=['uuid'], batch_size=10))
+        self.assertEqual(records, [{'uuid': e['uuid']} for e in self.mockapi.entities])
+        self.assertEqual(len(self.mockapi.call.mock_calls), 6)
+
+    def test_get_record(self):
+        record = self.records.get_record('')
+        self.assertTrue(isinstance(record, AsyncSchemaRecord))
+
+        # no calls were made
+        self.assertEqual([], self.mockapi.call.mock_calls)
+
+if __name__ == '__main__':
+    unittest.main()
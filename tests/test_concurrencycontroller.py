@@ -0,0 +1,63 @@
+"""Tests for ConcurrencyController."""
+import threading
+import time
+import unittest
+
+from janrain_datalib.concurrencycontroller import ConcurrencyController
+
+class TestConcurrencyController(unittest.TestCase):
+
+    def test_increase(self):
+        controller = ConcurrencyController(initial=2, maximum=4)
+        self.assertEqual(controller.limit, 2)
+        # about one more for each limit's worth of calls
+        for _ in range(3):
+            controller.release(controller.acquire())
+        self.assertEqual(controller.limit, 3)
+        for _ in range(100):
+            controller.release(controller.acquire())
+        self.assertEqual(controller.limit, 4)
+        self.assertEqual(controller.in_flight, 0)
+
+    def test_decrease(self):
+        controller = ConcurrencyController(initial=8, minimum=1)
+        starts = [controller.acquire() for _ in range(4)]
+        controller.release(starts[0], overloaded=True)
+        self.assertEqual(controller.limit, 4)
+        # calls that were in progress together only decrease it once
+        for start in starts[1:]:
+            controller.release(start, overloaded=True)
+        self.assertEqual(controller.limit, 4)
+        for _ in range(3):
+            controller.release(controller.acquire(), overloaded=True)
+        self.assertEqual(controller.limit, 1)
+
+        # slow calls also decrease it
+        controller = ConcurrencyController(initial=8, target_seconds=10)
+        controller.release(controller.acquire() - 20)
+        self.assertEqual(controller.limit, 4)
+
+    def test_limit(self):
+        controller = ConcurrencyController(initial=2, maximum=2)
+        lock = threading.Lock()
+        counts = {'in_flight': 0, 'most': 0}
+
+        def work():
+            start = controller.acquire()
+            with lock:
+                counts['in_flight'] += 1
+                counts['most'] = max(counts['most'], counts['in_flight'])
+            time.sleep(0.01)
+            with lock:
+                counts['in_flight'] -= 1
+            controller.release(start)
+        threads = [threading.Thread(target=work) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counts['most'], 2)
+
+    def test_retry_delay(self):
+        controller = ConcurrencyController(backoff_seconds=0.5)
+        self.assertEqual([controller.retry_delay(i) for i in range(3)], [0.5, 1, 2])
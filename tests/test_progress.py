@@ -0,0 +1,61 @@
+"""Tests for Progress."""
+import threading
+import unittest
+
+from janrain_datalib.progress import Progress
+
+class TestProgress(unittest.TestCase):
+
+    def test_counts(self):
+        progress = Progress(total=100)
+        snapshot = progress.snapshot()
+        self.assertEqual(snapshot.records, 0)
+        self.assertEqual(snapshot.eta, None)
+        self.assertFalse(snapshot.done)
+
+        progress.add(records=10, pages=1, num_bytes=1000)
+        progress.add(records=15, pages=1, num_bytes=500, retries=1, errors=2)
+        snapshot = progress.snapshot()
+        self.assertEqual(snapshot.records, 25)
+        self.assertEqual(snapshot.pages, 2)
+        self.assertEqual(snapshot.bytes, 1500)
+        self.assertEqual(snapshot.retries, 1)
+        self.assertEqual(snapshot.errors, 2)
+        self.assertEqual(snapshot.total, 100)
+        self.assertTrue(snapshot.rate > 0)
+        self.assertAlmostEqual(snapshot.eta, 75 / snapshot.rate, places=3)
+
+        progress.finish()
+        snapshot = progress.snapshot()
+        self.assertTrue(snapshot.done)
+        self.assertEqual(snapshot.eta, 0)
+        # the clock stopped
+        self.assertEqual(progress.snapshot().elapsed, snapshot.elapsed)
+
+    def test_threads(self):
+        progress = Progress()
+
+        def work():
+            for _ in range(1000):
+                progress.add(records=1)
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(progress.snapshot().records, 4000)
+
+    def test_callback(self):
+        snapshots = []
+        progress = Progress(callback=snapshots.append, interval=3600)
+        for item in progress.track(range(5)):
+            progress.add(records=1)
+        # the first update and the finish, throttled in between
+        self.assertEqual([s.records for s in snapshots], [1, 5])
+        self.assertTrue(snapshots[-1].done)
+
+        snapshots = []
+        progress = Progress(callback=snapshots.append, interval=0)
+        for item in progress.track(range(3)):
+            progress.add(records=1)
+        self.assertEqual([s.records for s in snapshots], [1, 2, 3, 3])
@@ -0,0 +1,81 @@
+"""Tests for RecordsDelta."""
+import unittest
+
+from janrain_datalib.app import App
+from janrain_datalib.recordsdelta import RecordsDelta
+from janrain_datalib.schemarecords import SchemaRecords
+from .mockapi import Mockapi
+
+class TestRecordsDelta(unittest.TestCase):
+
+    def setUp(self):
+        # use a mock for the api calls
+        self.mockapi = Mockapi('')
+        self.mockapi.filter_updated = True
+
+        # create the app object
+        self.app = App(self.mockapi)
+
+        self.schema_name = 'janraintestschema'
+
+        # create the records object
+        self.records = SchemaRecords(self.app, self.schema_name)
+
+        # several records share each timestamp
+        for entity in self.mockapi.entities:
+            entity['lastUpdated'] = '2000-01-0{} 12:00:00.000000 +0000'.format(1 + entity['id'] % 3)
+        self.expected = sorted(self.mockapi.entities, key=lambda x: (x['lastUpdated'], x['id']))
+
+    def test_all(self):
+        delta = self.records.delta(batch_size=4)
+        self.assertTrue(isinstance(delta, RecordsDelta))
+        self.assertEqual(delta.watermark, None)
+        self.assertEqual(list(delta), self.expected)
+        last = self.expected[-1]
+        self.assertEqual(delta.watermark, {'lastUpdated': last['lastUpdated'], 'id': last['id']})
+
+    def test_resume(self):
+        # stop in the middle of a group of records with the same timestamp
+        for batch_size in (4, 5, 100, None):
+            delta = self.records.delta(batch_size=batch_size)
+            seen = []
+            for record in delta:
+                seen.append(record['id'])
+                if len(seen) == 6:
+                    break
+            rest = [record['id'] for record in self.records.delta(delta.watermark, batch_size=batch_size)]
+            self.assertEqual(seen + rest, [x['id'] for x in self.expected])
+
+    def test_changes(self):
+        delta = self.records.delta(batch_size=4)
+        list(delta)
+        watermark = delta.watermark
+
+        # nothing changed
+        self.assertEqual(list(self.records.delta(watermark, batch_size=4)), [])
+
+        # updated records come back once
+        self.mockapi.entities[0]['lastUpdated'] = '2000-01-05 12:00:00.000000 +0000'
+        self.mockapi.entities[9]['lastUpdated'] = '2000-01-05 12:00:00.000000 +0000'
+        delta = self.records.delta(watermark, ['uuid'], batch_size=4)
+        self.assertEqual(list(delta), [
+            {'uuid': self.mockapi.entities[0]['uuid']},
+            {'uuid': self.mockapi.entities[9]['uuid']},
+        ])
+        self.assertEqual(delta.watermark, {'lastUpdated': '2000-01-05 12:00:00.000000 +0000', 'id': 10})
+
+    def test_timestamp(self):
+        timestamp = '2000-01-03 12:00:00.000000 +0000'
+        ids = [record['id'] for record in self.records.delta(timestamp, batch_size=4)]
+        self.assertEqual(ids, [x['id'] for x in self.expected if x['lastUpdated'] >= timestamp])
+
+    def test_filtering(self):
+        filtering = "email = 'test1@test.test'"
+        list(self.records.delta({'lastUpdated': '2000-01-01', 'id': 0}, filtering=filtering))
+        filters = [c[2]['filter'] for c in self.mockapi.call.mock_calls]
+        self.assertTrue(filters)
+        for f in filters:
+            self.assertTrue(f.startswith(filtering + ' and lastUpdated '))
+
+if __name__ == '__main__':
+    unittest.main()
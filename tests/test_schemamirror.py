@@ -0,0 +1,129 @@
+"""Tests for SchemaMirror."""
+import os
+import shutil
+import tempfile
+import unittest
+
+from janrain_datalib.app import App
+from janrain_datalib.exceptions import InputError
+from janrain_datalib.schemamirror import SchemaMirror
+from janrain_datalib.schemarecords import SchemaRecords
+from .mockapi import Mockapi
+
+class TestSchemaMirror(unittest.TestCase):
+
+    def setUp(self):
+        # use a mock for the api calls
+        self.mockapi = Mockapi('')
+        self.mockapi.filter_updated = True
+
+        # create the app object
+        self.app = App(self.mockapi)
+
+        self.schema_name = 'janraintestschema'
+
+        # create the records object
+        self.records = SchemaRecords(self.app, self.schema_name)
+
+        for entity in self.mockapi.entities:
+            entity['lastUpdated'] = '2000-01-01 12:00:00.{:06d} +0000'.format(entity['id'])
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'mirror.sqlite')
+        self.mirror = self.records.mirror(self.path, indexes=['email', 'address.city'])
+
+    def tearDown(self):
+        self.mirror.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_sync(self):
+        self.assertTrue(isinstance(self.mirror, SchemaMirror))
+        # the copy plus the last updated record again from the delta
+        self.assertEqual(self.mirror.sync(batch_size=10), len(self.mockapi.entities) + 1)
+        self.assertEqual(self.mirror.count(), len(self.mockapi.entities))
+        self.assertEqual(self.mirror.find(), self.mockapi.entities)
+        last = self.mockapi.entities[-1]
+        self.assertEqual(self.mirror.watermark, {'lastUpdated': last['lastUpdated'], 'id': last['id']})
+
+        # only changed and new records are fetched by the next sync
+        changed = self.mockapi.entities[3]
+        changed['email'] = 'changed@test.test'
+        changed['lastUpdated'] = '2000-01-02 12:00:00.000000 +0000'
+        new = dict(self.mockapi.entities[0], id=100, uuid='new-uuid',
+                   lastUpdated='2000-01-03 12:00:00.000000 +0000')
+        self.mockapi.entities.append(new)
+        self.assertEqual(self.mirror.sync(batch_size=10), 2)
+        self.assertEqual(self.mirror.get('changed@test.test', 'email'), changed)
+        self.assertEqual(self.mirror.get('new-uuid'), new)
+        self.assertEqual(self.mirror.watermark, {'lastUpdated': new['lastUpdated'], 'id': 100})
+        self.assertEqual(self.mirror.sync(batch_size=10), 0)
+
+    def test_sync_empty(self):
+        entities = self.mockapi.entities[:]
+        del self.mockapi.entities[:]
+        self.assertEqual(self.mirror.sync(batch_size=10), 0)
+        # not taken from the local clock, which may be ahead of the server's
+        self.assertIsNone(self.mirror.watermark)
+        # records created since are copied once, then the watermark is the server's
+        self.mockapi.entities.extend(entities)
+        self.assertEqual(self.mirror.sync(batch_size=10), len(entities))
+        last = entities[-1]
+        self.assertEqual(self.mirror.watermark, {'lastUpdated': last['lastUpdated'], 'id': last['id']})
+        self.assertEqual(self.mirror.sync(batch_size=10), 0)
+
+    def test_resume(self):
+        side_effect = self.mockapi.call.side_effect
+        pages = []
+
+        def fail_on_second_page(cmd, **kwargs):
+            if kwargs.get('filter') == 'id > 10':
+                raise RuntimeError("interrupted")
+            pages.append(kwargs.get('filter'))
+            return side_effect(cmd, **kwargs)
+        self.mockapi.call.side_effect = fail_on_second_page
+        with self.assertRaises(RuntimeError):
+            # interrupted during the first copy
+            self.mirror.sync(batch_size=10)
+        self.mockapi.call.side_effect = side_effect
+        self.assertEqual(self.mirror.count(), 10)
+        self.mockapi.call.reset_mock()
+        self.mirror.sync(batch_size=10)
+        self.assertEqual(self.mirror.find(), self.mockapi.entities)
+        filters = [c[2].get('filter') for c in self.mockapi.call.mock_calls]
+        self.assertEqual(filters[0], 'id > 10')
+
+    def test_prune(self):
+        self.mirror.sync()
+        deleted = self.mockapi.entities.pop(5)
+        del self.mockapi.entities[-1]
+        self.assertEqual(self.mirror.prune(batch_size=10), 2)
+        self.assertEqual(self.mirror.find(), self.mockapi.entities)
+        self.assertEqual(self.mirror.get(deleted['uuid']), None)
+
+    def test_queries(self):
+        self.mirror.sync()
+        entity = self.mockapi.entities[7]
+        city = entity['address']['city']
+        self.assertEqual(self.mirror.find("{address.city} = ?", [city]), [entity])
+        birthday = entity['birthday']
+        expected = [x for x in self.mockapi.entities if x['birthday'] < birthday]
+        self.assertEqual(self.mirror.count("{birthday} < ?", [birthday]), len(expected))
+        self.assertEqual(self.mirror.find(order_by="id DESC", limit=2), self.mockapi.entities[:-3:-1])
+        self.assertEqual(self.mirror.get(entity['id'], 'id'), entity)
+
+        # lookups on indexed attributes use the index
+        sql = "EXPLAIN QUERY PLAN SELECT data FROM records WHERE {} = ?".format(self.mirror.column('email'))
+        plan = self.mirror.connection.execute(sql, [entity['email']]).fetchall()
+        self.assertIn('index_email', plan[0][-1])
+
+        with self.assertRaises(InputError):
+            self.mirror.count("{email'} = 1")
+
+    def test_attributes(self):
+        self.mirror.close()
+        with self.assertRaises(InputError):
+            # a different set of attributes
+            self.records.mirror(self.path, attributes=['email'])
+        self.mirror = self.records.mirror(os.path.join(self.tmpdir, 'emails.sqlite'), attributes=['email'])
+        self.mirror.sync()
+        self.assertEqual(self.mirror.find(), [{'email': x['email'], 'id': x['id']} for x in self.mockapi.entities])
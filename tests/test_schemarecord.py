@@ -4,6 +4,7 @@ import unittest
 
 from janrain_datalib.app import App
 from janrain_datalib.schemarecord import SchemaRecord
+from janrain_datalib.utils import RecordBuilder
 from .mockapi import Mockapi
 
 class TestSchemaRecord(unittest.TestCase):
@@ -138,5 +139,20 @@ class TestSchemaRecord(unittest.TestCase):
             mock.call('entity.update', type_name=self.schema_name, key_attribute='uuid', key_value='"{}"'.format(self.uuid), attributes=expected_attributes)
         ]
 
+    def test_update_with_builder(self):
+        build = RecordBuilder({'balance': 'wallet.balance'}, {'balance': float})
+        self.record.update({'balance': '12.00', 'email': 'test@test.test'}, key_map=build)
+
+        expected_attributes = {
+            'wallet': {
+                'balance': 12.00,
+            },
+            'email': 'test@test.test',
+        }
+        calls = [
+            mock.call('entity.update', type_name=self.schema_name, key_attribute='uuid', key_value='"{}"'.format(self.uuid), attributes=expected_attributes)
+        ]
+        self.assertEqual(calls, self.mockapi.call.mock_calls)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,15 +1,41 @@
 """Tests for Schema."""
 from __future__ import unicode_literals
 import math
+import concurrent.futures
+import gzip
+import json
 import mock
+import os
+import re
+import shutil
+import tempfile
+import threading
 import time
 import unittest
 import io
 
+import janrain.capture
+import requests
+
 from janrain_datalib.app import App
+from janrain_datalib.concurrencycontroller import ConcurrencyController
+from janrain_datalib.exceptions import ApiError
+from janrain_datalib.exceptions import ApiAuthError
+from janrain_datalib.exceptions import ApiTooLargeError
+from janrain_datalib.exceptions import InputError
+from janrain_datalib.progress import Progress
+from janrain_datalib.utils import AdaptiveBatchSize
+from janrain_datalib.utils import json_array_bytes
+from janrain_datalib.utils import to_json_bytes
 from janrain_datalib.schemarecords import SchemaRecords
 from janrain_datalib.schemarecord import SchemaRecord
 from .mockapi import Mockapi
+from .mockapi import load_file
+from .mockapi import ProcessMockapi
+
+def payload(records):
+    """records as they are sent to entity.bulkCreate"""
+    return json_array_bytes([to_json_bytes(x) for x in records])
 
 class TestSchemaRecords(unittest.TestCase):
 
@@ -42,15 +68,71 @@ class TestSchemaRecords(unittest.TestCase):
         self.assertEqual(report[0], expected_result)
         self.assertEqual(report[12], expected_error)
 
+        # the batch failed, so it was split and the half with the
+        # duplicate was created record by record
         calls = [
             mock.call(
                 'entity.bulkCreate',
                 type_name=self.schema_name,
-                all_attributes=all_attributes,
-                commit_each='smart')
+                all_attributes=payload(all_attributes),
+                commit_each=False),
+            mock.call(
+                'entity.bulkCreate',
+                type_name=self.schema_name,
+                all_attributes=payload(all_attributes[:6]),
+                commit_each=False),
+            mock.call(
+                'entity.bulkCreate',
+                type_name=self.schema_name,
+                all_attributes=payload(all_attributes[6:]),
+                commit_each=False),
+            mock.call(
+                'entity.bulkCreate',
+                type_name=self.schema_name,
+                all_attributes=payload(all_attributes[6:]),
+                commit_each=True),
         ]
         self.assertEqual(calls, self.mockapi.call.mock_calls)
 
+    def test_create_smart(self):
+        num_records = 100
+        all_attributes = [{"email": "test{}@test.test".format(i)} for i in range(num_records)]
+        report = list(self.records.create(all_attributes, batch_size=50, concurrency=4))
+        self.assertEqual(len(report), num_records)
+        # results are in the same order as the records
+        failed = [i for i, result in enumerate(report) if 'error' in result]
+        self.assertEqual(failed, [12, 25, 38, 51, 64, 77, 90])
+        for i, result in enumerate(report):
+            if i not in failed:
+                self.assertEqual(result['uuid'], '00000000-0000-0000-0000-000000000000')
+
+        # the good records were created in bulk and only
+        # the small parts with a duplicate were created one by one
+        calls = self.mockapi.call.mock_calls
+        created = [c for c in calls if c[2]['commit_each'] is True]
+        self.assertEqual(sorted(len(json.loads(c[2]['all_attributes'])) for c in created), [6] * 7)
+
+    def test_create_smart_error(self):
+        # errors not caused by the records are not retried
+        self.mockapi.call.side_effect = ApiAuthError('forbidden', 403)
+        with self.assertRaises(ApiAuthError):
+            list(self.records.create([{"email": "test12@test.test"}]))
+        self.assertEqual(len(self.mockapi.call.mock_calls), 1)
+
+    def test_create_progress(self):
+        all_attributes = [{"email": "test{}@test.test".format(i)} for i in range(30)]
+        progress = Progress()
+        report = list(self.records.create(all_attributes, batch_size=15, progress=progress))
+        self.assertEqual(len(report), 30)
+        snapshot = progress.snapshot()
+        self.assertEqual(snapshot.total, 30)
+        self.assertEqual(snapshot.records, 30)
+        # each batch had a duplicate, so was split into parts
+        self.assertEqual(snapshot.pages, 4)
+        self.assertEqual(snapshot.retries, 4)
+        self.assertEqual(snapshot.errors, 2)
+        self.assertTrue(snapshot.done)
+
     def test_create_batches(self):
         def record_generator(num_records):
             for i in range(num_records):
@@ -65,9 +147,228 @@ class TestSchemaRecords(unittest.TestCase):
             concurrency=concurrency))
         self.assertEqual(len(report), num_records)
 
-        num_calls = math.ceil(num_records / batch_size)
+        # and the batch with a duplicate was retried
+        num_calls = math.ceil(num_records / batch_size) + 1
         self.assertEqual(num_calls, len(self.mockapi.call.mock_calls))
 
+    def test_create_batch_bytes(self):
+        # sizes vary by a lot
+        all_attributes = [
+            {"email": "test{}@test.test".format(i), "aboutMe": "x" * (10 if i % 2 else 500)}
+            for i in range(40) if (i + 1) % 13  # no duplicates
+        ]
+        with mock.patch('janrain_datalib.schemarecords.to_json_bytes', wraps=to_json_bytes) as encode:
+            report = list(self.records.create(all_attributes, batch_bytes=2000, batch_size=10))
+        self.assertEqual(len(report), len(all_attributes))
+        # each record was serialized only once
+        self.assertEqual(encode.call_count, len(all_attributes))
+
+        sent = [c[2]['all_attributes'] for c in self.mockapi.call.mock_calls]
+        self.assertTrue(all(len(data) <= 2000 for data in sent))
+        batches = [json.loads(data.decode('utf-8')) for data in sent]
+        self.assertEqual([r for batch in batches for r in batch], all_attributes)
+        self.assertTrue(all(len(batch) <= 10 for batch in batches))
+        # closed by size, not just by count
+        self.assertTrue(any(len(batch) < 10 for batch in batches[:-1]))
+
+        # a record larger than the limit goes in a batch of its own
+        self.mockapi.call.reset_mock()
+        list(self.records.create(all_attributes[:3], batch_bytes=100))
+        sizes = [len(json.loads(c[2]['all_attributes'].decode('utf-8'))) for c in self.mockapi.call.mock_calls]
+        self.assertEqual(sizes, [1, 1, 1])
+
+    def test_create_too_large(self):
+        call_side_effect = self.mockapi.call.side_effect
+
+        def mock_call(cmd, **kwargs):
+            if len(kwargs['all_attributes']) > 800:
+                response = requests.Response()
+                response.status_code = 413
+                response._content = b'request entity too large'
+                raise requests.exceptions.HTTPError(response=response)
+            return call_side_effect(cmd, **kwargs)
+        self.mockapi.call.side_effect = mock_call
+
+        num_records = 400
+        all_attributes = [{"email": "test{}@test.test".format(i)} for i in range(num_records)]
+        progress = Progress()
+        report = list(self.records.create(all_attributes, mode='each', batch_size=50, progress=progress))
+        self.assertEqual(len(report), num_records)
+        # results are in the same order as the records
+        failed = [i for i, result in enumerate(report) if 'error' in result]
+        self.assertEqual(failed, [i for i in range(num_records) if (i + 1) % 13 == 0])
+
+        sent = [c[2]['all_attributes'] for c in self.mockapi.call.mock_calls]
+        created = [json.loads(data.decode('utf-8')) for data in sent if len(data) <= 800]
+        self.assertEqual(sorted(r['email'] for batch in created for r in batch),
+                         sorted(r['email'] for r in all_attributes))
+        # the batches built after a split are no larger than the halves
+        self.assertTrue(len(sent[-1]) <= max(len(data) for data in sent) // 2)
+        self.assertEqual(progress.snapshot().retries, len(sent) - len(created))
+
+    def test_create_too_large_record(self):
+        call_side_effect = self.mockapi.call.side_effect
+
+        def mock_call(cmd, **kwargs):
+            if b'large' in kwargs['all_attributes']:
+                raise ApiTooLargeError('too large', 413)
+            return call_side_effect(cmd, **kwargs)
+        self.mockapi.call.side_effect = mock_call
+
+        records = [{"email": "user{}@test.test".format(i)} for i in range(4)]
+        records[1]['aboutMe'] = 'large'
+        progress = Progress()
+        report = list(self.records.create(records, progress=progress))
+        # split down to the single record, which fails on its own
+        self.assertEqual([result.get('code') for result in report], [None, 413, None, None])
+        self.assertEqual(report[1]['error'], 'request_too_large')
+        self.assertEqual(progress.snapshot().errors, 1)
+        sizes = [len(json.loads(c[2]['all_attributes'])) for c in self.mockapi.call.mock_calls]
+        self.assertEqual(sizes[:3], [4, 2, 2])
+
+    def test_create_gateway_error(self):
+        response = requests.Response()
+        response.status_code = 502
+        self.mockapi.call.side_effect = requests.exceptions.HTTPError(response=response)
+        # not taken for a batch that is too large or has a bad record
+        with self.assertRaises(ApiError) as cm:
+            list(self.records.create([{"email": "test0@test.test"}, {"email": "test1@test.test"}]))
+        self.assertNotIsInstance(cm.exception, ApiTooLargeError)
+        self.assertEqual(len(self.mockapi.call.mock_calls), 1)
+
+    def test_create_concurrency_controller(self):
+        self.app.controller = ConcurrencyController(initial=2, maximum=3)
+        call_side_effect = self.mockapi.call.side_effect
+        lock = threading.Lock()
+        counts = {'in_flight': 0, 'most': 0}
+
+        def mock_call(cmd, **kwargs):
+            with lock:
+                counts['in_flight'] += 1
+                counts['most'] = max(counts['most'], counts['in_flight'])
+            time.sleep(0.01)
+            with lock:
+                counts['in_flight'] -= 1
+            return call_side_effect(cmd, **kwargs)
+        self.mockapi.call.side_effect = mock_call
+
+        num_records = 60
+        all_attributes = [{"email": "test{}@test.test".format(i)} for i in range(num_records)]
+        report = list(self.records.create(all_attributes, mode='each', batch_size=2, concurrency=8))
+        self.assertEqual(len(report), num_records)
+        # fewer than the 8 workers asked for, within the controller's maximum
+        self.assertTrue(1 < counts['most'] <= 3)
+        self.assertEqual(self.app.controller.limit, 3)
+
+        # the controller does not add workers
+        counts['most'] = 0
+        list(self.records.create(all_attributes[:20], mode='each', batch_size=2))
+        self.assertEqual(counts['most'], 1)
+
+    def test_create_dedupe(self):
+        emails = ['user1', 'user2', 'user1', 'user3', 'user2', 'user4', None, None]
+        all_attributes = [{'email': email and email + '@test.test'} for email in emails]
+        progress = Progress()
+        report = list(self.records.create(
+            all_attributes, mode='all', dedupe=[['email']], progress=progress))
+
+        duplicate = {
+            'code': 361,
+            'error': 'unique_violation',
+            'error_description': 'Attempted to update a duplicate value',
+            'stat': 'error',
+        }
+        self.assertEqual([x == duplicate for x in report],
+                         [False, False, True, False, True, False, False, False])
+        unique = [all_attributes[i] for i in [0, 1, 3, 5, 6, 7]]
+        calls = [
+            mock.call('entity.bulkCreate', type_name=self.schema_name,
+                      all_attributes=payload(unique), commit_each=False)
+        ]
+        self.assertEqual(calls, self.mockapi.call.mock_calls)
+        snapshot = progress.snapshot()
+        self.assertEqual((snapshot.records, snapshot.errors), (8, 2))
+
+    def test_create_dedupe_rules(self):
+        all_attributes = [
+            {'givenName': 'a', 'familyName': 'b'},
+            {'givenName': 'a', 'familyName': 'c'},
+            {'givenName': 'a', 'familyName': 'b'},
+            {'givenName': 'a', 'familyName': 'b'},
+        ]
+        report = list(self.records.create(all_attributes, dedupe=True, batch_size=1))
+
+        self.assertEqual(['error' in x for x in report], [False, False, True, True])
+        creates = [c for c in self.mockapi.call.mock_calls if c[1][0] == 'entity.bulkCreate']
+        self.assertEqual([c[2]['all_attributes'] for c in creates],
+                         [payload(all_attributes[:1]), payload(all_attributes[1:2])])
+        self.assertIn(mock.call('entityType.properties', type_name=self.schema_name),
+                      self.mockapi.call.mock_calls)
+
+    def test_create_dedupe_constraints(self):
+        # email has a 'unique' constraint in the schema
+        all_attributes = [
+            {'email': 'test1@test.test'},
+            {'email': 'user1@test.test'},
+            {'email': 'user1@test.test'},
+        ]
+        report = list(self.records.create(all_attributes, dedupe=True, check_existing=True))
+
+        self.assertEqual([x.get('error') for x in report],
+                         ['unique_violation', None, 'unique_violation'])
+        creates = [c for c in self.mockapi.call.mock_calls if c[1][0] == 'entity.bulkCreate']
+        self.assertEqual([c[2]['all_attributes'] for c in creates], [payload(all_attributes[1:2])])
+
+    def test_create_dedupe_failed(self):
+        call_side_effect = self.mockapi.call.side_effect
+        invalid = {
+            'code': 200,
+            'error': 'invalid_argument',
+            'error_description': 'bad value',
+            'stat': 'error',
+        }
+        def mock_call(cmd, **kwargs):
+            r = call_side_effect(cmd, **kwargs)
+            batch = json.loads(kwargs['all_attributes'].decode('utf-8'))
+            for i, record in enumerate(batch):
+                if record.get('aboutMe') == 'bad':
+                    r['results'][i] = invalid.copy()
+                    r['uuid_results'][i] = invalid.copy()
+            return r
+        self.mockapi.call.side_effect = mock_call
+
+        all_attributes = [
+            {'email': 'user1@test.test', 'aboutMe': 'bad'},
+            {'email': 'user1@test.test', 'aboutMe': 'good'},
+            {'email': 'user2@test.test'},
+            {'email': 'user1@test.test', 'aboutMe': 'again'},
+        ]
+        report = list(self.records.create(all_attributes, dedupe=[['email']]))
+
+        self.assertEqual(report[0], invalid)
+        # not a duplicate of the record that failed, so it was created
+        self.assertEqual(report[1]['uuid'], '00000000-0000-0000-0000-000000000000')
+        self.assertEqual(report[2]['uuid'], '00000000-0000-0000-0000-000000000000')
+        self.assertEqual(report[3]['error'], 'unique_violation')
+        self.assertEqual([c[2]['all_attributes'] for c in self.mockapi.call.mock_calls], [
+            payload([all_attributes[0], all_attributes[2]]), payload([all_attributes[1]])])
+
+    def test_create_dedupe_existing(self):
+        all_attributes = [{'email': 'test1@test.test'}, {'email': 'user1@test.test'}]
+        report = list(self.records.create(
+            all_attributes, dedupe=[['email'], ['givenName', 'familyName']],
+            check_existing=True))
+
+        self.assertEqual(report[0]['error'], 'unique_violation')
+        self.assertEqual(report[1]['uuid'], '00000000-0000-0000-0000-000000000000')
+        calls = [
+            mock.call('entity.find', type_name=self.schema_name, attributes=['email'],
+                      max_results=2, filter="email = 'test1@test.test' or email = 'user1@test.test'"),
+            mock.call('entity.bulkCreate', type_name=self.schema_name,
+                      all_attributes=payload(all_attributes[1:]), commit_each=False),
+        ]
+        self.assertEqual(calls, self.mockapi.call.mock_calls)
+
     def test_create_batches_error(self):
         def record_generator(num_records):
             for i in range(num_records):
@@ -99,7 +400,7 @@ class TestSchemaRecords(unittest.TestCase):
             mock.call(
                 'entity.bulkCreate',
                 type_name=self.schema_name,
-                all_attributes=all_attributes,
+                all_attributes=payload(all_attributes),
                 commit_each=True)
         ]
         self.assertEqual(calls, self.mockapi.call.mock_calls)
@@ -112,11 +413,274 @@ class TestSchemaRecords(unittest.TestCase):
             mock.call(
                 'entity.bulkCreate',
                 type_name=self.schema_name,
-                all_attributes=all_attributes,
+                all_attributes=payload(all_attributes),
                 commit_each=False)
         ]
         self.assertEqual(calls, self.mockapi.call.mock_calls)
 
+    def test_import_csv(self):
+        lines = ['mail,city']
+        for i in range(30):
+            lines.append('user{}@test.test,city{}'.format(i, i))
+        lines[5] = 'user4@test.test,"city\n4"'
+        fp = io.StringIO('\n'.join(lines) + '\n')
+        key_map = {'mail': 'email', 'city': 'address.city'}
+        progress = Progress()
+        results = list(self.records.import_csv(
+            fp, key_map, mode='all', batch_size=10, chunk_size=7, progress=progress))
+
+        # the row with a newline takes up two lines
+        line_nums = list(range(2, 6)) + list(range(7, 33))
+        self.assertEqual([line_num for line_num, _ in results], line_nums)
+        records = [
+            {'email': 'user{}@test.test'.format(i), 'address': {'city': 'city{}'.format(i)}}
+            for i in range(30)
+        ]
+        records[4]['address']['city'] = 'city\n4'
+        calls = [
+            mock.call('entity.bulkCreate', type_name=self.schema_name,
+                      all_attributes=payload(records[i:i + 10]), commit_each=False)
+            for i in range(0, 30, 10)
+        ]
+        self.assertEqual(calls, self.mockapi.call.mock_calls)
+        self.assertEqual(progress.snapshot().records, 30)
+        self.assertTrue(progress.snapshot().done)
+
+    def test_import_csv_smart(self):
+        lines = ['email,givenName'] + [
+            'test{}@test.test,name{}'.format(i, i) for i in range(30)]
+        fp = io.StringIO('\n'.join(lines) + '\n')
+        transform_map = {'givenName': str.upper}
+        results = list(self.records.import_csv(
+            fp, transform_map=transform_map, batch_size=15, concurrency=2, processes=2))
+
+        self.assertEqual([line_num for line_num, _ in results], list(range(2, 32)))
+        errors = [line_num for line_num, result in results if 'error' in result]
+        # test12 and test25 are duplicates
+        self.assertEqual(errors, [14, 27])
+        creates = [c for c in self.mockapi.call.mock_calls if c[1][0] == 'entity.bulkCreate']
+        self.assertIn(b'"NAME0"', creates[0][2]['all_attributes'])
+
+    def test_update_many(self):
+        call_side_effect = self.mockapi.call.side_effect
+        def mock_call(cmd, **kwargs):
+            if kwargs.get('key_value') == '"missing"':
+                raise janrain.capture.ApiResponseError(
+                    310, 'record_not_found', 'record not found', {})
+            return call_side_effect(cmd, **kwargs)
+        self.mockapi.call.side_effect = mock_call
+
+        updates = [(str(i), {'givenName': 'name{}'.format(i)}) for i in range(20)]
+        updates[7] = ('missing', {'givenName': 'nobody'})
+        progress = Progress()
+        results = list(self.records.update_many(updates, concurrency=4, progress=progress))
+
+        expected = [{'stat': 'ok'}] * 20
+        expected[7] = {
+            'code': 310,
+            'error': 'record_not_found',
+            'error_description': 'record not found',
+            'stat': 'error',
+        }
+        self.assertEqual(results, list(zip([update[0] for update in updates], expected)))
+        self.assertEqual(len(self.mockapi.call.mock_calls), 20)
+        self.assertIn(
+            mock.call('entity.update', type_name=self.schema_name, key_attribute='uuid',
+                      key_value='"3"', attributes={'givenName': 'name3'}),
+            self.mockapi.call.mock_calls)
+        snapshot = progress.snapshot()
+        self.assertEqual(snapshot.records, 20)
+        self.assertEqual(snapshot.errors, 1)
+        self.assertEqual(snapshot.total, 20)
+        self.assertTrue(snapshot.done)
+
+    def test_update_many_with_maps(self):
+        key_map = {'name': 'givenName'}
+        transform_map = {'name': lambda x: x.upper()}
+        updates = iter([('test@test.test', {'name': 'bob'})])
+        results = list(self.records.update_many(
+            updates, id_attribute='email', key_map=key_map, transform_map=transform_map))
+
+        self.assertEqual(results, [('test@test.test', {'stat': 'ok'})])
+        calls = [
+            mock.call('entity.update', type_name=self.schema_name, key_attribute='email',
+                      key_value='"test@test.test"', attributes={'givenName': 'BOB'})
+        ]
+        self.assertEqual(calls, self.mockapi.call.mock_calls)
+
+    def test_update_many_transform_map(self):
+        transform_map = {'givenName': lambda x: x.upper()}
+        updates = iter([('a', {'givenName': 'bob'})])
+        results = list(self.records.update_many(updates, transform_map=transform_map))
+
+        self.assertEqual(results, [('a', {'stat': 'ok'})])
+        calls = [
+            mock.call('entity.update', type_name=self.schema_name, key_attribute='uuid',
+                      key_value='"a"', attributes={'givenName': 'BOB'})
+        ]
+        self.assertEqual(calls, self.mockapi.call.mock_calls)
+
+    def test_update_many_auth_error(self):
+        self.mockapi.call.side_effect = ApiAuthError('forbidden', 403)
+        updates = [(str(i), {'givenName': 'x'}) for i in range(5)]
+        with self.assertRaises(ApiAuthError):
+            list(self.records.update_many(updates, concurrency=2))
+
+    def test_delete_many(self):
+        results = list(self.records.delete_many(['a', 'b', 'c'], concurrency=2))
+
+        self.assertEqual(results, [(x, {'stat': 'ok'}) for x in ['a', 'b', 'c']])
+        calls = [
+            mock.call('entity.delete', type_name=self.schema_name, key_attribute='uuid',
+                      key_value='"{}"'.format(x))
+            for x in ['a', 'b', 'c']
+        ]
+        self.assertEqual(calls, self.mockapi.call.mock_calls)
+
+    def test_delete_many_filtering(self):
+        progress = Progress(total=25)
+        results = list(self.records.delete_many(
+            filtering='id <= 25', batch_size=10, concurrency=4, progress=progress))
+
+        uuids = [x['uuid'] for x in self.mockapi.entities[:25]]
+        self.assertEqual(results, [(x, {'stat': 'ok'}) for x in uuids])
+        deletes = [c for c in self.mockapi.call.mock_calls if c[1][0] == 'entity.delete']
+        self.assertEqual(
+            [c[2]['key_value'] for c in deletes], ['"{}"'.format(x) for x in uuids])
+        finds = [c for c in self.mockapi.call.mock_calls if c[1][0] == 'entity.find']
+        self.assertEqual(len(finds), 4)
+        self.assertEqual(finds[0][2]['attributes'], ['uuid', 'id'])
+        self.assertEqual(progress.snapshot().records, 25)
+
+    def test_delete_many_input_error(self):
+        with self.assertRaises(InputError):
+            self.records.delete_many()
+        with self.assertRaises(InputError):
+            self.records.delete_many(['a'], filtering='id > 1')
+
+    def test_upsert_many(self):
+        records = [
+            {'email': 'test1@test.test', 'givenName': 'a'},
+            {'email': 'new1@test.test', 'givenName': 'b'},
+            {'givenName': 'c'},
+            {'email': 'test5@test.test', 'givenName': 'd'},
+            {'email': "o'new@test.test", 'givenName': 'e'},
+        ]
+        progress = Progress()
+        results = list(self.records.upsert_many(
+            records, batch_size=2, concurrency=2, progress=progress))
+
+        entities = self.mockapi.entities
+        self.assertEqual(results, [
+            {'id': entities[0]['id'], 'uuid': entities[0]['uuid'], 'created': False},
+            {'id': 44, 'uuid': '00000000-0000-0000-0000-000000000000', 'created': True},
+            {'id': 44, 'uuid': '00000000-0000-0000-0000-000000000000', 'created': True},
+            {'id': entities[4]['id'], 'uuid': entities[4]['uuid'], 'created': False},
+            {'id': 44, 'uuid': '00000000-0000-0000-0000-000000000000', 'created': True},
+        ])
+        finds = [c for c in self.mockapi.call.mock_calls if c[1][0] == 'entity.find']
+        self.assertEqual([c[2]['filter'] for c in finds], [
+            "email = 'test1@test.test' or email = 'new1@test.test'",
+            "email = 'test5@test.test'",
+            "email = 'o\\'new@test.test'",
+        ])
+        self.assertIn(
+            mock.call('entity.update', type_name=self.schema_name, key_attribute='uuid',
+                      key_value='"{}"'.format(entities[4]['uuid']), attributes=records[3]),
+            self.mockapi.call.mock_calls)
+        creates = [c for c in self.mockapi.call.mock_calls if c[1][0] == 'entity.bulkCreate']
+        self.assertEqual([c[2]['all_attributes'] for c in creates], [
+            payload(records[1:2]), payload(records[2:3]), payload(records[4:5])])
+        self.assertEqual(progress.snapshot().records, 5)
+        self.assertEqual(progress.snapshot().total, 5)
+
+    def test_upsert_many_repeated_keys(self):
+        records = [
+            {'email': 'new1@test.test', 'givenName': 'a'},
+            {'email': 'test1@test.test', 'givenName': 'b'},
+            {'email': 'new1@test.test', 'givenName': 'c'},
+            {'email': 'test1@test.test', 'givenName': 'd'},
+            {'email': 'new2@test.test', 'givenName': 'e'},
+            {'email': 'new2@test.test', 'givenName': 'f'},
+        ]
+        results = list(self.records.upsert_many(records, batch_size=5, concurrency=4))
+
+        new = {'id': 44, 'uuid': '00000000-0000-0000-0000-000000000000'}
+        found = {'id': self.mockapi.entities[0]['id'], 'uuid': self.mockapi.entities[0]['uuid']}
+        self.assertEqual(results, [
+            dict(new, created=True),
+            dict(found, created=False),
+            # an update of the record created for the same key
+            dict(new, created=False),
+            dict(found, created=False),
+            dict(new, id=45, created=True),
+            # in the next group, which was looked up before the record was created
+            dict(new, id=45, created=False),
+        ])
+        creates = [c for c in self.mockapi.call.mock_calls if c[1][0] == 'entity.bulkCreate']
+        self.assertEqual([c[2]['all_attributes'] for c in creates], [
+            payload([records[0], records[4]])])
+        updates = [c[2] for c in self.mockapi.call.mock_calls if c[1][0] == 'entity.update']
+        # each after the one before it for the same record
+        self.assertEqual([u['attributes']['givenName'] for u in updates], ['b', 'c', 'd', 'f'])
+        self.assertEqual(updates[1]['key_value'], '"{}"'.format(new['uuid']))
+
+    def test_upsert_many_update_error(self):
+        call_side_effect = self.mockapi.call.side_effect
+        def mock_call(cmd, **kwargs):
+            if cmd == 'entity.update':
+                raise janrain.capture.ApiResponseError(
+                    200, 'invalid_argument', 'bad value', {})
+            return call_side_effect(cmd, **kwargs)
+        self.mockapi.call.side_effect = mock_call
+
+        results = list(self.records.upsert_many([{'email': 'test2@test.test'}]))
+        self.assertEqual(results, [{
+            'code': 200,
+            'error': 'invalid_argument',
+            'error_description': 'bad value',
+            'stat': 'error',
+            'created': False,
+        }])
+
+    def test_get_many(self):
+        entities = self.mockapi.entities
+        uuids = [x['uuid'] for x in entities[:10]]
+        uuids.insert(3, 'missing')
+        progress = Progress()
+        results = list(self.records.get_many(
+            uuids, attributes=['email'], batch_size=4, concurrency=3, progress=progress))
+
+        expected = [(x['uuid'], {'email': x['email']}) for x in entities[:10]]
+        expected.insert(3, ('missing', None))
+        self.assertEqual(results, expected)
+        self.assertEqual(len(self.mockapi.call.mock_calls), 3)
+        for c in self.mockapi.call.mock_calls:
+            self.assertEqual(c[2]['attributes'], ['email', 'uuid'])
+        snapshot = progress.snapshot()
+        self.assertEqual((snapshot.records, snapshot.pages, snapshot.errors), (11, 3, 1))
+
+    def test_get_many_by_email(self):
+        emails = ['test2@test.test', 'test1@test.test', 'test2@test.test']
+        results = list(self.records.get_many(iter(emails), id_attribute='email'))
+
+        entities = self.mockapi.entities
+        self.assertEqual(results, [
+            (emails[0], entities[1]), (emails[1], entities[0]), (emails[2], entities[1])])
+        calls = [
+            mock.call('entity.find', type_name=self.schema_name, max_results=2,
+                      filter="email = 'test2@test.test' or email = 'test1@test.test'")
+        ]
+        self.assertEqual(calls, self.mockapi.call.mock_calls)
+
+    def test_key_groups(self):
+        values = ['x' * 1000] * 10
+        groups = list(self.records._key_groups(values, 'email'))
+        # the filters stay under the length limit
+        self.assertEqual([len(group) for group in groups], [3, 3, 3, 1])
+        groups = list(self.records._key_groups(range(10), 'id', batch_size=4))
+        self.assertEqual(groups, [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+
     def test_delete(self):
         self.records.delete()
 
@@ -187,15 +751,378 @@ class TestSchemaRecords(unittest.TestCase):
 
         self.assertEqual(calls, self.mockapi.call.mock_calls)
 
+    def test_iterator_prefetch(self):
+        records = list(self.records.iterator(batch_size=5, prefetch=2))
+        self.assertEqual(records, self.mockapi.entities)
+        # same paging calls as without prefetching
+        filters = [c[2]['filter'] for c in self.mockapi.call.mock_calls]
+        expected = ['id > {}'.format(i) for i in range(0, 44, 5)] + ['id > 43']
+        self.assertEqual(filters, expected)
+
+    def test_iterator_stream(self):
+        self.mockapi.sign_requests = False
+        with mock.patch('requests.post', side_effect=self.mockapi.post):
+            records = list(self.records.iterator(['email'], batch_size=10, stream=True))
+        self.assertEqual(records, [{'email': x['email']} for x in self.mockapi.entities])
+        # same paging calls as without streaming
+        filters = [c[2]['filter'] for c in self.mockapi.call.mock_calls]
+        expected = ['id > {}'.format(i) for i in range(0, 44, 10)] + ['id > 43']
+        self.assertEqual(filters, expected)
+
+        with self.assertRaises(InputError):
+            self.records.iterator(batch_size=10, prefetch=1, stream=True)
+        with self.assertRaises(InputError):
+            self.records.iterator(batch_size='auto', stream=True)
+
+    def test_iterator_progress(self):
+        call_side_effect = self.mockapi.call.side_effect
+        timeouts = []
+
+        def mock_call(cmd, **kwargs):
+            if cmd == 'entity.find' and not timeouts:
+                timeouts.append(kwargs)
+                raise janrain.capture.ApiResponseError(504, 'timeout', 'timed out', {})
+            return call_side_effect(cmd, **kwargs)
+        self.mockapi.call.side_effect = mock_call
+
+        progress = Progress(total=100)
+        records = self.records.iterator(batch_size=10, progress=progress)
+        self.assertEqual(next(records), self.mockapi.entities[0])
+        snapshot = progress.snapshot()
+        # counted as consumed, not as fetched
+        self.assertEqual((snapshot.records, snapshot.pages, snapshot.retries), (1, 1, 1))
+        self.assertEqual(snapshot.total, 100)
+        self.assertFalse(snapshot.done)
+        list(records)
+        snapshot = progress.snapshot()
+        self.assertEqual(snapshot.records, len(self.mockapi.entities))
+        self.assertTrue(snapshot.done)
+        # total was given, so not counted
+        self.assertNotIn('entity.count', [c[1][0] for c in self.mockapi.call.mock_calls])
+
+    def test_iterator_progress_prefetch(self):
+        progress = Progress()
+        records = self.records.iterator(batch_size=10, prefetch=2, progress=progress)
+        # nothing is counted until the first record is requested
+        self.assertEqual(self.mockapi.call.mock_calls, [])
+        next(records)
+        self.assertEqual(self.mockapi.call.mock_calls[0][1], ('entity.count',))
+        next(records)
+        time.sleep(0.1)
+        snapshot = progress.snapshot()
+        # fetched ahead, but only two were consumed
+        self.assertEqual(snapshot.records, 2)
+        self.assertTrue(snapshot.pages > 1)
+        records.close()
+
+    def test_iterator_stream_progress(self):
+        self.mockapi.sign_requests = False
+        progress = Progress()
+        with mock.patch('requests.post', side_effect=self.mockapi.post):
+            records = list(self.records.iterator(batch_size=10, stream=True, progress=progress))
+        snapshot = progress.snapshot()
+        self.assertEqual(snapshot.records, len(records))
+        self.assertEqual(snapshot.total, len(records))
+        self.assertEqual(snapshot.bytes, sum(len(r.content) for r in self.mockapi.responses))
+
+    def test_iterator_adaptive(self):
+        call_side_effect = self.mockapi.call.side_effect
+
+        def mock_call(cmd, **kwargs):
+            if kwargs['max_results'] > 8:
+                response = requests.Response()
+                response.status_code = 413
+                response._content = b'request too large'
+                raise requests.exceptions.HTTPError(response=response)
+            return call_side_effect(cmd, **kwargs)
+        self.mockapi.call.side_effect = mock_call
+
+        batch_size = AdaptiveBatchSize(initial=32)
+        records = list(self.records.iterator(batch_size=batch_size))
+        self.assertEqual(records, self.mockapi.entities)
+        sizes = [c[2]['max_results'] for c in self.mockapi.call.mock_calls]
+        # shrunk on each too large error without retrying the same size
+        self.assertEqual(sizes[:3], [32, 16, 8])
+        self.assertTrue(all(b <= a for a, b in zip(sizes, sizes[1:3])))
+
+    def test_iterator_adaptive_fail(self):
+        self.mockapi.call.side_effect = ApiTooLargeError('too large', 413)
+        with self.assertRaises(ApiTooLargeError):
+            list(self.records.iterator(batch_size=AdaptiveBatchSize(initial=4)))
+        # 4, 2, 1 and then gave up
+        self.assertEqual(len(self.mockapi.call.mock_calls), 3)
+
+    def test_iter_pages(self):
+        pages = list(self.records.iter_pages(attributes=['uuid'], batch_size=10))
+        self.assertEqual([len(page.records) for page in pages], [10, 10, 10, 10, 3])
+        self.assertEqual([(page.first_id, page.last_id) for page in pages],
+                         [(1, 10), (11, 20), (21, 30), (31, 40), (41, 43)])
+        for page in pages:
+            self.assertGreaterEqual(page.elapsed, 0)
+            # id is kept for page consumers
+            self.assertEqual(set(page.records[0]), {'uuid', 'id'})
+        self.assertEqual(len(self.mockapi.call.mock_calls), 6)
+
+        # an id range
+        pages = list(self.records.iter_pages(['uuid'], batch_size=10, start_id=15, end_id=30))
+        self.assertEqual([(page.first_id, page.last_id) for page in pages], [(16, 25), (26, 30)])
+        # no empty page is asked for once the end of the range is reached
+        self.assertEqual(len(self.mockapi.call.mock_calls), 8)
+
+    def test_resumable_iterator(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        checkpoint_path = os.path.join(tmp_dir, 'checkpoint.json')
+        attributes = ['uuid']
+
+        # stop part way through the third batch
+        seen = []
+        records = self.records.resumable_iterator(checkpoint_path, attributes, batch_size=5)
+        for record in records:
+            seen.append(record['uuid'])
+            if len(seen) == 12:
+                break
+        records.close()
+
+        # restart: the last record received was not consumed (the next one
+        # was never requested), so it is yielded again and nothing else is
+        progress = Progress()
+        resumed = [r['uuid'] for r in self.records.resumable_iterator(
+            checkpoint_path, attributes, batch_size=5, progress=progress)]
+        expected = [e['uuid'] for e in self.mockapi.entities]
+        self.assertEqual(seen[:11] + resumed, expected)
+        # the total is what remained
+        snapshot = progress.snapshot()
+        self.assertEqual((snapshot.records, snapshot.total), (len(resumed), len(resumed)))
+
+        # finished
+        self.assertEqual(list(self.records.resumable_iterator(checkpoint_path, attributes)), [])
+
+        # different iteration
+        with self.assertRaises(InputError):
+            next(self.records.resumable_iterator(checkpoint_path, ['email']))
+
+    def test_csv_iterator_checkpoint(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        checkpoint_path = os.path.join(tmp_dir, 'checkpoint.json')
+        attributes = ['uuid', 'email', 'address.city', 'aboutMe', 'lastUpdated', 'adlists']
+
+        csv_file = io.StringIO(newline=None)
+        rows = self.records.csv_iterator(attributes, batch_size=10, checkpoint_path=checkpoint_path)
+        for i, row in enumerate(rows):
+            if i == 25:
+                break
+            csv_file.write(row)
+        # stopped in the middle of the third batch
+        rows.close()
+
+        for row in self.records.csv_iterator(attributes, batch_size=10, checkpoint_path=checkpoint_path):
+            csv_file.write(row)
+        expected = load_file('test_csv_iterator.csv')
+        self.assertEqual(csv_file.getvalue(), expected)
+
+    def test_csv_iterator_missing(self):
+        # nested attribute of a null object
+        pages = [[{'id': 1, 'uuid': 'a', 'address': None}], []]
+        self.mockapi.call.side_effect = lambda cmd, **kwargs: {'results': pages.pop(0), 'stat': 'ok'}
+        rows = list(self.records.csv_iterator(['uuid', 'address.city']))
+        self.assertEqual(rows, ['uuid,address.city\r\n', 'a,\r\n'])
+
+    def test_parallel_iterator(self):
+        ids = [entity['id'] for entity in self.records.parallel_iterator(
+            partitions=4, concurrency=2, batch_size=5)]
+        self.assertEqual(ids, [entity['id'] for entity in self.mockapi.entities])
+
+        # the id span is looked up once
+        find_calls = [c for c in self.mockapi.call.mock_calls if c[2]['max_results'] == 1]
+        self.assertEqual(len(find_calls), 2)
+        # every range is bounded on both ends
+        for c in self.mockapi.call.mock_calls:
+            if c[2]['max_results'] == 5:
+                self.assertRegex(c[2]['filter'], r'^id > \d+ and id <= \d+$')
+
+    def test_parallel_iterator_close(self):
+        records = self.records.parallel_iterator(partitions=8, concurrency=2, batch_size=2)
+        next(records)
+        records.close()
+        # only the ranges already being fetched made calls
+        ends = set()
+        for c in self.mockapi.call.mock_calls:
+            found = re.search(r'id <= (\d+)', c[2].get('filter', ''))
+            if found:
+                ends.add(found.group(1))
+        self.assertLessEqual(len(ends), 2)
+
+    def test_parallel_iterator_unordered(self):
+        records = list(self.records.parallel_iterator(
+            attributes=['uuid'], partitions=5, concurrency=3, batch_size=4, ordered=False))
+        self.assertEqual(
+            sorted(record['uuid'] for record in records),
+            sorted(entity['uuid'] for entity in self.mockapi.entities))
+        # id was not asked for
+        self.assertTrue(all('id' not in record for record in records))
+
+    def test_parallel_iterator_filtering(self):
+        filtering = "lastUpdated > '2001-01-01'"
+        list(self.records.parallel_iterator(partitions=2, filtering=filtering))
+        for c in self.mockapi.call.mock_calls:
+            self.assertTrue(c[2]['filter'].startswith(filtering))
+
+    def test_parallel_iterator_error(self):
+        def mock_call(cmd, **kwargs):
+            if kwargs['max_results'] == 1:
+                return {'results': [{'id': 1}], 'stat': 'ok'}
+            raise Exception('error')
+        self.mockapi.call = mock.Mock(side_effect=mock_call)
+        try:
+            list(self.records.parallel_iterator(batch_size=5))
+        except Exception:
+            pass  # expection
+        else:
+            self.fail("Error not raised on exception")
+
     def test_csv_iterator(self):
         csv_file = io.StringIO(newline=None)
         attributes = ['uuid', 'email', 'address.city', 'aboutMe', 'lastUpdated', 'adlists']
         for record in self.records.csv_iterator(attributes):
             csv_file.write(record)
-        from .mockapi import load_file
         expected = load_file('test_csv_iterator.csv')
         self.assertEqual(csv_file.getvalue(), expected)
 
+    def test_csv_iterator_progress(self):
+        snapshots = []
+        progress = Progress(callback=snapshots.append, interval=0)
+        rows = list(self.records.csv_iterator(['uuid'], batch_size=10, progress=progress))
+        self.assertEqual(len(rows), len(self.mockapi.entities) + 1)
+        total = len(self.mockapi.entities)
+        # counted first
+        self.assertEqual(self.mockapi.call.mock_calls[0][1], ('entity.count',))
+        counts = [s.records for s in snapshots]
+        self.assertEqual(counts, sorted(counts))
+        self.assertEqual(counts[-1], total)
+        self.assertEqual(snapshots[0].total, total)
+        self.assertEqual(snapshots[-1].pages, 6)
+        self.assertTrue(snapshots[-1].bytes > 0)
+        self.assertTrue(snapshots[-1].done)
+
+    def test_export_csv(self):
+        expected = load_file('test_csv_iterator.csv')
+        attributes = ['uuid', 'email', 'address.city', 'aboutMe', 'lastUpdated', 'adlists']
+
+        csv_file = io.StringIO(newline='')
+        count = self.records.export_csv(csv_file, attributes, batch_size=10)
+        self.assertEqual(count, len(self.mockapi.entities))
+        self.assertEqual(csv_file.getvalue().replace('\r\n', '\n'), expected)
+
+        csv_file = io.BytesIO()
+        self.records.export_csv(csv_file, attributes, batch_size=10)
+        # file is left open
+        self.assertEqual(csv_file.getvalue().decode('utf-8').replace('\r\n', '\n'), expected)
+
+    def test_export_csv_checkpoint(self):
+        expected = load_file('test_csv_iterator.csv')
+        attributes = ['uuid', 'email', 'address.city', 'aboutMe', 'lastUpdated', 'adlists']
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        checkpoint_path = os.path.join(tmp_dir, 'checkpoint.json')
+        csv_path = os.path.join(tmp_dir, 'export.csv')
+
+        call_side_effect = self.mockapi.call.side_effect
+
+        def mock_call(cmd, **kwargs):
+            if kwargs['filter'] == 'id > 30':
+                raise Exception('error')
+            return call_side_effect(cmd, **kwargs)
+        self.mockapi.call.side_effect = mock_call
+
+        with open(csv_path, 'wb') as fp:
+            with self.assertRaises(Exception):
+                self.records.export_csv(fp, attributes, batch_size=10, checkpoint_path=checkpoint_path)
+
+        self.mockapi.call.side_effect = call_side_effect
+        with open(csv_path, 'r+b') as fp:
+            count = self.records.export_csv(fp, attributes, batch_size=10, checkpoint_path=checkpoint_path)
+        self.assertEqual(count, 13)
+        with open(csv_path, encoding='utf-8') as fp:
+            self.assertEqual(fp.read(), expected)
+
+    @mock.patch('concurrent.futures.ProcessPoolExecutor', concurrent.futures.ThreadPoolExecutor)
+    def test_export_csv_shards(self):
+        expected = load_file('test_csv_iterator.csv')
+        attributes = ['uuid', 'email', 'address.city', 'aboutMe', 'lastUpdated', 'adlists']
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path_template = os.path.join(tmp_dir, 'export-{}.csv')
+
+        count = self.records.export_csv_shards(path_template, attributes, shards=4, batch_size=5)
+        self.assertEqual(count, len(self.mockapi.entities))
+        shard_paths = sorted(os.listdir(tmp_dir))
+        self.assertEqual(shard_paths, ['export-{}.csv'.format(i) for i in range(1, 5)])
+        rows = []
+        for path in shard_paths:
+            with open(os.path.join(tmp_dir, path), encoding='utf-8', newline='') as fp:
+                lines = fp.read().replace('\r\n', '\n').splitlines(True)
+            # every shard has a header
+            self.assertEqual(lines[0], expected.splitlines(True)[0])
+            rows.extend(lines[1:])
+        self.assertEqual(''.join(rows), ''.join(expected.splitlines(True)[1:]))
+
+        for path in shard_paths:
+            os.remove(os.path.join(tmp_dir, path))
+        merge_path = os.path.join(tmp_dir, 'export.csv')
+        self.records.export_csv_shards(path_template, attributes, shards=3, merge_path=merge_path)
+        # shards were removed
+        self.assertEqual(os.listdir(tmp_dir), ['export.csv'])
+        with open(merge_path, encoding='utf-8') as fp:
+            self.assertEqual(fp.read(), expected)
+
+    def test_export_csv_shards_processes(self):
+        expected = load_file('test_csv_iterator.csv')
+        attributes = ['uuid', 'email', 'address.city', 'aboutMe', 'lastUpdated', 'adlists']
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path_template = os.path.join(tmp_dir, 'export-{}.csv')
+        merge_path = os.path.join(tmp_dir, 'export.csv')
+
+        # the api is sent to real worker processes
+        records = SchemaRecords(App(ProcessMockapi('')), self.schema_name)
+        count = records.export_csv_shards(
+            path_template, attributes, shards=2, processes=2, batch_size=10, merge_path=merge_path)
+        self.assertEqual(count, len(self.mockapi.entities))
+        with open(merge_path, encoding='utf-8') as fp:
+            self.assertEqual(fp.read(), expected)
+
+    def test_jsonl_iterator(self):
+        lines = list(self.records.jsonl_iterator(batch_size=10))
+        self.assertEqual(len(lines), len(self.mockapi.entities))
+        for line, entity in zip(lines, self.mockapi.entities):
+            # compact, one record per line
+            self.assertTrue(line.endswith('}\n'))
+            self.assertEqual(line.count('\n'), 1)
+            self.assertNotIn(', ', line)
+            self.assertEqual(json.loads(line), entity)
+
+    def test_export_jsonl(self):
+        attributes = ['uuid', 'adlists']
+        expected = [{k: e[k] for k in attributes} for e in self.mockapi.entities]
+
+        jsonl_file = io.StringIO()
+        count = self.records.export_jsonl(jsonl_file, attributes, batch_size=10)
+        self.assertEqual(count, len(expected))
+        records = [json.loads(line) for line in jsonl_file.getvalue().splitlines()]
+        self.assertEqual(records, expected)
+
+        jsonl_file = io.BytesIO()
+        self.records.export_jsonl(jsonl_file, attributes, batch_size=10, compress=True)
+        jsonl_file.seek(0)
+        with gzip.GzipFile(fileobj=jsonl_file) as fp:
+            records = [json.loads(line) for line in fp.read().decode('utf-8').splitlines()]
+        self.assertEqual(records, expected)
+
+        with self.assertRaises(InputError):
+            self.records.export_jsonl(io.StringIO(), compress=True)
+
     def test_get_record(self):
         record = self.records.get_record('')
         self.assertTrue(isinstance(record, SchemaRecord))
@@ -1,4 +1,16 @@
+import json
+import mock
+import time
 import unittest
+from janrain_datalib.utils import AdaptiveBatchSize
+from janrain_datalib.utils import DuplicateFilter
+from janrain_datalib.utils import Projector
+from janrain_datalib.utils import RecordBuilder
+from janrain_datalib.utils import iter_json_array
+from janrain_datalib.utils import ordered_map
+from janrain_datalib.utils import read_ahead
+from janrain_datalib.utils import split_range
+from janrain_datalib.utils import to_capture_record
 from janrain_datalib.utils import to_csv
 
 class TestUtils(unittest.TestCase):
@@ -41,3 +53,196 @@ class TestUtils(unittest.TestCase):
         result = to_csv(input, delimiter=delimiter)
         # test
         self.assertEqual(result, expected)
+
+    def test_split_range(self):
+        self.assertEqual(split_range(0, 10, 3), [(0, 4), (4, 7), (7, 10)])
+        # never more ranges than ids
+        self.assertEqual(split_range(3, 5, 8), [(3, 4), (4, 5)])
+
+    def test_read_ahead(self):
+        self.assertEqual(list(read_ahead(iter(range(10)), 3)), list(range(10)))
+
+    def test_read_ahead_bounded(self):
+        consumed = []
+
+        def generator():
+            for i in range(100):
+                consumed.append(i)
+                yield i
+
+        items = read_ahead(generator(), 2)
+        self.assertEqual(next(items), 0)
+        time.sleep(0.1)
+        # the queue holds 2 items and the producer is waiting with 1 more
+        self.assertLessEqual(len(consumed), 4)
+        items.close()
+
+    def test_read_ahead_error(self):
+        def generator():
+            yield 1
+            raise ValueError('error')
+
+        items = read_ahead(generator(), 2)
+        self.assertEqual(next(items), 1)
+        with self.assertRaises(ValueError):
+            next(items)
+
+    def test_ordered_map(self):
+        def func(x):
+            time.sleep(0.01 * (x % 3))
+            return x * 2
+
+        self.assertEqual(list(ordered_map(func, range(20), 4)), [x * 2 for x in range(20)])
+
+    def test_ordered_map_bounded(self):
+        consumed = []
+
+        def generator():
+            for i in range(100):
+                consumed.append(i)
+                yield i
+
+        results = ordered_map(lambda x: x, generator(), 2)
+        self.assertEqual(next(results), 0)
+        self.assertLessEqual(len(consumed), 4)
+        results.close()
+
+    def test_ordered_map_error(self):
+        def func(x):
+            if x == 3:
+                raise ValueError('error')
+            return x
+
+        results = ordered_map(func, range(10), 2)
+        self.assertEqual([next(results) for _ in range(3)], [0, 1, 2])
+        with self.assertRaises(ValueError):
+            next(results)
+
+    def test_adaptive_batch_size(self):
+        batch_size = AdaptiveBatchSize(initial=100, maximum=300, target_seconds=1.0, target_bytes=1000)
+        # fast and small: grow, but never more than double
+        batch_size.update(100, 100, 0.1, 100)
+        self.assertEqual(batch_size.size, 200)
+        batch_size.update(200, 200, 0.1, 100)
+        self.assertEqual(batch_size.size, 300)
+        # slow: shrink towards the target time
+        batch_size.update(300, 300, 2.0, 100)
+        self.assertEqual(batch_size.size, 150)
+        # large: shrink towards the target size
+        batch_size.update(150, 150, 0.1, 1500)
+        self.assertEqual(batch_size.size, 100)
+        # a short batch does not grow it
+        batch_size.update(100, 10, 0.1, 10)
+        self.assertEqual(batch_size.size, 100)
+
+    def test_adaptive_batch_size_shrink(self):
+        batch_size = AdaptiveBatchSize(initial=4, minimum=1)
+        self.assertTrue(batch_size.shrink(4))
+        self.assertEqual(batch_size.size, 2)
+        self.assertTrue(batch_size.shrink(2))
+        self.assertEqual(batch_size.size, 1)
+        self.assertFalse(batch_size.shrink(1))
+
+    def test_projector(self):
+        project = Projector(['a', 'b.c', 'b.d.e'])
+        self.assertEqual(project.attributes, ['a', 'b.c', 'b.d.e'])
+        self.assertEqual(project({'a': 1, 'b': {'c': 2, 'd': {'e': [3]}}}), [1, 2, [3]])
+        # missing or null objects along the way
+        self.assertEqual(project({'b': {'c': 2, 'd': None}}), [None, 2, None])
+        self.assertEqual(project({'b': None}), [None, None, None])
+
+        project = Projector(['a', 'b.c'], default='')
+        self.assertEqual(project({}), ['', ''])
+
+    def test_record_builder(self):
+        key_map = {'a': 'x.a', 'b': 'x.y.b', 'c': 'c'}
+        transform_map = {'b': int, 'd': str.upper}
+        build = RecordBuilder(key_map, transform_map)
+        records = [
+            {'a': 1, 'b': '2', 'c': 3, 'd': 'four', 'e.f': 5},
+            {'b': '6'},
+            {},
+        ]
+        for record in records:
+            self.assertEqual(build(record), to_capture_record(record, key_map, transform_map))
+        self.assertEqual(build(records[0]), {
+            'x': {'a': 1, 'y': {'b': 2}}, 'c': 3, 'd': 'FOUR', 'e': {'f': 5}})
+        # a builder can stand in for the maps
+        self.assertEqual(to_capture_record(records[1], build), {'x': {'y': {'b': 6}}})
+
+    def test_duplicate_filter(self):
+        duplicates = DuplicateFilter([['email'], ['name.given', 'name.family']])
+        first = duplicates.keys({'email': 'a', 'name': {'given': 'x', 'family': 'y'}})
+        self.assertEqual(len(first), 2)
+        self.assertIsNone(duplicates.reserve(first))
+        # the first record is still being created
+        self.assertEqual(duplicates.reserve(duplicates.keys({'email': 'a'})), 'pending')
+        duplicates.release(first, created=True)
+        self.assertEqual(duplicates.reserve(duplicates.keys({'email': 'a'})), 'duplicate')
+        self.assertEqual(duplicates.reserve(duplicates.keys(
+            {'email': 'b', 'name': {'given': 'x', 'family': 'y'}})), 'duplicate')
+        self.assertIsNone(duplicates.reserve(duplicates.keys(
+            {'email': 'b', 'name': {'given': 'x', 'family': 'z'}})))
+        # keys with missing or null values are not checked
+        self.assertEqual(duplicates.keys({'email': None, 'name': {'given': 'x'}}), [])
+        self.assertEqual(len(duplicates), 2)
+
+    def test_duplicate_filter_failed(self):
+        duplicates = DuplicateFilter([['email']])
+        keys = duplicates.keys({'email': 'a'})
+        self.assertIsNone(duplicates.reserve(keys))
+        duplicates.release(keys, created=False)
+        # a record that failed is not a duplicate of anything
+        self.assertIsNone(duplicates.reserve(keys))
+        self.assertEqual(len(duplicates), 0)
+
+    def test_duplicate_filter_bounded(self):
+        duplicates = DuplicateFilter([['email']], max_keys=2)
+        for email in ['a', 'b', 'c']:
+            keys = duplicates.keys({'email': email})
+            self.assertIsNone(duplicates.reserve(keys))
+            duplicates.release(keys, created=True)
+        self.assertEqual(len(duplicates), 2)
+        self.assertEqual(duplicates.reserve(duplicates.keys({'email': 'b'})), 'duplicate')
+        # not remembered, so not found
+        self.assertIsNone(duplicates.reserve(duplicates.keys({'email': 'c'})))
+
+    def test_iter_json_array(self):
+        body = {
+            'result_count': 3,
+            'results': [{'a': 'x]}"{[', 'b': '\\"\\', 'n': 12345, 'u': '\u57ce'}, 123456789,
+                        [1, [2]], 'y', True],
+            'stat': 'ok',
+        }
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        # every chunk size, including ones that split multibyte characters and numbers
+        for size in range(1, len(data) + 1):
+            chunks = [data[i:i + size] for i in range(0, len(data), size)]
+            extra = {}
+            self.assertEqual(list(iter_json_array(chunks, 'results', extra)), body['results'])
+            self.assertEqual(extra, {'result_count': 3, 'stat': 'ok'})
+
+        extra = {}
+        self.assertEqual(list(iter_json_array([b'{"stat": "error", "code": 1}'], 'results', extra)), [])
+        self.assertEqual(extra, {'stat': 'error', 'code': 1})
+
+    def test_iter_json_array_large_item(self):
+        item = {'aboutMe': 'x' * 100000, 'plural': [{'n': i} for i in range(1000)]}
+        data = json.dumps({'results': [item, 1]}).encode('utf-8')
+        chunks = [data[i:i + 16] for i in range(0, len(data), 16)]
+        with mock.patch('janrain_datalib.utils._JSON_DECODER', wraps=json.JSONDecoder()) as decoder:
+            self.assertEqual(list(iter_json_array(chunks, 'results')), [item, 1])
+        # decoded once rather than again after every chunk
+        self.assertEqual(decoder.raw_decode.call_count, 3)
+
+    def test_iter_json_array_lazy(self):
+        def chunks():
+            yield b'{"results": [1, '
+            raise RuntimeError("not needed yet")
+        items = iter_json_array(chunks(), 'results')
+        self.assertEqual(next(items), 1)
+
+    def test_iter_json_array_invalid(self):
+        for data in [b'{"results": [1, 2', b'{"results": [1 2]}', b'[1]', b'']:
+            with self.assertRaises(ValueError):
+                list(iter_json_array([data], 'results'))